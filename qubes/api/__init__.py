@@ -20,6 +20,7 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
 import errno
 import functools
 import io
@@ -95,6 +96,122 @@ def apply_filters(iterable, filters):
     return iterable
 
 
+class PermissionCache:
+    '''Cache of ``admin-permission:...`` decisions
+
+    The result of the event (either a list of filters, or
+    :py:class:`PermissionDenied`) is cached per ``(src, method, dest, arg)``.
+    A decision is cached only if *all* handlers of the event declared which
+    events invalidate it (see *invalidated_by* argument of
+    :py:func:`qubes.ext.handler`); when any of those events is fired, on any
+    qube or on the app, the whole cache is dropped. It is dropped also when
+    any qube is added or removed.
+
+    Calls passing additional arguments to the event (like the new value of a
+    property) are never cached.
+
+    The argument of a call is chosen by the caller, so the cache keeps only
+    *max_entries* most recently used decisions.
+    '''
+
+    #: default limit of cached decisions
+    default_max_entries = 10000
+
+    def __init__(self, app, max_entries=None):
+        #: :py:class:`qubes.Qubes` object
+        self.app = app
+        #: maximum number of cached decisions
+        self.max_entries = max_entries or self.default_max_entries
+        self._cache = collections.OrderedDict()
+        self._watched_events = set()
+
+        self.app.add_handler('domain-add', self.on_domain_add)
+        self.app.add_handler('domain-delete', self.on_domain_delete)
+
+    def close(self):
+        '''Unregister all the event handlers'''
+        self.app.remove_handler('domain-add', self.on_domain_add)
+        self.app.remove_handler('domain-delete', self.on_domain_delete)
+        for event in self._watched_events:
+            self.app.remove_handler(event, self.on_invalidating_event)
+        for vm in self.app.domains:
+            self._unwatch_vm(vm)
+        self._watched_events.clear()
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def invalidate(self):
+        '''Drop all cached decisions'''
+        self._cache.clear()
+
+    @staticmethod
+    def get_invalidating_events(subject, event):
+        '''Collect events invalidating decision of handlers of *event*
+
+        :return: set of event names, or :py:obj:`None` if any handler did \
+            not declare it (and the decision cannot be cached)
+        '''
+        invalidating_events = set()
+        for func in subject.get_handlers(event, pre_event=True):
+            try:
+                invalidating_events.update(func.ha_invalidated_by)
+            except AttributeError:
+                return None
+        return invalidating_events
+
+    def fire_event_for_permission(self, subject, event, dest, arg):
+        '''Fire *event* on *subject*, or return the cached result'''
+        key = (subject.name, event, dest.name, arg)
+        try:
+            effects, denied = self._cache[key]
+            self._cache.move_to_end(key)
+        except KeyError:
+            invalidating_events = self.get_invalidating_events(subject, event)
+            effects, denied = None, None
+            try:
+                effects = subject.fire_event(event, pre_event=True,
+                    dest=dest, arg=arg)
+            except PermissionDenied as e:
+                denied = e.args
+            if invalidating_events is not None:
+                self._watch(invalidating_events)
+                self._cache[key] = (effects, denied)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+
+        if denied is not None:
+            raise PermissionDenied(*denied)
+        return list(effects)
+
+    def _watch(self, events):
+        for event in events.difference(self._watched_events):
+            self._watched_events.add(event)
+            self.app.add_handler(event, self.on_invalidating_event)
+            for vm in self.app.domains:
+                vm.add_handler(event, self.on_invalidating_event)
+
+    def _unwatch_vm(self, vm):
+        for event in self._watched_events:
+            vm.remove_handler(event, self.on_invalidating_event)
+
+    def on_invalidating_event(self, subject, event, **kwargs):
+        # pylint: disable=unused-argument
+        self._cache.clear()
+
+    def on_domain_add(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        for watched_event in self._watched_events:
+            vm.add_handler(watched_event, self.on_invalidating_event)
+        self._cache.clear()
+
+    def on_domain_delete(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        self._unwatch_vm(vm)
+        self._cache.clear()
+
+
 class AbstractQubesAPI:
     '''Common code for Qubes Management Protocol handling
 
@@ -114,7 +231,8 @@ class AbstractQubesAPI:
     #: the preferred socket location (to be overridden in child's class)
     SOCKNAME = None
 
-    def __init__(self, app, src, method_name, dest, arg, send_event=None):
+    def __init__(self, app, src, method_name, dest, arg, send_event=None,
+            permission_cache=None):
         #: :py:class:`qubes.Qubes` object
         self.app = app
 
@@ -142,6 +260,9 @@ class AbstractQubesAPI:
         #: callback for sending events if applicable
         self.send_event = send_event
 
+        #: :py:class:`PermissionCache` object, if decisions should be cached
+        self.permission_cache = permission_cache
+
         #: is this operation cancellable?
         self.cancellable = False
 
@@ -195,6 +316,9 @@ class AbstractQubesAPI:
 
     def fire_event_for_permission(self, **kwargs):
         '''Fire an event on the source qube to check for permission'''
+        if self.permission_cache is not None and not kwargs:
+            return self.permission_cache.fire_event_for_permission(self.src,
+                'admin-permission:' + self.method, self.dest, self.arg)
         return self.src.fire_event('admin-permission:' + self.method,
             pre_event=True, dest=self.dest, arg=self.arg, **kwargs)
 
@@ -217,10 +341,12 @@ class QubesDaemonProtocol(asyncio.Protocol):
     # (including cleanup of integration test)
     connections = set()
 
-    def __init__(self, handler, *args, app, debug=False, **kwargs):
+    def __init__(self, handler, *args, app, debug=False,
+            permission_cache=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.handler = handler
         self.app = app
+        self.permission_cache = permission_cache
         self.untrusted_buffer = io.BytesIO()
         self.len_untrusted_buffer = 0
         self.transport = None
@@ -270,7 +396,7 @@ class QubesDaemonProtocol(asyncio.Protocol):
     def respond(self, src, meth, dest, arg, *, untrusted_payload):
         try:
             self.mgmt = self.handler(self.app, src, meth, dest, arg,
-                self.send_event)
+                self.send_event, permission_cache=self.permission_cache)
             response = yield from self.mgmt.execute(
                 untrusted_payload=untrusted_payload)
             assert not (self.event_sent and response)
@@ -385,7 +511,7 @@ def cleanup_socket(sockpath, force):
                 'socket already exists: {!r}'.format(sockpath))
 
 @asyncio.coroutine
-def create_servers(*args, force=False, loop=None, **kwargs):
+def create_servers(*args, force=False, loop=None, group='qubes', **kwargs):
     '''Create multiple Qubes API servers
 
     :param qubes.Qubes app: the app that is a backend of the servers
@@ -393,6 +519,8 @@ def create_servers(*args, force=False, loop=None, **kwargs):
         sockets; if :py:obj:`False`, raise an error if there is some process \
         listening to such socket
     :param asyncio.Loop loop: loop
+    :param str group: group owning the sockets; if :py:obj:`None`, do not \
+        change it
 
     *args* are supposed to be classes inheriting from
     :py:class:`AbstractQubesAPI`
@@ -420,8 +548,9 @@ def create_servers(*args, force=False, loop=None, **kwargs):
                 functools.partial(QubesDaemonProtocol, handler, **kwargs),
                 sockpath)
 
-            for sock in server.sockets:
-                shutil.chown(sock.getsockname(), group='qubes')
+            if group is not None:
+                for sock in server.sockets:
+                    shutil.chown(sock.getsockname(), group=group)
 
             servers.append(server)
     except:
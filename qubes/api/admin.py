@@ -35,6 +35,7 @@ import yaml
 
 import qubes.api
 import qubes.backup
+import qubes.bulk
 import qubes.config
 import qubes.devices
 import qubes.firewall
@@ -42,6 +43,8 @@ import qubes.storage
 import qubes.utils
 import qubes.vm
 import qubes.vm.adminvm
+import qubes.vm.appvm
+import qubes.vm.dispvm
 import qubes.vm.qubesvm
 
 
@@ -68,6 +71,10 @@ class QubesMgmtEventsDispatcher:
             return
         self.send_event(subject, event, **kwargs)
 
+    # admin-permission:... events are ignored above, so this handler never
+    # influences the decision and does not prevent caching it
+    vm_handler.ha_invalidated_by = ()
+
     def app_handler(self, subject, event, **kwargs):
         if not list(qubes.api.apply_filters([(subject, event, kwargs)],
                 self.filters)):
@@ -780,6 +787,22 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         pool.revisions_to_keep = newvalue
         self.app.save()
 
+    @qubes.api.method('admin.autostart.Status', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def autostart_status(self):
+        '''Order and timing of autostart of qubes at qubesd startup, see
+        :py:meth:`qubes.bulk.AutostartScheduler.format_report`'''
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(not self.arg)
+
+        self.fire_event_for_permission()
+
+        scheduler = getattr(self.app, 'autostart_scheduler', None)
+        if scheduler is None:
+            raise qubes.exc.QubesException('Autostart was not run by qubesd')
+        return scheduler.format_report()
+
     @qubes.api.method('admin.label.List', no_payload=True,
         scope='global', read=True)
     @asyncio.coroutine
@@ -887,6 +910,10 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
     def vm_start(self):
         self.enforce(not self.arg)
         self.fire_event_for_permission()
+        scheduler = getattr(self.app, 'autostart_scheduler', None)
+        if scheduler is not None and scheduler.is_pending(self.dest):
+            # don't disturb the autostart order
+            yield from scheduler.wait_for(self.dest)
         try:
             yield from self.dest.start()
         except libvirt.libvirtError as e:
@@ -895,6 +922,72 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
                 ', see /var/log/libvirt/libxl/libxl-driver.log for details')
 
 
+    @qubes.api.method('admin.vm.BulkStart', scope='global', execute=True)
+    @asyncio.coroutine
+    def vm_bulk_start(self, untrusted_payload):
+        '''Start multiple qubes (and their dependencies), in parallel.
+
+        Payload is a list of qube names, one per line. Optional argument is
+        the maximum number of qubes started at the same time. Response
+        contains one line for each qube: either ``<name> ok`` or
+        ``<name> error <exception class> <message>``.
+        '''
+        self.enforce(self.dest.name == 'dom0')
+        max_concurrency = None
+        if self.arg:
+            self.enforce(self.arg.isdigit() and 0 < int(self.arg) <= 256)
+            max_concurrency = int(self.arg)
+
+        vms = self._get_bulk_vms(untrusted_payload)
+
+        results = yield from qubes.bulk.start_domains(self.app, vms,
+            max_concurrency=max_concurrency)
+        return self._format_bulk_results(results)
+
+    @qubes.api.method('admin.vm.BulkShutdown', scope='global', execute=True)
+    @asyncio.coroutine
+    def vm_bulk_shutdown(self, untrusted_payload):
+        '''Shut down multiple qubes, in reverse dependency order.
+
+        Payload is a list of qube names, one per line. Argument ``kill``
+        requests killing qubes which did not shut down in time. Response
+        has the same format as for ``admin.vm.BulkStart``. Progress is
+        reported with ``domain-bulk-shutdown`` events.
+        '''
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(self.arg in ('', 'kill'))
+
+        vms = self._get_bulk_vms(untrusted_payload)
+
+        results = yield from qubes.bulk.shutdown_domains(self.app, vms,
+            kill=(self.arg == 'kill'))
+        return self._format_bulk_results(results)
+
+    def _get_bulk_vms(self, untrusted_payload):
+        '''Parse list of qube names for bulk operations'''
+        untrusted_names = set(untrusted_payload.decode('ascii').split())
+        self.enforce(untrusted_names)
+        self.enforce(all(untrusted_name in self.app.domains
+            for untrusted_name in untrusted_names))
+        vms = [self.app.domains[name] for name in untrusted_names]
+        del untrusted_names
+
+        allowed = list(self.fire_event_for_filter(vms))
+        self.enforce(len(allowed) == len(vms))
+        return vms
+
+    @staticmethod
+    def _format_bulk_results(results):
+        response = ''
+        for vm in sorted(results):
+            exc = results[vm]
+            if exc is None:
+                response += '{} ok\n'.format(vm.name)
+            else:
+                response += '{} error {} {}\n'.format(vm.name,
+                    type(exc).__name__, ' '.join(str(exc).split()))
+        return response
+
     @qubes.api.method('admin.vm.Shutdown', no_payload=True,
         scope='local', execute=True)
     @asyncio.coroutine
@@ -1174,7 +1267,10 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         scope='global', write=True)
     @asyncio.coroutine
     def create_disposable(self):
-        self.enforce(not self.arg)
+        # 'prestarted' - the caller starts the DispVM right away, without
+        # changing its configuration, so it may get an already running one
+        # from a pool of pre-started DispVMs
+        self.enforce(self.arg in ('', 'prestarted'))
 
         if self.dest.name == 'dom0':
             dispvm_template = self.src.default_dispvm
@@ -1183,12 +1279,53 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.fire_event_for_permission(dispvm_template=dispvm_template)
 
-        dispvm = yield from qubes.vm.dispvm.DispVM.from_appvm(dispvm_template)
+        dispvm = yield from qubes.vm.dispvm.DispVM.from_appvm(dispvm_template,
+            prestarted=self.arg == 'prestarted')
         # TODO: move this to extension (in race-free fashion, better than here)
         dispvm.tags.add('disp-created-by-' + str(self.src))
 
         return dispvm.name
 
+    @qubes.api.method('admin.vm.DispVMPoolInfo', no_payload=True,
+        scope='local', read=True)
+    @asyncio.coroutine
+    def vm_dispvm_pool_info(self):
+        '''Statistics of the pool of ready DispVMs based on this qube.'''
+        self.enforce(not self.arg)
+        self.enforce(isinstance(self.dest, qubes.vm.appvm.AppVM))
+
+        self.fire_event_for_permission()
+
+        pools = getattr(self.app, 'dispvm_pools', None)
+        if pools is None:
+            raise qubes.exc.QubesException('DispVM pools are not enabled')
+        stats = pools.get_pool(self.dest).get_stats()
+        response = ''
+        for key, value in sorted(stats.items()):
+            if value is None:
+                value = ''
+            elif isinstance(value, bool):
+                value = int(value)
+            elif isinstance(value, float):
+                value = '{:.3f}'.format(value)
+            response += '{}={}\n'.format(key, value)
+        return response
+
+    @qubes.api.method('admin.vm.Timings', no_payload=True,
+        scope='local', read=True)
+    @asyncio.coroutine
+    def vm_timings(self):
+        '''Durations of phases of the last start and shutdown operations,
+        one per line (oldest first): wall-clock start time, operation name,
+        result, total duration and ``phase=duration`` pairs.'''
+        self.enforce(not self.arg)
+
+        self.fire_event_for_permission()
+
+        timings = getattr(self.dest, 'operation_timings', ())
+        return ''.join('{:.3f} {!s}\n'.format(timing.started, timing)
+            for timing in timings)
+
     @qubes.api.method('admin.vm.Remove', no_payload=True,
         scope='global', write=True)
     @asyncio.coroutine
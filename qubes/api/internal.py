@@ -21,15 +21,161 @@
 ''' Internal interface for dom0 components to communicate with qubesd. '''
 
 import asyncio
+import functools
 import json
 import subprocess
+import weakref
 
 import qubes.api
 import qubes.api.admin
+import qubes.config
+import qubes.exc
 import qubes.vm.adminvm
 import qubes.vm.dispvm
 
 
+def get_domain_info(domain):
+    '''Describe a single domain, as included in internal.GetSystemInfo'''
+    return {
+        'tags': list(domain.tags),
+        'type': domain.__class__.__name__,
+        'template_for_dispvms':
+            getattr(domain, 'template_for_dispvms', False),
+        'default_dispvm': (str(domain.default_dispvm) if
+            getattr(domain, 'default_dispvm', None) else None),
+        'icon': str(domain.label.icon),
+    }
+
+
+class SystemInfoCache:
+    '''Cached result of internal.GetSystemInfo
+
+    The information is updated incrementally, only for domains affected by
+    an event (domain added or removed, tag, label, or any of the included
+    properties changed). Each update increases :py:attr:`generation`, which
+    allows to ask for changes since given generation.
+
+    The cache does not keep a reference to the app, so it can be stored in
+    :py:data:`_system_info_caches` without keeping the app alive.
+    '''
+
+    #: events, fired on a domain, which may change its description
+    domain_events = (
+        'domain-tag-add:*',
+        'domain-tag-delete:*',
+        'property-set:label',
+        'property-set:default_dispvm',
+        'property-del:default_dispvm',
+        'property-set:template_for_dispvms',
+        'property-del:template_for_dispvms',
+    )
+
+    #: events, fired on the app, which may change description of any domain
+    app_events = (
+        'property-set:default_dispvm',
+        'property-del:default_dispvm',
+    )
+
+    def __init__(self, app):
+        #: incremented on each change; domains present initially are
+        #: reported as changed in generation 1, so changes since generation 0
+        #: always include all the domains
+        self.generation = 1
+        self._domains = {}
+        #: domain name -> generation of the last change of this domain
+        self._changes = {}
+        self._serialized = None
+
+        app.add_handler('domain-add', self.on_domain_add)
+        app.add_handler('domain-delete', self.on_domain_delete)
+        for event in self.app_events:
+            app.add_handler(event, self.on_app_changed)
+        for domain in app.domains:
+            self._watch(domain)
+            self._domains[domain.name] = get_domain_info(domain)
+            self._changes[domain.name] = self.generation
+
+    def _watch(self, domain):
+        for event in self.domain_events:
+            domain.add_handler(event, self.on_domain_changed)
+
+    def _unwatch(self, domain):
+        for event in self.domain_events:
+            domain.remove_handler(event, self.on_domain_changed)
+
+    def _update(self, name, info):
+        if self._domains.get(name) == info:
+            return
+        self.generation += 1
+        self._changes[name] = self.generation
+        self._serialized = None
+        if info is None:
+            del self._domains[name]
+        else:
+            self._domains[name] = info
+
+    def get_system_info(self):
+        '''Return serialized information about all domains'''
+        if self._serialized is None:
+            self._serialized = json.dumps({'domains': self._domains})
+        return self._serialized
+
+    def get_changes(self, since):
+        '''Return serialized information about domains changed after
+        generation *since*
+
+        Removed domains are listed with :py:obj:`None` description. If
+        *since* is from the future (for example the client talked to
+        another instance of qubesd), all domains are included and ``full``
+        is set to :py:obj:`True`.
+        '''
+        full = since > self.generation
+        if full:
+            domains = self._domains
+        else:
+            domains = {name: self._domains.get(name)
+                for name, generation in self._changes.items()
+                if generation > since}
+        return json.dumps({
+            'generation': self.generation,
+            'full': full,
+            'domains': domains,
+        })
+
+    def on_domain_add(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        self._watch(vm)
+        self._update(vm.name, get_domain_info(vm))
+
+    def on_domain_delete(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        self._unwatch(vm)
+        self._update(vm.name, None)
+
+    def on_domain_changed(self, subject, event, **kwargs):
+        # pylint: disable=unused-argument
+        self._update(subject.name, get_domain_info(subject))
+
+    def on_app_changed(self, subject, event, **kwargs):
+        # pylint: disable=unused-argument
+        for domain in subject.domains:
+            self._update(domain.name, get_domain_info(domain))
+
+
+#: :py:class:`SystemInfoCache` for each app
+_system_info_caches = weakref.WeakKeyDictionary()
+
+
+def get_system_info_cache(app):
+    '''Return :py:class:`SystemInfoCache` for *app*, creating it if
+    needed'''
+    try:
+        return _system_info_caches[app]
+    except KeyError:
+        cache = _system_info_caches[app] = SystemInfoCache(app)
+        return cache
+
+
 class QubesInternalAPI(qubes.api.AbstractQubesAPI):
     ''' Communication interface for dom0 components,
     by design the input here is trusted.'''
@@ -42,19 +188,17 @@ class QubesInternalAPI(qubes.api.AbstractQubesAPI):
         self.enforce(self.dest.name == 'dom0')
         self.enforce(not self.arg)
 
-        system_info = {'domains': {
-            domain.name: {
-                'tags': list(domain.tags),
-                'type': domain.__class__.__name__,
-                'template_for_dispvms':
-                    getattr(domain, 'template_for_dispvms', False),
-                'default_dispvm': (str(domain.default_dispvm) if
-                    getattr(domain, 'default_dispvm', None) else None),
-                'icon': str(domain.label.icon),
-            } for domain in self.app.domains
-        }}
+        return get_system_info_cache(self.app).get_system_info()
 
-        return json.dumps(system_info)
+    @qubes.api.method('internal.GetSystemInfoChanges', no_payload=True)
+    @asyncio.coroutine
+    def getsysteminfochanges(self):
+        '''Return information about domains changed since generation given
+        as the argument, together with the current generation number.'''
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(self.arg.isdigit())
+
+        return get_system_info_cache(self.app).get_changes(int(self.arg))
 
     @qubes.api.method('internal.vm.volume.ImportEnd')
     @asyncio.coroutine
@@ -81,47 +225,122 @@ class QubesInternalAPI(qubes.api.AbstractQubesAPI):
         if not success:
             raise qubes.exc.QubesException('Data import failed')
 
+    def _get_suspend_setting(self, feature, default, convert=int,
+            minimum=None):
+        '''Get setting of suspend handling from dom0 *feature*
+
+        Invalid values are replaced by *default*, values lower than
+        *minimum* are raised to it.
+        '''
+        try:
+            value = self.app.domains['dom0'].features.get(feature, None)
+        except KeyError:
+            return default
+        if not value:
+            return default
+        try:
+            value = convert(value)
+        except ValueError:
+            self.app.log.warning('Invalid value of %s feature: %r, using %s',
+                feature, value, default)
+            return default
+        if minimum is not None and value < minimum:
+            self.app.log.warning('Too low value of %s feature: %s, using %s',
+                feature, value, minimum)
+            return minimum
+        return value
+
+    @asyncio.coroutine
+    def _run_for_vms(self, vms, func, description):
+        '''Call coroutine *func* for each of *vms*, with bounded
+        concurrency (``suspend-max-concurrency`` feature of dom0).
+
+        Calls not finished in ``suspend-timeout`` (feature of dom0, in
+        seconds) are cancelled and reported.
+
+        :return: list of VMs for which *func* did not finish in time
+        '''
+        timeout = self._get_suspend_setting('suspend-timeout',
+            qubes.config.defaults['suspend_timeout'], convert=float)
+        semaphore = asyncio.Semaphore(self._get_suspend_setting(
+            'suspend-max-concurrency',
+            qubes.config.defaults['suspend_max_concurrency'], minimum=1))
+
+        @asyncio.coroutine
+        def run(vm):
+            with (yield from semaphore):
+                yield from func(vm)
+
+        tasks = {asyncio.ensure_future(run(vm)): vm for vm in vms}
+        if not tasks:
+            return []
+        done, pending = yield from asyncio.wait(tasks, timeout=timeout)
+        for task in done:
+            if task.exception() is not None:
+                tasks[task].log.warning('Failed to %s: %s', description,
+                    str(task.exception()))
+        if pending:
+            for task in pending:
+                task.cancel()
+            yield from asyncio.wait(pending)
+        stragglers = sorted((tasks[task] for task in pending),
+            key=lambda vm: vm.name)
+        if stragglers:
+            self.app.log.warning('Timeout while trying to %s: %s',
+                description, ', '.join(vm.name for vm in stragglers))
+        return stragglers
+
+    @staticmethod
+    @asyncio.coroutine
+    def _notify_vm(vm, service):
+        '''Run *service* in *vm* (if it supports qrexec) and wait for it
+        to finish; kill it if cancelled'''
+        if not vm.features.check_with_template('qrexec', False):
+            return
+        try:
+            proc = yield from vm.run_service(
+                service, user='root',
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+        except qubes.exc.QubesException as e:
+            vm.log.warning('Failed to run %s: %s', service, str(e))
+            return
+        try:
+            yield from proc.wait()
+        except asyncio.CancelledError:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            raise
+
     @qubes.api.method('internal.SuspendPre', no_payload=True)
     @asyncio.coroutine
     def suspend_pre(self):
         '''
         Method called before host system goes to sleep.
 
+        VMs are first notified, then suspended/paused, in parallel. Each
+        of the steps is limited by ``suspend-timeout`` feature of dom0 (in
+        seconds); VMs not handled in time are logged. VMs are suspended even
+        if they did not handle the notification in time.
+
         :return:
         '''
+        vms = [vm for vm in self.app.domains
+            if not isinstance(vm, qubes.vm.adminvm.AdminVM)]
 
         # first notify all VMs
-        processes = []
-        for vm in self.app.domains:
-            if isinstance(vm, qubes.vm.adminvm.AdminVM):
-                continue
-            if not vm.is_running():
-                continue
-            if not vm.features.check_with_template('qrexec', False):
-                continue
-            try:
-                proc = yield from vm.run_service(
-                    'qubes.SuspendPreAll', user='root',
-                    stdin=subprocess.DEVNULL,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL)
-                processes.append(proc)
-            except qubes.exc.QubesException as e:
-                vm.log.warning('Failed to run qubes.SuspendPreAll: %s', str(e))
-
-        # FIXME: some timeout?
-        if processes:
-            yield from asyncio.wait([p.wait() for p in processes])
-
-        coros = []
+        yield from self._run_for_vms(
+            [vm for vm in vms if vm.is_running()],
+            functools.partial(self._notify_vm, service='qubes.SuspendPreAll'),
+            'run qubes.SuspendPreAll')
+
         # then suspend/pause VMs
-        for vm in self.app.domains:
-            if isinstance(vm, qubes.vm.adminvm.AdminVM):
-                continue
-            if vm.is_running():
-                coros.append(vm.suspend())
-        if coros:
-            yield from asyncio.wait(coros)
+        yield from self._run_for_vms(
+            [vm for vm in vms if vm.is_running()],
+            lambda vm: vm.suspend(), 'suspend')
 
     @qubes.api.method('internal.SuspendPost', no_payload=True)
     @asyncio.coroutine
@@ -129,38 +348,23 @@ class QubesInternalAPI(qubes.api.AbstractQubesAPI):
         '''
         Method called after host system wake up from sleep.
 
+        VMs are first resumed/unpaused, then notified, in parallel. Each
+        of the steps is limited by ``suspend-timeout`` feature of dom0 (in
+        seconds); VMs not handled in time are logged.
+
         :return:
         '''
+        vms = [vm for vm in self.app.domains
+            if not isinstance(vm, qubes.vm.adminvm.AdminVM)]
 
-        coros = []
         # first resume/unpause VMs
-        for vm in self.app.domains:
-            if isinstance(vm, qubes.vm.adminvm.AdminVM):
-                continue
-            if vm.get_power_state() in ["Paused", "Suspended"]:
-                coros.append(vm.resume())
-        if coros:
-            yield from asyncio.wait(coros)
+        yield from self._run_for_vms(
+            [vm for vm in vms
+                if vm.get_power_state() in ["Paused", "Suspended"]],
+            lambda vm: vm.resume(), 'resume')
 
         # then notify all VMs
-        processes = []
-        for vm in self.app.domains:
-            if isinstance(vm, qubes.vm.adminvm.AdminVM):
-                continue
-            if not vm.is_running():
-                continue
-            if not vm.features.check_with_template('qrexec', False):
-                continue
-            try:
-                proc = yield from vm.run_service(
-                    'qubes.SuspendPostAll', user='root',
-                    stdin=subprocess.DEVNULL,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL)
-                processes.append(proc)
-            except qubes.exc.QubesException as e:
-                vm.log.warning('Failed to run qubes.SuspendPostAll: %s', str(e))
-
-        # FIXME: some timeout?
-        if processes:
-            yield from asyncio.wait([p.wait() for p in processes])
+        yield from self._run_for_vms(
+            [vm for vm in vms if vm.is_running()],
+            functools.partial(self._notify_vm, service='qubes.SuspendPostAll'),
+            'run qubes.SuspendPostAll')
@@ -21,6 +21,7 @@
 #
 
 import collections
+import concurrent.futures
 import copy
 import functools
 import grp
@@ -30,9 +31,11 @@ import os
 import random
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import uuid
+import weakref
 
 import asyncio
 import jinja2
@@ -110,22 +113,102 @@ class VirDomainWrapper:
         return wrapper
 
 
+#: number of threads making libvirt calls for :py:class:`AsyncVirDomainWrapper`
+LIBVIRT_EXECUTOR_WORKERS = 8
+_libvirt_executor = None
+
+
+def get_libvirt_executor():
+    """Get executor for blocking libvirt calls, create it if needed"""
+    global _libvirt_executor  # pylint: disable=global-statement
+    if _libvirt_executor is None:
+        _libvirt_executor = concurrent.futures.ThreadPoolExecutor(
+            LIBVIRT_EXECUTOR_WORKERS)
+    return _libvirt_executor
+
+
+class AsyncVirDomainWrapper:
+    """Asynchronous facade of a libvirt domain (:py:class:`VirDomainWrapper`)
+
+    Each method returns a coroutine, which calls the respective method of the
+    domain in :py:func:`get_libvirt_executor`, so a slow libvirt call does
+    not block the event loop. Calls through a single facade are serialized,
+    calls on different domains run in parallel.
+
+    >>> yield from AsyncVirDomainWrapper(domain).createWithFlags(flags)
+    """
+    # pylint: disable=too-few-public-methods
+
+    _instances = weakref.WeakKeyDictionary()
+
+    def __init__(self, domain):
+        #: the wrapped domain
+        self.domain = domain
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def for_domain(cls, domain):
+        """Get the facade of *domain*, shared by all its users for as long
+        as the domain object lives"""
+        try:
+            return cls._instances[domain]
+        except KeyError:
+            wrapper = cls._instances[domain] = cls(domain)
+            return wrapper
+        except TypeError:
+            # not weakly referenceable (None in offline mode)
+            return cls(domain)
+
+    def __getattr__(self, attrname):
+        @asyncio.coroutine
+        def wrapper(*args, **kwargs):
+            with (yield from self._lock):
+                func = functools.partial(getattr(self.domain, attrname),
+                    *args, **kwargs)
+                return (yield from asyncio.get_event_loop().run_in_executor(
+                    get_libvirt_executor(), func))
+
+        wrapper.__name__ = attrname
+        return wrapper
+
+
 class VirConnectWrapper:
     # pylint: disable=too-few-public-methods
 
     def __init__(self, uri, reconnect_cb=None):
         self._conn = libvirt.open(uri)
         self._reconnect_cb = reconnect_cb
+        self._reconnect_lock = threading.Lock()
+        try:
+            #: event loop to call *reconnect_cb* in, and its thread
+            self._loop = asyncio.get_event_loop()
+            self._loop_thread = threading.get_ident()
+        except RuntimeError:
+            # no event loop in this thread
+            self._loop = None
+            self._loop_thread = None
+
+    def _reconnected(self, old_conn):
+        if callable(self._reconnect_cb):
+            self._reconnect_cb(old_conn)
+        old_conn.close()
 
     def _reconnect_if_dead(self):
-        is_dead = not self._conn.isAlive()
-        if is_dead:
-            uri = self._conn.getURI()
-            old_conn = self._conn
-            self._conn = libvirt.open(uri)
-            if callable(self._reconnect_cb):
-                self._reconnect_cb(old_conn)
-            old_conn.close()
+        # may be called from libvirt executor threads at the same time
+        with self._reconnect_lock:
+            is_dead = not self._conn.isAlive()
+            if is_dead:
+                uri = self._conn.getURI()
+                old_conn = self._conn
+                self._conn = libvirt.open(uri)
+                # the callback (re)registers event handlers and may fire
+                # events, so it needs to run in the event loop
+                if self._loop is not None and not self._loop.is_closed() \
+                        and threading.get_ident() != self._loop_thread:
+                    self._loop.call_soon_threadsafe(self._reconnected,
+                        old_conn)
+                else:
+                    self._reconnected(old_conn)
         return is_dead
 
     def _wrap_domain(self, ret):
@@ -726,6 +809,10 @@ class Qubes(qubes.PropertyHolder):
 
     Methods and attributes:
     """
+    # the application object is the root of all state; config_generation
+    # has to be here, as it is shared by all domains
+    # pylint: disable=too-many-instance-attributes
+
     default_guivm = qubes.VMProperty(
         'default_guivm',
         load_stage=3,
@@ -880,6 +967,10 @@ class Qubes(qubes.PropertyHolder):
         self.__locked_fh = None
         self._domain_event_callback_id = None
 
+        #: incremented on each change of global properties; used to detect
+        #: stale cached libvirt config of domains
+        self.config_generation = 0
+
         #: jinja2 environment for libvirt XML templates
         self.env = jinja2.Environment(
             loader=jinja2.FileSystemLoader([
@@ -897,6 +988,12 @@ class Qubes(qubes.PropertyHolder):
     def store(self):
         return self._store
 
+    @property
+    def cache_libvirt_state(self):
+        '''Domains cache their libvirt state, kept up to date by libvirt
+        lifecycle events; enabled by :py:meth:`register_event_handlers`'''
+        return self._domain_event_callback_id is not None
+
     def _migrate_global_properties(self):
         """Migrate renamed/dropped properties"""
         if self.xml is None:
@@ -1391,6 +1488,9 @@ class Qubes(qubes.PropertyHolder):
                 libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
                 self._domain_event_callback,
                 None))
+        # events could be missed while reconnecting
+        for vm in self.domains:
+            vm.invalidate_libvirt_state()
 
     def _domain_event_callback(self, _conn, domain, event, _detail, _opaque):
         """Generic libvirt event handler (virConnectDomainEventCallback),
@@ -1405,6 +1505,10 @@ class Qubes(qubes.PropertyHolder):
             # ignore events for unknown domains
             return
 
+        # the event may be delivered after the state changed again, so do not
+        # try to deduce the new state from it
+        vm.invalidate_libvirt_state()
+
         if event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
             vm.on_libvirt_domain_stopped()
         elif event == libvirt.VIR_DOMAIN_EVENT_SUSPENDED:
@@ -1462,6 +1566,11 @@ class Qubes(qubes.PropertyHolder):
             except AttributeError:
                 pass
 
+    @qubes.events.handler('property-set:*', 'property-del:*')
+    def on_property_change(self, event, name, **kwargs):
+        # pylint: disable=unused-argument
+        self.config_generation += 1
+
     @qubes.events.handler('property-pre-set:clockvm')
     def on_property_pre_set_clockvm(self, event, name, newvalue, oldvalue=None):
         # pylint: disable=unused-argument,no-self-use
@@ -0,0 +1,574 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Operations on multiple qubes at once.
+
+Qubes depend on each other: a qube needs its netvm, guivm and backends of
+its persistent devices running before it can start itself. Functions here
+order the operations according to those dependencies, and run independent
+ones concurrently.
+
+Shutdown goes the other way round: a qube is shut down only after all
+qubes using it (as netvm, guivm, device backend or template) are halted.
+'''
+
+import asyncio
+
+import qubes.exc
+import qubes.vm.adminvm
+
+qmemman_present = False
+try:
+    import qubes.qmemman.client  # pylint: disable=wrong-import-position
+
+    qmemman_present = True
+except ImportError:
+    pass
+
+#: default limit of qubes started at the same time
+DEFAULT_START_CONCURRENCY = 4
+
+#: upper limit of autostart qubes started at the same time
+AUTOSTART_MAX_CONCURRENCY = 8
+
+
+def get_start_dependencies(vm):
+    '''Return set of qubes which need to be running before *vm* starts
+
+    Those are: netvm, guivm and backends of persistent devices. Dom0 is
+    never included.
+    '''
+    dependencies = set()
+    for prop in ('netvm', 'guivm'):
+        dependency = getattr(vm, prop, None)
+        if dependency is not None:
+            dependencies.add(dependency)
+    for devclass in vm.devices:
+        for device in vm.devices[devclass].persistent():
+            dependencies.add(device.backend_domain)
+    return set(dependency for dependency in dependencies
+        if dependency is not vm
+        and not isinstance(dependency, qubes.vm.adminvm.AdminVM))
+
+
+def get_shutdown_dependencies(vm):
+    '''Return set of qubes which *vm* uses while running, and so can be
+    shut down only after *vm*
+
+    Those are start dependencies (see :py:func:`get_start_dependencies`) and
+    the template.
+    '''
+    dependencies = get_start_dependencies(vm)
+    template = getattr(vm, 'template', None)
+    if template is not None:
+        dependencies.add(template)
+    return dependencies
+
+
+def get_dependency_graph(vms, get_dependencies=get_start_dependencies):
+    '''Build dependency graph of *vms*, including their (transitive)
+    dependencies
+
+    :return: dict mapping each qube to the set of qubes it depends on
+    '''
+    graph = {}
+    queue = [vm for vm in vms
+        if not isinstance(vm, qubes.vm.adminvm.AdminVM)]
+    while queue:
+        vm = queue.pop()
+        if vm in graph:
+            continue
+        graph[vm] = get_dependencies(vm)
+        queue.extend(graph[vm])
+    return graph
+
+
+def get_available_memory(app):
+    '''Estimate memory (in MiB) available for starting new qubes
+
+    This is the total host memory, minus current dom0 memory and initial
+    memory of already running qubes. Qmemman can take back memory above
+    that from running qubes.
+
+    :return: memory in MiB, or :py:obj:`None` if unknown (offline mode)
+    '''
+    if app.vmm.offline_mode:
+        return None
+    available = app.host.memory_total // 1024
+    for vm in app.domains:
+        if isinstance(vm, qubes.vm.adminvm.AdminVM):
+            available -= vm.get_mem() // 1024
+        elif vm.is_running():
+            available -= vm.memory
+    return max(available, 0)
+
+
+def get_qmemman_free_memory(app):
+    '''Get memory (in MiB) qmemman can give to new qubes right now
+
+    This is free Xen memory above qmemman's reserve and not reserved for
+    qubes being started, plus memory running qubes have above their
+    preferred size (see :py:func:`qubes.qmemman.algo.prefmem`).
+
+    :return: memory in MiB, or :py:obj:`None` if qmemman is not available
+    '''
+    if app.vmm.offline_mode or not qmemman_present:
+        return None
+    try:
+        # blocking, but with a short timeout (socket.timeout is an OSError)
+        status = qubes.qmemman.client.QMemmanClient().get_status()
+    except (OSError, ValueError) as e:
+        app.log.warning('Failed to get qmemman status: %s', str(e))
+        return None
+    free = status['xen_free_memory'] - status['reserve'] - \
+        status['reserved_memory']
+    for domain in status['domains'].values():
+        if domain.get('prefmem') is not None:
+            free += max(0, domain['memory_actual'] - domain['prefmem'])
+    return max(int(free) // 1024 ** 2, 0)
+
+
+class BulkStart:
+    '''Start multiple qubes, in dependency order
+
+    Qubes are started as soon as all their dependencies are running, but
+    no more than *max_concurrency* at a time, and only while the sum of
+    initial memory of qubes being started fits in *memory_budget* (MiB).
+    At least one qube is always admitted, regardless of its memory.
+
+    If a qube fails to start, qubes depending on it are not started at all.
+
+    :param qubes.Qubes app: the app
+    :param iterable vms: qubes to start; their dependencies are started too
+    :param int max_concurrency: how many qubes to start at the same time
+    :param int memory_budget: memory (MiB) for qubes being started at the \
+        same time; :py:obj:`None` means no limit
+    '''
+
+    def __init__(self, app, vms, max_concurrency=None, memory_budget=None):
+        self.app = app
+        if max_concurrency is None:
+            max_concurrency = DEFAULT_START_CONCURRENCY
+        self.max_concurrency = max_concurrency
+        self.memory_budget = memory_budget
+        #: qube -> set of qubes it depends on
+        self.graph = get_dependency_graph(vms)
+        #: qube -> exception, or :py:obj:`None` on success
+        self.results = {}
+        #: task -> qube being started
+        self._running = {}
+        #: qube being started -> memory (MiB) reserved for it
+        self._reserved = {}
+
+    def get_priority(self, vm):
+        '''Sort key for qubes ready to start: those with the most dependents
+        go first'''
+        dependents = sum(1 for dependencies in self.graph.values()
+            if vm in dependencies)
+        return (-dependents, vm.name)
+
+    @staticmethod
+    def get_memory(vm):
+        '''Memory (MiB) needed to start *vm*'''
+        if vm.is_running():
+            return 0
+        return vm.memory
+
+    def _fail_unstartable(self):
+        '''Mark as failed qubes with failed dependencies'''
+        changed = True
+        while changed:
+            changed = False
+            for vm, dependencies in self.graph.items():
+                if vm in self.results:
+                    continue
+                failed = [dependency for dependency in dependencies
+                    if self.results.get(dependency, None) is not None]
+                if failed:
+                    self.results[vm] = qubes.exc.QubesVMError(vm,
+                        'Dependency {} failed to start'.format(
+                            failed[0].name))
+                    changed = True
+
+    def get_ready(self):
+        '''Return qubes which can be started now, in priority order'''
+        return sorted((vm for vm, dependencies in self.graph.items()
+            if vm not in self.results and vm not in self._reserved
+            and all(dependency in self.results
+                for dependency in dependencies)),
+            key=self.get_priority)
+
+    def _admit(self):
+        memory_in_use = sum(self._reserved.values())
+        for vm in self.get_ready():
+            if len(self._running) >= self.max_concurrency:
+                break
+            memory = self.get_memory(vm)
+            if self._running and self.memory_budget is not None and \
+                    memory_in_use + memory > self.memory_budget:
+                break
+            memory_in_use += memory
+            self._reserved[vm] = memory
+            self._running[asyncio.ensure_future(self.start_vm(vm))] = vm
+
+    @asyncio.coroutine
+    def start_vm(self, vm):
+        '''Start a single qube'''
+        self.app.log.debug('Starting %s', vm.name)
+        return (yield from vm.start())
+
+    @asyncio.coroutine
+    def execute(self):
+        '''Start the qubes
+
+        :return: dict mapping each qube to :py:obj:`None` (success) or \
+            exception
+        '''
+        try:
+            while True:
+                self._fail_unstartable()
+                self._admit()
+                if not self._running:
+                    break
+                done, _ = yield from asyncio.wait(self._running,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    vm = self._running.pop(task)
+                    del self._reserved[vm]
+                    try:
+                        task.result()
+                    except Exception as e:  # pylint: disable=broad-except
+                        vm.log.error('Start failed: %s', str(e))
+                        self.results[vm] = e
+                    else:
+                        self.results[vm] = None
+        except asyncio.CancelledError:
+            for task in self._running:
+                task.cancel()
+            raise
+
+        # anything left must be part of a dependency cycle
+        for vm in self.graph:
+            if vm not in self.results:
+                self.results[vm] = qubes.exc.QubesVMError(vm,
+                    'Circular dependency between qubes')
+        return self.results
+
+
+@asyncio.coroutine
+def start_domains(app, vms, max_concurrency=None, memory_budget=None):
+    '''Start *vms* and their dependencies, see :py:class:`BulkStart`
+
+    If *memory_budget* is not given, it is estimated with
+    :py:func:`get_available_memory`.
+
+    :return: dict mapping each qube to :py:obj:`None` (success) or exception
+    '''
+    if memory_budget is None:
+        memory_budget = get_available_memory(app)
+    bulk_start = BulkStart(app, vms, max_concurrency=max_concurrency,
+        memory_budget=memory_budget)
+    return (yield from bulk_start.execute())
+
+
+def get_autostart_vms(app):
+    '''Return qubes with :py:attr:`qubes.vm.qubesvm.QubesVM.autostart` set,
+    sorted by name'''
+    return sorted(vm for vm in app.domains
+        if not isinstance(vm, qubes.vm.adminvm.AdminVM)
+        and getattr(vm, 'autostart', False))
+
+
+class AutostartScheduler(BulkStart):
+    '''Start qubes with *autostart* property set, when qubesd starts
+
+    This is :py:class:`BulkStart`, with those differences:
+
+    - among qubes ready to start, those providing network go first;
+    - the number of qubes started at the same time is the number of
+      (average) qubes which fit in *memory_budget* (but at least 1 and at
+      most :py:data:`AUTOSTART_MAX_CONCURRENCY`);
+    - the default *memory_budget* is what qmemman can actually give (see
+      :py:func:`get_qmemman_free_memory`);
+    - order and timing of starts are recorded in :py:attr:`report`.
+
+    Starting a qube still pending in the scheduler in some other way should
+    first :py:meth:`wait_for` it, to not disturb the order.
+
+    :param qubes.Qubes app: the app
+    :param iterable vms: qubes to start, default: :py:func:`get_autostart_vms`
+    :param int memory_budget: memory (MiB) for qubes being started at the \
+        same time, default: :py:func:`get_qmemman_free_memory`, or \
+        :py:func:`get_available_memory` if qmemman is not available
+    '''
+
+    def __init__(self, app, vms=None, memory_budget=None):
+        if vms is None:
+            vms = get_autostart_vms(app)
+        if memory_budget is None:
+            memory_budget = get_qmemman_free_memory(app)
+        if memory_budget is None:
+            memory_budget = get_available_memory(app)
+        super().__init__(app, vms, memory_budget=memory_budget)
+        self.max_concurrency = self.get_concurrency(self.graph,
+            memory_budget)
+        #: started qubes, in start order: ``[vm, start, end, error]``;
+        #: *start* and *end* are in seconds since :py:attr:`started`
+        self.report = []
+        #: event loop time when the scheduler started, or :py:obj:`None`
+        self.started = None
+        #: event loop time when all qubes were handled, or :py:obj:`None`
+        self.finished = None
+        loop = asyncio.get_event_loop()
+        self._futures = {vm: loop.create_future() for vm in self.graph}
+
+    @staticmethod
+    def get_concurrency(vms, memory_budget):
+        '''How many of *vms* start at the same time, given
+        *memory_budget* (MiB)'''
+        memory = [vm.memory for vm in vms if not vm.is_running()]
+        if memory_budget is None or not memory or not sum(memory):
+            return AUTOSTART_MAX_CONCURRENCY
+        average = sum(memory) / len(memory)
+        return max(1, min(AUTOSTART_MAX_CONCURRENCY,
+            int(memory_budget // average)))
+
+    def get_priority(self, vm):
+        return (not getattr(vm, 'provides_network', False),) + \
+            super().get_priority(vm)
+
+    def is_pending(self, vm):
+        '''Check if the scheduler has yet to handle *vm*'''
+        return vm in self._futures and not self._futures[vm].done()
+
+    @asyncio.coroutine
+    def wait_for(self, vm):
+        '''Wait until the scheduler handles *vm* (successfully or not)'''
+        if vm in self._futures:
+            yield from asyncio.shield(self._futures[vm])
+
+    def _set_handled(self, vm):
+        if not self._futures[vm].done():
+            self._futures[vm].set_result(None)
+
+    @asyncio.coroutine
+    def start_vm(self, vm):
+        loop = asyncio.get_event_loop()
+        entry = [vm, loop.time() - self.started, None, None]
+        self.report.append(entry)
+        try:
+            return (yield from super().start_vm(vm))
+        except Exception as e:
+            entry[3] = e
+            raise
+        finally:
+            entry[2] = loop.time() - self.started
+            self._set_handled(vm)
+
+    @asyncio.coroutine
+    def execute(self):
+        loop = asyncio.get_event_loop()
+        self.started = loop.time()
+        self.app.log.info('Autostart of %d qubes, %d at a time',
+            len(self.graph), self.max_concurrency)
+        try:
+            return (yield from super().execute())
+        finally:
+            self.finished = loop.time()
+            for vm in self.graph:
+                self._set_handled(vm)
+            self.app.log.info('Autostart finished in %.1f s: %s',
+                self.finished - self.started,
+                ', '.join('{} {:.1f}-{:.1f}{}'.format(vm.name, start, end,
+                    ' failed' if error is not None else '')
+                    for vm, start, end, error in self.report))
+
+    def format_report(self):
+        '''Describe the progress as text
+
+        The first line is ``status=(running|finished) elapsed=SECONDS``. It
+        is followed by a line for each qube (in start order):
+        ``NAME start=SECONDS end=SECONDS result=(ok|failed|starting)``;
+        qubes not started due to failed dependencies have only ``result``.
+        '''
+        if self.started is None:
+            return 'status=pending elapsed=0.000\n'
+        end = self.finished
+        if end is None:
+            end = asyncio.get_event_loop().time()
+        lines = ['status={} elapsed={:.3f}'.format(
+            'running' if self.finished is None else 'finished',
+            end - self.started)]
+        started = set()
+        for vm, start, end, error in self.report:
+            started.add(vm)
+            if end is None:
+                lines.append('{} start={:.3f} result=starting'.format(
+                    vm.name, start))
+            else:
+                lines.append('{} start={:.3f} end={:.3f} result={}'.format(
+                    vm.name, start, end, 'ok' if error is None else 'failed'))
+        for vm in sorted(self.results):
+            if vm not in started and self.results[vm] is not None:
+                lines.append('{} result=failed'.format(vm.name))
+        return ''.join(line + '\n' for line in lines)
+
+
+class BulkShutdown:
+    '''Shut down multiple qubes, in reverse dependency order
+
+    Qubes are shut down in waves: the first wave contains qubes not used by
+    any other qube from *vms*, the next one qubes used only by those from
+    the first wave, and so on. Qubes in a single wave are shut down in
+    parallel, and the next wave is started when the previous one is
+    completed.
+
+    Each qube gets *timeout* seconds (default:
+    :py:attr:`qubes.vm.qubesvm.QubesVM.shutdown_timeout`) to shut down. If
+    *kill* is set, qubes which did not make it are killed, otherwise
+    that is reported as a failure. Qubes used by a qube that failed to shut
+    down are not touched.
+
+    Progress is reported with ``domain-bulk-shutdown`` event, fired on each
+    qube.
+
+    .. event:: domain-bulk-shutdown (subject, event, wave, status)
+
+        Fired when shutdown of a qube progresses.
+
+        :param subject: Event emitter (the qube object)
+        :param event: Event name (``'domain-bulk-shutdown'``)
+        :param wave: Number of the wave (starting from 0)
+        :param status: ``'shutdown'`` (shutdown requested), ``'kill'`` \
+            (shutdown timed out, killing), ``'halted'`` or ``'failed'``
+        :param reason: Error message (only for *status* ``'failed'``)
+
+    :param qubes.Qubes app: the app
+    :param iterable vms: qubes to shut down
+    :param int timeout: per-qube shutdown timeout, in seconds
+    :param bool kill: kill qubes which did not shut down in time
+    '''
+
+    def __init__(self, app, vms, timeout=None, kill=False):
+        self.app = app
+        self.timeout = timeout
+        self.kill = kill
+        vms = set(vm for vm in vms
+            if not isinstance(vm, qubes.vm.adminvm.AdminVM))
+        #: qube -> set of qubes (from *vms*) which must be halted first
+        self.graph = {vm: set() for vm in vms}
+        for vm in vms:
+            for dependency in get_shutdown_dependencies(vm):
+                if dependency in self.graph:
+                    self.graph[dependency].add(vm)
+        #: qube -> exception, or :py:obj:`None` on success
+        self.results = {}
+
+    def get_waves(self):
+        '''Split qubes into waves
+
+        :return: list of waves (each being a list of qubes sorted by name),
+            and set of qubes left out due to a dependency cycle
+        '''
+        waves = []
+        done = set()
+        while True:
+            wave = sorted(vm for vm, dependents in self.graph.items()
+                if vm not in done and dependents <= done)
+            if not wave:
+                break
+            waves.append(wave)
+            done.update(wave)
+        return waves, set(self.graph) - done
+
+    @staticmethod
+    def _fire_progress(vm, wave, status, **kwargs):
+        vm.fire_event('domain-bulk-shutdown', wave=wave, status=status,
+            **kwargs)
+
+    @asyncio.coroutine
+    def _shutdown(self, vm, wave):
+        self._fire_progress(vm, wave, 'shutdown')
+        try:
+            yield from vm.shutdown(wait=True, timeout=self.timeout)
+        except qubes.exc.QubesVMNotStartedError:
+            pass
+        except qubes.exc.QubesVMShutdownTimeoutError:
+            if not self.kill:
+                raise
+            vm.log.warning('Shutdown timed out, killing')
+            self._fire_progress(vm, wave, 'kill')
+            try:
+                yield from vm.kill()
+            except qubes.exc.QubesVMNotStartedError:
+                # halted in the meantime
+                pass
+        self._fire_progress(vm, wave, 'halted')
+
+    @asyncio.coroutine
+    def execute(self):
+        '''Shut down the qubes
+
+        :return: dict mapping each qube to :py:obj:`None` (success) or \
+            exception
+        '''
+        waves, cycle = self.get_waves()
+        for vm in cycle:
+            self.results[vm] = qubes.exc.QubesVMError(vm,
+                'Circular dependency between qubes')
+
+        for wave_no, wave in enumerate(waves):
+            tasks = {}
+            for vm in wave:
+                failed = sorted(dependent for dependent in self.graph[vm]
+                    if self.results[dependent] is not None)
+                if failed:
+                    self.results[vm] = qubes.exc.QubesVMError(vm,
+                        'Dependent qube {} failed to shut down'.format(
+                            failed[0].name))
+                    self._fire_progress(vm, wave_no, 'failed',
+                        reason=str(self.results[vm]))
+                    continue
+                tasks[asyncio.ensure_future(self._shutdown(vm, wave_no))] = vm
+            if not tasks:
+                continue
+            try:
+                yield from asyncio.wait(tasks)
+            except asyncio.CancelledError:
+                for task in tasks:
+                    task.cancel()
+                raise
+            for task, vm in tasks.items():
+                try:
+                    task.result()
+                except Exception as e:  # pylint: disable=broad-except
+                    vm.log.error('Shutdown failed: %s', str(e))
+                    self.results[vm] = e
+                    self._fire_progress(vm, wave_no, 'failed', reason=str(e))
+                else:
+                    self.results[vm] = None
+        return self.results
+
+
+@asyncio.coroutine
+def shutdown_domains(app, vms, timeout=None, kill=False):
+    '''Shut down *vms*, see :py:class:`BulkShutdown`
+
+    :return: dict mapping each qube to :py:obj:`None` (success) or exception
+    '''
+    bulk_shutdown = BulkShutdown(app, vms, timeout=timeout, kill=kill)
+    return (yield from bulk_shutdown.execute())
@@ -94,6 +94,15 @@ defaults = {
     # before killing them (when used qvm-run with --wait option),
     'shutdown_counter_max': 60,
 
+    # how long (in sec) to wait for VMs to handle host suspend/resume,
+    # and how many of them to handle at once; can be overridden with
+    # 'suspend-timeout' and 'suspend-max-concurrency' features of dom0
+    'suspend_timeout': 60,
+    'suspend_max_concurrency': 8,
+
+    # how many last start/shutdown timings to keep for each VM
+    'operation_timings_count': 10,
+
     'vm_default_netmask': "255.255.255.0",
 
     'appvm_label': 'red',
@@ -137,21 +137,18 @@ class Emitter(metaclass=EmitterMeta):
         # pylint: disable=no-member
         self.__handlers__[event].remove(func)
 
-    def _fire_event(self, event, kwargs, pre_event=False):
-        '''Fire event for classes in given order.
+    def get_handlers(self, event, pre_event=False):
+        '''Iterate over handlers for an event, in the order they would be
+        called by :py:meth:`fire_event`.
 
-        Do not use this method. Use :py:meth:`fire_event`.
+        :param str event: event identifier
+        :param pre_event: is this -pre- event? reverse handlers calling order
         '''
 
-        if not self.events_enabled:
-            return [], []
-
         order = itertools.chain((self,), self.__class__.__mro__)
         if not pre_event:
             order = reversed(list(order))
 
-        effects = []
-        async_effects = []
         for i in order:
             try:
                 handlers_dict = i.__handlers__
@@ -160,14 +157,27 @@ class Emitter(metaclass=EmitterMeta):
             handlers = [h_func for h_name, h_func_set in handlers_dict.items()
                         for h_func in h_func_set
                         if fnmatch.fnmatch(event, h_name)]
-            for func in sorted(handlers,
-                    key=(lambda handler: hasattr(handler, 'ha_bound')),
-                    reverse=True):
-                effect = func(self, event, **kwargs)
-                if asyncio.iscoroutinefunction(func):
-                    async_effects.append(effect)
-                elif effect is not None:
-                    effects.extend(effect)
+            yield from sorted(handlers,
+                key=(lambda handler: hasattr(handler, 'ha_bound')),
+                reverse=True)
+
+    def _fire_event(self, event, kwargs, pre_event=False):
+        '''Fire event for classes in given order.
+
+        Do not use this method. Use :py:meth:`fire_event`.
+        '''
+
+        if not self.events_enabled:
+            return [], []
+
+        effects = []
+        async_effects = []
+        for func in self.get_handlers(event, pre_event=pre_event):
+            effect = func(self, event, **kwargs)
+            if asyncio.iscoroutinefunction(func):
+                async_effects.append(effect)
+            elif effect is not None:
+                effects.extend(effect)
         return effects, async_effects
 
     def fire_event(self, event, pre_event=False, **kwargs):
@@ -73,11 +73,19 @@ def handler(*events, **kwargs):
     :param type vm: VM to hook (leave as None to hook all VMs)
     :param bool system: when :py:obj:`True`, hook is system-wide (not attached \
         to any VM)
+    :param iterable invalidated_by: for ``admin-permission:...`` handlers: \
+        events (possibly with wildcards) after which the handler may decide \
+        differently for the same source, destination and argument; \
+        specifying it (even as empty tuple) allows \
+        :py:class:`qubes.api.PermissionCache` to cache the decision
     '''
 
     def decorator(func):
         func.ha_events = events
 
+        if 'invalidated_by' in kwargs:
+            func.ha_invalidated_by = tuple(kwargs['invalidated_by'])
+
         if kwargs.get('system', False):
             func.ha_vm = None
         elif 'vm' in kwargs:
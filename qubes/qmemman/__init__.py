@@ -21,13 +21,19 @@
 #
 
 import logging
+import math
 import os
 import string
 import time
 
+import bisect
 import functools
-import xen.lowlevel.xc
-import xen.lowlevel.xs
+try:
+    import xen.lowlevel.xc
+    import xen.lowlevel.xs
+except ImportError:
+    # allow using qubes.qmemman.algo without Xen (for example in tests)
+    pass
 
 import qubes.qmemman.algo
 
@@ -35,12 +41,66 @@ import qubes.qmemman.algo
 no_progress_msg="VM refused to give back requested memory"
 slow_memset_react_msg="VM didn't give back all requested memory"
 
+# This are only defaults - can be overridden by qmemmand with values from
+# config file
+# minimum time between two balance passes triggered by meminfo updates
+BALANCE_INTERVAL = 1.0
+# balance immediately when domain's preferred memory exceeds its current
+# allocation by more than this
+BALANCE_PRESSURE_THRESHOLD = 100 * 1024 * 1024
+# maximum Xen free memory kept for predicted memory requests; 0 disables the
+# reserve
+RESERVE_MAX = 0
+# time constant (in seconds) of the recent memory requests count, used to
+# size the free memory reserve (see ReservePolicy)
+RESERVE_WINDOW = 600.0
+# weight of the newest request in the average request size
+RESERVE_SIZE_WEIGHT = 0.3
+
+# upper bounds (in seconds) of latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120)
+
+def run_blocking(steps):
+    '''Run a step generator (like :py:meth:`SystemState.do_balloon_iter`),
+    sleeping for the time each step yields; return its result'''
+    try:
+        while True:
+            time.sleep(next(steps))
+    except StopIteration as e:
+        return e.value
+
+
+class LatencyHistogram(object):
+    '''Count durations (in seconds) in buckets with given upper *bounds*;
+    the last bucket is unbounded'''
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            # le=None is the unbounded bucket
+            'buckets': [{'le': le, 'count': count} for le, count in
+                zip(self.bounds + (None,), self.counts)],
+        }
+
+
 class DomainState:
     def __init__(self, id):
         self.memory_current = 0     # the current memory size
         self.memory_actual = None   # the current memory allocation (what VM
                                     # is using or can use at any time)
-        self.memory_maximum = None  # the maximum memory size
+        self.memory_maximum = None  # the maximum memory size (cached
+                                    # static-max)
         self.mem_used = None		# used memory, computed based on meminfo
         self.id = id			    # domain id
         self.last_target = 0		# the last memset target
@@ -57,12 +117,20 @@ class SystemState(object):
         self.log.debug('SystemState()')
 
         self.domdict = {}
+        #: optional :py:class:`ReservePolicy`, keeping some Xen free memory
+        #: for predicted requests
+        self.reserve_policy = None
+        #: memory granted to clients, but possibly not yet allocated by
+        #: their domains (key identifies the request)
+        self.reservations = {}
         self.xc = None
         self.xs = None
 
-    def init(self):
-        self.xc = xen.lowlevel.xc.xc()
-        self.xs = xen.lowlevel.xs.xs()
+    # xc and xs can be given to use something else than real Xen (for
+    # example a simulator)
+    def init(self, xc=None, xs=None):
+        self.xc = xc or xen.lowlevel.xc.xc()
+        self.xs = xs or xen.lowlevel.xs.xs()
         self.BALOON_DELAY = 0.1
         self.XEN_FREE_MEM_LEFT = 50*1024*1024
         self.XEN_FREE_MEM_MIN = 25*1024*1024
@@ -84,6 +152,7 @@ class SystemState(object):
         target_str = self.xs.read('', '/local/domain/' + id + '/memory/target')
         if target_str:
             self.domdict[id].last_target = int(target_str) * 1024
+        self.refresh_static_max(id)
 
     def del_domain(self, id):
         self.log.debug('del_domain(id={!r})'.format(id))
@@ -113,7 +182,41 @@ class SystemState(object):
             self.log.error("Xen free = {!r} too small for satisfy assignments! "
                            "assigned_but_unused={!r}, domdict={!r}".format(
                 xen_free, assigned_but_unused, self.domdict))
-        return xen_free - assigned_but_unused
+        # memory promised to domains being started is not free either
+        return xen_free - assigned_but_unused - self.get_reserved_memory()
+
+    def get_reserved_memory(self):
+        return sum(self.reservations.values())
+
+    def add_reservation(self, key, memsize):
+        self.log.debug('add_reservation({!r}, {})'.format(key, memsize))
+        self.reservations[key] = memsize
+
+    def remove_reservation(self, key):
+        '''Remove reservation, return True if there was one'''
+        self.log.debug('remove_reservation({!r})'.format(key))
+        return self.reservations.pop(key, None) is not None
+
+    # static-max practically never changes after domain creation, so it is
+    # read only when domain is added and then when its xenstore watch fires
+    def refresh_static_max(self, id):
+        self.log.debug('refresh_static_max(id={!r})'.format(id))
+        if id not in self.domdict:
+            return
+        static_max = self.xs.read(
+            '', '/local/domain/{}/memory/static-max'.format(id))
+        if static_max:
+            self.domdict[id].memory_maximum = int(static_max)*1024
+        else:
+            self.domdict[id].memory_maximum = self.ALL_PHYS_MEM
+            # the previous line used to be
+            #   self.domdict[id].memory_maximum = domain[
+            #       'maxmem_kb']*1024
+            # but domain['maxmem_kb'] changes in self.mem_set as well,
+            # and this results in the memory never increasing
+            # in fact, the only possible case of nonexisting
+            # memory/static-max is dom0
+            # see #307
 
     # refresh information on memory assigned to all domains
     def refresh_memactual(self):
@@ -127,19 +230,6 @@ class SystemState(object):
                     self.domdict[id].memory_current,
                     self.domdict[id].last_target
                 )
-                self.domdict[id].memory_maximum = self.xs.read('', '/local/domain/%s/memory/static-max' % str(id))
-                if self.domdict[id].memory_maximum:
-                    self.domdict[id].memory_maximum = int(self.domdict[id].memory_maximum)*1024
-                else:
-                    self.domdict[id].memory_maximum = self.ALL_PHYS_MEM
-                    # the previous line used to be
-                    #   self.domdict[id].memory_maximum = domain[
-                    #       'maxmem_kb']*1024
-                    # but domain['maxmem_kb'] changes in self.mem_set as well,
-                    # and this results in the memory never increasing
-                    # in fact, the only possible case of nonexisting
-                    # memory/static-max is dom0
-                    # see #307
 
     def clear_outdated_error_markers(self):
         # Clear outdated errors
@@ -189,7 +279,15 @@ class SystemState(object):
     # perform memory ballooning, across all domains, to add "memsize" to Xen
     #  free memory
     def do_balloon(self, memsize):
+        return run_blocking(self.do_balloon_iter(memsize))
+
+    # the same as do_balloon, but instead of sleeping between iterations,
+    # yield the time to wait, so the caller can do something else meanwhile;
+    # domdict may change during that time
+    def do_balloon_iter(self, memsize):
         self.log.info('do_balloon(memsize={!r})'.format(memsize))
+        if self.reserve_policy is not None:
+            self.reserve_policy.record_request(memsize)
         CHECK_PERIOD_S = 3
         CHECK_MB_S = 100
 
@@ -224,12 +322,14 @@ class SystemState(object):
             xenfree_ring[ring_slot] = xenfree
             if prev_memory_actual is not None:
                 for i in prev_memory_actual.keys():
+                    if i not in self.domdict:
+                        continue
                     if prev_memory_actual[i] == self.domdict[i].memory_actual:
                         # domain not responding to memset requests, remove it
                         #  from donors
                         self.domdict[i].no_progress = True
                         self.log.info('domain {} stuck at {}'.format(i, self.domdict[i].memory_actual))
-            memset_reqs = qubes.qmemman.algo.balloon(memsize + self.XEN_FREE_MEM_LEFT - xenfree, self.domdict)
+            memset_reqs = qubes.qmemman.algo.balloon_fast(memsize + self.XEN_FREE_MEM_LEFT - xenfree, self.domdict)
             self.log.info('memset_reqs={!r}'.format(memset_reqs))
             if len(memset_reqs) == 0:
                 return False
@@ -239,7 +339,7 @@ class SystemState(object):
                 self.mem_set(dom, mem)
                 prev_memory_actual[dom] = self.domdict[dom].memory_actual
             self.log.debug('sleeping for {} s'.format(self.BALOON_DELAY))
-            time.sleep(self.BALOON_DELAY)
+            yield self.BALOON_DELAY
             niter = niter + 1
 
     def refresh_meminfo(self, domid, untrusted_meminfo_key):
@@ -285,6 +385,46 @@ class SystemState(object):
         return ret
 
 
+    # memory to keep free for predicted requests; only what is left after
+    # giving all domains their preferred memory - under memory pressure the
+    # reserve is given back to domains
+    def get_reserve(self, xenfree):
+        if self.reserve_policy is None:
+            return 0
+        reserve = self.reserve_policy.get_reserve()
+        if reserve <= 0:
+            return 0
+        table = qubes.qmemman.algo.DomainTable(self.domdict)
+        surplus = xenfree - self.XEN_FREE_MEM_LEFT - sum(table.need)
+        reserve = max(0, min(reserve, surplus))
+        self.log.debug('get_reserve(xenfree={}) = {}'.format(xenfree, reserve))
+        return reserve
+
+    def get_status(self):
+        '''Return snapshot of the state (domains with derived values), as
+        JSON-serializable dict'''
+        domains = {}
+        for i, dom in self.domdict.items():
+            domains[i] = {
+                'memory_current': dom.memory_current,
+                'memory_actual': dom.memory_actual,
+                'memory_maximum': dom.memory_maximum,
+                'mem_used': dom.mem_used,
+                'last_target': dom.last_target,
+                'no_progress': dom.no_progress,
+                'slow_memset_react': dom.slow_memset_react,
+            }
+            if dom.mem_used is not None:
+                domains[i]['prefmem'] = qubes.qmemman.algo.prefmem(dom)
+        xenfree = self.get_free_xen_memory()
+        return {
+            'xen_free_memory': xenfree,
+            'reserve': self.get_reserve(xenfree),
+            'reserved_memory': self.get_reserved_memory(),
+            'reservations': len(self.reservations),
+            'domains': domains,
+        }
+
     def print_stats(self, xenfree, memset_reqs):
         for i in self.domdict.keys():
             if self.domdict[i].mem_used is not None:
@@ -301,6 +441,11 @@ class SystemState(object):
 
 
     def do_balance(self):
+        run_blocking(self.do_balance_iter())
+
+    # the same as do_balance, but yields the time to wait instead of
+    # sleeping; domdict may change during that time
+    def do_balance_iter(self):
         self.log.debug('do_balance()')
         if os.path.isfile('/var/run/qubes/do-not-membalance'):
             self.log.debug('do-not-membalance file preset, returning')
@@ -309,7 +454,9 @@ class SystemState(object):
         self.refresh_memactual()
         self.clear_outdated_error_markers()
         xenfree = self.get_free_xen_memory()
-        memset_reqs = qubes.qmemman.algo.balance(xenfree - self.XEN_FREE_MEM_LEFT, self.domdict)
+        # keep the reserve aside, as if it was already used
+        xenfree -= self.get_reserve(xenfree)
+        memset_reqs = qubes.qmemman.algo.balance_fast(xenfree - self.XEN_FREE_MEM_LEFT, self.domdict)
         if not self.is_balance_req_significant(memset_reqs, xenfree):
             return
 
@@ -320,6 +467,9 @@ class SystemState(object):
             prev_memactual[i] = self.domdict[i].memory_actual
         for rq in memset_reqs:
             dom, mem = rq
+            if dom not in self.domdict:
+                # domain gone while waiting
+                continue
             # Force to always have at least 0.9*self.XEN_FREE_MEM_LEFT (some
             # margin for rounding errors). Before giving memory to
             # domain, ensure that others have gave it back.
@@ -328,7 +478,9 @@ class SystemState(object):
             while self.get_free_xen_memory() - (mem - self.domdict[dom].memory_actual) < 0.9*self.XEN_FREE_MEM_LEFT:
                 self.log.debug('do_balance dom={!r} sleeping ntries={}'.format(
                     dom, ntries))
-                time.sleep(self.BALOON_DELAY)
+                yield self.BALOON_DELAY
+                if dom not in self.domdict:
+                    break
                 self.refresh_memactual()
                 ntries -= 1
                 if ntries <= 0:
@@ -339,6 +491,8 @@ class SystemState(object):
                         if dom2 == dom:
                             # All donors have been processed
                             break
+                        if dom2 not in self.domdict:
+                            continue
                         # allow some small margin
                         if self.domdict[dom2].memory_actual > self.domdict[dom2].last_target + self.XEN_FREE_MEM_LEFT/4:
                             # VM didn't react to memory request at all,
@@ -360,10 +514,179 @@ class SystemState(object):
                                 self.domdict[dom2].slow_memset_react = True
                     self.mem_set(dom, self.get_free_xen_memory() + self.domdict[dom].memory_actual - self.XEN_FREE_MEM_LEFT)
                     return
-
-            self.mem_set(dom, mem)
+            else:
+                self.mem_set(dom, mem)
 
 #        for i in self.domdict.keys():
 #            print 'domain ', i, ' meminfo=', self.domdict[i].mem_used, 'actual mem', self.domdict[i].memory_actual
 #            print 'domain ', i, 'actual mem', self.domdict[i].memory_actual
 #        print 'xen free mem', self.get_free_xen_memory()
+
+
+class BalanceScheduler(object):
+    '''Coalesce meminfo updates into periodic balance passes.
+
+    Every meminfo update only refreshes the domain state and marks it dirty.
+    A single :py:meth:`SystemState.do_balance` is then run at most once per
+    *interval* seconds, or as soon as possible when some domain crosses the
+    pressure threshold (its preferred memory exceeds current allocation by
+    more than *pressure_threshold*). The caller is responsible for calling
+    :py:meth:`balance_if_due` no later than :py:meth:`get_timeout` seconds
+    from now.
+    '''
+    def __init__(self, system_state, interval=None, pressure_threshold=None,
+            clock=time.monotonic):
+        self.log = logging.getLogger('qmemman.balancescheduler')
+        self.system_state = system_state
+        self.clock = clock
+        if interval is None:
+            interval = BALANCE_INTERVAL
+        if pressure_threshold is None:
+            pressure_threshold = BALANCE_PRESSURE_THRESHOLD
+        self.interval = interval
+        self.pressure_threshold = pressure_threshold
+        #: domains with meminfo updated since the last balance pass
+        self.dirty = set()
+        #: domains which were under memory pressure at their last update
+        self.under_pressure = set()
+        #: run balance on the next opportunity, regardless of interval
+        self.immediate = False
+        self.last_balance = None
+        self.meminfo_updates = 0
+        self.balance_passes = 0
+        self.immediate_passes = 0
+        #: duration of balance passes (including waits for domains)
+        self.balance_latency = LatencyHistogram()
+
+    def is_under_pressure(self, dom):
+        if dom.mem_used is None:
+            return False
+        if dom.memory_maximum is None:
+            # never balanced yet
+            return True
+        current = max(dom.memory_actual or 0, dom.last_target)
+        return qubes.qmemman.algo.prefmem(dom) - current > \
+            self.pressure_threshold
+
+    def refresh_meminfo(self, domid, untrusted_meminfo_key):
+        self.log.debug(
+            'refresh_meminfo(domid={}, untrusted_meminfo_key={!r})'.format(
+                domid, untrusted_meminfo_key))
+        dom = self.system_state.domdict[domid]
+        qubes.qmemman.algo.refresh_meminfo_for_domain(
+            dom, untrusted_meminfo_key)
+        self.meminfo_updates += 1
+        self.dirty.add(domid)
+        if self.is_under_pressure(dom):
+            if domid not in self.under_pressure:
+                self.log.debug('dom {!r} crossed pressure threshold'.format(
+                    domid))
+                self.under_pressure.add(domid)
+                self.immediate = True
+        else:
+            self.under_pressure.discard(domid)
+
+    def request_balance(self):
+        '''Request balance pass as soon as possible (for example after
+        domain list change)'''
+        self.immediate = True
+
+    def get_timeout(self):
+        '''Return number of seconds until the next balance pass is due, or
+        :py:obj:`None` if there is nothing to do'''
+        if self.immediate or self.last_balance is None:
+            return 0 if (self.immediate or self.dirty) else None
+        if not self.dirty:
+            return None
+        remaining = self.last_balance + self.interval - self.clock()
+        # event loop timers fire up to clock resolution early; do not wait
+        # again for such a tiny remainder
+        if remaining < 0.001:
+            return 0
+        return remaining
+
+    def balance_if_due(self):
+        '''Run balance pass if one is due.
+
+        :return: True if balance was done
+        '''
+        return run_blocking(self.balance_if_due_iter())
+
+    def balance_if_due_iter(self):
+        '''Step generator version of :py:meth:`balance_if_due`'''
+        if self.get_timeout() != 0:
+            return False
+        if self.immediate:
+            self.immediate_passes += 1
+        self.immediate = False
+        self.dirty.clear()
+        self.under_pressure.intersection_update(self.system_state.domdict)
+        self.last_balance = self.clock()
+        self.balance_passes += 1
+        try:
+            yield from self.system_state.do_balance_iter()
+        finally:
+            self.balance_latency.add(self.clock() - self.last_balance)
+        return True
+
+    def get_stats(self):
+        return {
+            'meminfo_updates': self.meminfo_updates,
+            'balance_passes': self.balance_passes,
+            'immediate_passes': self.immediate_passes,
+            'saved_passes': max(0,
+                self.meminfo_updates - self.balance_passes),
+        }
+
+
+class ReservePolicy(object):
+    '''Predict how much memory upcoming requests will need.
+
+    Every memory request (see :py:meth:`SystemState.do_balloon_iter`) updates
+    an exponentially weighted average of the request size and an
+    exponentially decayed count of recent requests (with time constant
+    *window* seconds). The reserve is the memory needed to serve that many
+    average-sized requests again, capped at *max_reserve*. Without new
+    requests it decays towards 0, so idle system does not keep memory away
+    from domains.
+    '''
+    def __init__(self, max_reserve, window=None, size_weight=None,
+            clock=time.monotonic):
+        self.log = logging.getLogger('qmemman.reservepolicy')
+        self.clock = clock
+        if window is None:
+            window = RESERVE_WINDOW
+        if size_weight is None:
+            size_weight = RESERVE_SIZE_WEIGHT
+        self.max_reserve = max_reserve
+        self.window = window
+        self.size_weight = size_weight
+        #: average size of recent requests
+        self.avg_size = None
+        #: decayed number of recent requests, as of :py:attr:`last_request`
+        self.recent_requests = 0.0
+        self.last_request = None
+
+    def get_recent_requests(self):
+        '''Return decayed number of recent requests, as of now'''
+        if self.last_request is None:
+            return 0.0
+        age = max(0, self.clock() - self.last_request)
+        return self.recent_requests * math.exp(-age / self.window)
+
+    def record_request(self, memsize):
+        self.recent_requests = self.get_recent_requests() + 1
+        self.last_request = self.clock()
+        if self.avg_size is None:
+            self.avg_size = float(memsize)
+        else:
+            self.avg_size += self.size_weight * (memsize - self.avg_size)
+        self.log.debug('record_request(memsize={}): avg_size={:.0f} '
+            'recent_requests={:.2f}'.format(
+                memsize, self.avg_size, self.recent_requests))
+
+    def get_reserve(self):
+        if self.avg_size is None:
+            return 0
+        return int(min(self.max_reserve,
+            self.avg_size * self.get_recent_requests()))
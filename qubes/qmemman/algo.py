@@ -125,6 +125,13 @@ def memory_needed(domain):
     return ret
 
 
+# balloon() and balance() below, working on a dict of DomainState objects,
+# are not used by qmemman itself anymore - it uses balloon_fast() and
+# balance_fast() instead. They are kept unchanged as the reference
+# implementation: the test oracle of qubes.tests.qmemman and the baseline of
+# qubes.tests.perf.qmemman. Do not change them together with the *_fast()
+# variants.
+
 # prepare list of (domain, memory_target) pairs that need to be passed
 # to "xm memset" equivalent in order to obtain "memsize" of memory
 # return empty list when the request cannot be satisfied
@@ -318,3 +325,194 @@ def balance(xen_free_memory, domain_dictionary):
     else:
         return balance_when_low_on_memory(domain_dictionary, xen_free_memory,
             total_mem_pref_acceptors, donors, acceptors)
+
+
+# Below are the same algorithms as above, working on a DomainTable instead
+# of a dict of DomainState objects, used by qmemman. Domains excluded from
+# balancing are filtered out once, and prefmem() is computed once per
+# domain, instead of in every loop. They must return exactly the same
+# requests as the reference functions above (see qubes.tests.qmemman).
+
+class DomainTable(object):
+    '''Column-oriented snapshot of domains taking part in balancing
+
+    Domains without meminfo or marked as no_progress are skipped. Order of
+    domains is the same as in the source dictionary.
+    '''
+    def __init__(self, domain_dictionary):
+        self.ids = []
+        self.actual = []
+        self.maximum = []
+        self.pref = []
+        for dom_id, domain in domain_dictionary.items():
+            if domain.mem_used is None:
+                continue
+            if domain.no_progress:
+                continue
+            self.ids.append(dom_id)
+            self.actual.append(domain.memory_actual)
+            self.maximum.append(domain.memory_maximum)
+            self.pref.append(prefmem(domain))
+        # memory_needed() of each domain
+        self.need = [pref - actual
+            for pref, actual in zip(self.pref, self.actual)]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def balloon_fast(memsize, domain_dictionary):
+    '''The same as :py:func:`balloon`, using :py:class:`DomainTable`'''
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('balloon(memsize={!r}, domain_dictionary={!r})'.format(
+            memsize, domain_dictionary))
+    return balloon_table(memsize, DomainTable(domain_dictionary))
+
+
+def balloon_table(memsize, table):
+    REQ_SAFETY_NET_FACTOR = 1.05
+    donors = list()
+    request = list()
+    available = 0
+    for dom_id, actual, need in zip(table.ids, table.actual, table.need):
+        if need < 0:
+            log.info('balloon: dom {} has actual memory {}'.format(dom_id,
+                actual))
+            donors.append((dom_id, -need, actual))
+            available -= need
+
+    log.info('req={} avail={} donors={!r}'.format(memsize, available,
+        [(dom_id, mem) for dom_id, mem, _ in donors]))
+
+    if available < memsize:
+        return ()
+    scale = 1.0 * memsize / available
+    for dom_id, mem, actual in donors:
+        memborrowed = mem * scale * REQ_SAFETY_NET_FACTOR
+        log.info('borrow {} from {}'.format(memborrowed, dom_id))
+        memtarget = int(actual - memborrowed)
+        request.append((dom_id, memtarget))
+    return request
+
+
+def balance_when_enough_memory_table(table,
+        xen_free_memory, total_mem_pref, total_available_memory):
+    log.info('balance_when_enough_memory(xen_free_memory={!r}, '
+             'total_mem_pref={!r}, total_available_memory={!r})'.format(
+        xen_free_memory, total_mem_pref, total_available_memory))
+
+    target_memory = []
+    # memory not assigned because of static max
+    left_memory = 0
+    acceptors_count = 0
+    for pref, maximum in zip(table.pref, table.maximum):
+        # distribute total_available_memory proportionally to mempref
+        scale = 1.0 * pref / total_mem_pref
+        target_nonint = pref + scale * total_available_memory
+        # prevent rounding errors
+        target = int(0.999 * target_nonint)
+        # do not try to give more memory than static max
+        if target > maximum:
+            left_memory += target - maximum
+            target = maximum
+        else:
+            # count domains which can accept more memory
+            acceptors_count += 1
+        target_memory.append(target)
+    # distribute left memory across all acceptors
+    while left_memory > 0 and acceptors_count > 0:
+        log.info('left_memory={} acceptors_count={}'.format(
+            left_memory, acceptors_count))
+
+        memory_bonus = int(0.999 * (left_memory / acceptors_count))
+        new_left_memory = 0
+        new_acceptors_count = acceptors_count
+        for idx, maximum in enumerate(table.maximum):
+            target = target_memory[idx]
+            if target < maximum:
+                if target + memory_bonus >= maximum:
+                    new_left_memory += target + memory_bonus - maximum
+                    target_memory[idx] = maximum
+                    new_acceptors_count -= 1
+                else:
+                    target_memory[idx] = target + memory_bonus
+        left_memory = new_left_memory
+        acceptors_count = new_acceptors_count
+    # split target_memory to donors and acceptors
+    # this is needed to first get memory from donors and only then give it
+    # to acceptors
+    donors_rq = list()
+    acceptors_rq = list()
+    for dom_id, target, actual in zip(table.ids, target_memory, table.actual):
+        if target < actual:
+            donors_rq.append((dom_id, target))
+        else:
+            acceptors_rq.append((dom_id, target))
+
+    return donors_rq + acceptors_rq
+
+
+def balance_when_low_on_memory_table(table,
+        xen_free_memory, total_mem_pref_acceptors, donors, acceptors):
+    log.info('balance_when_low_on_memory(xen_free_memory={!r}, '
+        'total_mem_pref_acceptors={!r}, donors={!r}, acceptors={!r})'.format(
+         xen_free_memory, total_mem_pref_acceptors,
+         [table.ids[idx] for idx in donors],
+         [table.ids[idx] for idx in acceptors]))
+    donors_rq = list()
+    acceptors_rq = list()
+    squeezed_mem = xen_free_memory
+    for idx in donors:
+        avail = -table.need[idx]
+        if avail < 10 * 1024 * 1024:
+            # probably we have already tried making it exactly at prefmem,
+            # give up
+            continue
+        squeezed_mem -= avail
+        donors_rq.append((table.ids[idx], table.pref[idx]))
+    # the below can happen if initially xen free memory is below 50M
+    if squeezed_mem < 0:
+        return donors_rq
+    for idx in acceptors:
+        scale = 1.0 * table.pref[idx] / total_mem_pref_acceptors
+        target_nonint = table.actual[idx] + scale * squeezed_mem
+        # do not try to give more memory than static max
+        target = min(int(0.999 * target_nonint), table.maximum[idx])
+        acceptors_rq.append((table.ids[idx], target))
+    return donors_rq + acceptors_rq
+
+
+def balance_fast(xen_free_memory, domain_dictionary):
+    '''The same as :py:func:`balance`, using :py:class:`DomainTable`'''
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('balance(xen_free_memory={!r}, '
+            'domain_dictionary={!r})'.format(
+                xen_free_memory, domain_dictionary))
+    return balance_table(xen_free_memory, DomainTable(domain_dictionary))
+
+
+def balance_table(xen_free_memory, table):
+    # see balance() for description of those
+    total_memory_needed = 0
+    total_mem_pref = 0
+    total_mem_pref_acceptors = 0
+
+    donors = list()  # indexes of domains that can yield memory
+    acceptors = list()  # indexes of domains that require more memory
+    for idx, need in enumerate(table.need):
+        pref = table.pref[idx]
+        if need < 0 or table.actual[idx] >= table.maximum[idx]:
+            donors.append(idx)
+        else:
+            acceptors.append(idx)
+            total_mem_pref_acceptors += pref
+        total_memory_needed += need
+        total_mem_pref += pref
+
+    total_available_memory = xen_free_memory - total_memory_needed
+    if total_available_memory > 0:
+        return balance_when_enough_memory_table(table, xen_free_memory,
+            total_mem_pref, total_available_memory)
+    else:
+        return balance_when_low_on_memory_table(table, xen_free_memory,
+            total_mem_pref_acceptors, donors, acceptors)
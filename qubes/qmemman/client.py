@@ -19,24 +19,213 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import json
 import socket
 import fcntl
+import threading
+
+SOCK_PATH = "/var/run/qubes/qmemman.sock"
+
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX)
+
+    flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+    flags |= fcntl.FD_CLOEXEC
+    fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags)
+
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class QMemmanConnection:
+    """Persistent connection to qmemman (protocol version 2).
+
+    Requests from any number of threads are multiplexed over it; replies are
+    dispatched by a reader thread. When the connection is lost, qmemman
+    releases all its reservations, and so pending requests fail.
+    """
+    def __init__(self, path=None):
+        self.sock = _connect(path or SOCK_PATH)
+        self.rfile = self.sock.makefile('rb')
+        try:
+            self.sock.sendall(b"QMEMMAN 2\n")
+            if self.rfile.readline().strip() != b"QMEMMAN 2":
+                raise ConnectionError(
+                    'qmemman does not support protocol version 2')
+        except OSError:
+            self.rfile.close()
+            self.sock.close()
+            raise
+        self.lock = threading.Lock()
+        self.next_id = 0
+        # request ID -> [event, got memory?]
+        self.pending = {}
+        self.broken = False
+        self.thread = threading.Thread(target=self._read_replies,
+            name='qmemman-client', daemon=True)
+        self.thread.start()
+
+    def _read_replies(self):
+        try:
+            for line in self.rfile:
+                fields = line.split()
+                if len(fields) != 2:
+                    break
+                with self.lock:
+                    waiter = self.pending.pop(int(fields[0]), None)
+                if waiter is not None:
+                    waiter[1] = (fields[1] == b'OK')
+                    waiter[0].set()
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                self.broken = True
+                waiters = list(self.pending.values())
+                self.pending.clear()
+            for waiter in waiters:
+                waiter[0].set()
+            self.rfile.close()
+            self.sock.close()
+
+    def _send(self, line):
+        # must be called with self.lock held
+        if self.broken:
+            raise ConnectionError('connection to qmemman lost')
+        try:
+            self.sock.sendall(line.encode('ascii') + b"\n")
+        except OSError:
+            self.broken = True
+            raise
+
+    def reserve(self, amount, batch=False):
+        """Request *amount* bytes, return the request ID or None if qmemman
+        couldn't get the memory"""
+        waiter = [threading.Event(), False]
+        with self.lock:
+            request_id = self.next_id
+            self.next_id += 1
+            self.pending[request_id] = waiter
+            try:
+                self._send("RESERVE {} {}{}".format(request_id, int(amount),
+                    " batch" if batch else ""))
+            except OSError:
+                del self.pending[request_id]
+                raise
+        waiter[0].wait()
+        return request_id if waiter[1] else None
+
+    def _finish(self, command, request_id):
+        with self.lock:
+            try:
+                self._send("{} {}".format(command, request_id))
+            except OSError:
+                # reservations of broken connection are released anyway
+                pass
+
+    def commit(self, request_id):
+        """Report that the memory is now used by the started VM"""
+        self._finish("COMMIT", request_id)
+
+    def release(self, request_id):
+        """Give the reserved memory back"""
+        self._finish("RELEASE", request_id)
+
+
+_connection = None
+_connection_lock = threading.Lock()
+
+
+def get_connection():
+    """Return the process-wide :py:class:`QMemmanConnection`, (re)connecting
+    if needed"""
+    global _connection
+    with _connection_lock:
+        if _connection is None or _connection.broken:
+            _connection = QMemmanConnection()
+        return _connection
+
 
 class QMemmanClient:
-    def request_memory(self, amount):
-        self.sock = socket.socket(socket.AF_UNIX)
+    # number of requests in this process waiting for an answer; when there
+    # are others, more VMs are being started at the same time and qmemman
+    # can merge the requests
+    _in_flight_lock = threading.Lock()
+    _in_flight = 0
 
-        flags = fcntl.fcntl(self.sock.fileno(), fcntl.F_GETFD)
-        flags |= fcntl.FD_CLOEXEC
-        fcntl.fcntl(self.sock.fileno(), fcntl.F_SETFD, flags)
+    def __init__(self):
+        self.sock = None
+        self.connection = None
+        self.request_id = None
 
-        self.sock.connect("/var/run/qubes/qmemman.sock")
-        self.sock.send(str(int(amount)).encode('ascii')+b"\n")
+    def request_memory(self, amount):
+        with QMemmanClient._in_flight_lock:
+            batch = QMemmanClient._in_flight > 0
+            QMemmanClient._in_flight += 1
+        try:
+            try:
+                connection = get_connection()
+                request_id = connection.reserve(amount, batch)
+            except OSError:
+                # qmemman not supporting protocol version 2 (or restarted
+                # just now)
+                return self._request_memory_v1(amount, batch)
+        finally:
+            with QMemmanClient._in_flight_lock:
+                QMemmanClient._in_flight -= 1
+        if request_id is None:
+            return False
+        self.connection = connection
+        self.request_id = request_id
+        return True
+
+    def _request_memory_v1(self, amount, batch):
+        # the connection holds qmemman's lock until closed
+        self.sock = _connect(SOCK_PATH)
+        request = str(int(amount)).encode('ascii')
+        if batch:
+            request += b" batch"
+        self.sock.send(request + b"\n")
         received = self.sock.recv(1024).strip()
         if received == b'OK':
             return True
         else:
             return False
 
+    def commit(self):
+        """The VM using requested memory is started"""
+        if self.connection is not None:
+            self.connection.commit(self.request_id)
+            self.connection = None
+
     def close(self):
-        self.sock.close()
+        """Release requested memory, unless already committed"""
+        if self.connection is not None:
+            self.connection.release(self.request_id)
+            self.connection = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def get_status(self, timeout=5):
+        """Return qmemman state and statistics (see
+        qubes.tools.qmemmand.QMemmanServer.get_status)
+
+        Raises socket.timeout if qmemman does not answer within *timeout*
+        seconds"""
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.settimeout(timeout)
+            sock.connect(SOCK_PATH)
+            sock.sendall(b"STATUS\n")
+            data = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        return json.loads(data.decode('ascii'))
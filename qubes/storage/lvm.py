@@ -19,6 +19,7 @@
 
 ''' Driver for storing vm images in a LVM thin pool '''
 import functools
+import json
 import logging
 import os
 import subprocess
@@ -43,6 +44,15 @@ def check_lvm_version():
 
 lvm_is_very_old = check_lvm_version()
 
+#: send LVM operations to long running :program:`lvm shell` processes (see
+#: :py:class:`LvmShellPool`), instead of starting :program:`lvm` for each of
+#: them; set ``QUBES_LVM_SHELL=1`` in qubesd environment to enable
+use_lvm_shell = os.environ.get('QUBES_LVM_SHELL', '0') == '1'
+
+#: number of :program:`lvm shell` processes, executing LVM operations
+#: concurrently
+LVM_SHELL_POOL_SIZE = 4
+
 
 class ThinPool(qubes.storage.Pool):
     ''' LVM Thin based pool implementation
@@ -218,6 +228,13 @@ _init_cache_cmd = ['lvs', '--noheadings', '-o',
    'vg_name,pool_lv,name,lv_size,data_percent,lv_attr,origin,lv_metadata_size,'
    'metadata_percent', '--units', 'b', '--separator', ';']
 
+#: attributes of a (thin) snapshot created by :py:func:`qubes_lvm`
+_new_volume_attr = 'Vwi-a-tz--'
+
+#: volumes updated in :py:data:`size_cache` by :py:func:`_update_cache` since
+#: the last full rescan
+_updated_vids = set()
+
 def _parse_lvm_cache(lvm_output):
     result = {}
 
@@ -241,6 +258,107 @@ def _parse_lvm_cache(lvm_output):
 
     return result
 
+def _vid_from_path(path):
+    if path.startswith('/dev/'):
+        return path[len('/dev/'):]
+    return path
+
+def _cache_affected_vids(cmd):
+    ''' Return volumes whose :py:data:`size_cache` entries are changed by
+    LVM operation *cmd* (as given to :py:func:`qubes_lvm`)'''
+    action = cmd[0]
+    if action == 'create':
+        return [cmd[1].split('/', 1)[0] + '/' + cmd[2]]
+    if action in ('clone', 'rename'):
+        return [_vid_from_path(cmd[1]), _vid_from_path(cmd[2])]
+    if action in ('remove', 'extend'):
+        return [_vid_from_path(cmd[1])]
+    return []
+
+def _update_cache(cmd):
+    ''' Update :py:data:`size_cache` with the known effect of successful LVM
+    operation *cmd* (as given to :py:func:`qubes_lvm`), instead of scanning
+    all the volumes again.
+
+    Usage is not updated (a snapshot has the same as its origin), it is
+    refreshed periodically by :py:func:`refresh_cache`. That also reports
+    entries updated here which do not match reality.
+
+    :return: False if the effect could not be determined
+    '''
+    cache = qubes.storage.lvm.size_cache
+    action = cmd[0]
+    if action in ('create', 'extend'):
+        # LVM rounds the size up to whole extents, let the caller ask it
+        return False
+    if action == 'clone':
+        src = _vid_from_path(cmd[1])
+        if src not in cache:
+            return False
+        vol_info = dict(cache[src])
+        vol_info['attr'] = _new_volume_attr
+        vol_info['origin'] = src.split('/', 1)[1]
+        cache[_vid_from_path(cmd[2])] = vol_info
+    elif action == 'rename':
+        src, dst = _vid_from_path(cmd[1]), _vid_from_path(cmd[2])
+        if src not in cache:
+            return False
+        cache[dst] = cache.pop(src)
+        # snapshots refer to their origin by name
+        _replace_origin(cache, src, dst.split('/', 1)[1])
+    elif action == 'remove':
+        vid = _vid_from_path(cmd[1])
+        cache.pop(vid, None)
+        _replace_origin(cache, vid, '')
+    _updated_vids.update(_cache_affected_vids(cmd))
+    return True
+
+def _replace_origin(cache, vid, new_origin):
+    volume_group, name = vid.split('/', 1)
+    for other_vid, vol_info in cache.items():
+        if vol_info['origin'] == name and \
+                other_vid.startswith(volume_group + '/'):
+            vol_info['origin'] = new_origin
+
+def _set_cache(new_cache, vids=None,
+        log=logging.getLogger('qubes.storage.lvm')):
+    ''' Replace :py:data:`size_cache` content with *new_cache*, reporting
+    entries updated by :py:func:`_update_cache` which do not match
+
+    :param vids: if given, *new_cache* is a result of scanning only these
+        volumes
+    '''
+    old_cache = qubes.storage.lvm.size_cache
+    if vids is None:
+        checked = _updated_vids.copy()
+        _updated_vids.clear()
+    else:
+        checked = _updated_vids.intersection(vids)
+        _updated_vids.difference_update(vids)
+    for vid in sorted(checked):
+        old, new = old_cache.get(vid), new_cache.get(vid)
+        if old is None and new is None:
+            continue
+        if old is None or new is None or any(old[key] != new[key]
+                for key in ('size', 'pool_lv', 'origin')):
+            log.warning('LVM size cache mismatch for %s: cached %r, '
+                'actual %r', vid, old, new)
+    if vids is None:
+        qubes.storage.lvm.size_cache = new_cache
+        qubes.storage.lvm.size_cache_time = time.monotonic()
+    else:
+        for vid in vids:
+            if vid in new_cache:
+                old_cache[vid] = new_cache[vid]
+            else:
+                old_cache.pop(vid, None)
+
+def _get_lvs_cmdline(vids=()):
+    cmd = _init_cache_cmd + list(vids)
+    if os.getuid() != 0:
+        cmd = ['sudo'] + cmd
+    return cmd
+
 def init_cache(log=logging.getLogger('qubes.storage.lvm')):
     cmd = _init_cache_cmd
     if os.getuid() != 0:
@@ -278,6 +396,35 @@ def init_cache_coro(log=logging.getLogger('qubes.storage.lvm')):
 
     return _parse_lvm_cache(out)
 
+def refresh_volumes(vids, log=logging.getLogger('qubes.storage.lvm')):
+    ''' Refresh :py:data:`size_cache` entries of given volumes only '''
+    if not vids:
+        return
+    environ = os.environ.copy()
+    environ['LC_ALL'] = 'C.utf8'
+    p = subprocess.Popen(_get_lvs_cmdline(vids), stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, close_fds=True, env=environ)
+    out, _ = p.communicate()
+    # missing volumes make lvs fail, but the others are still listed
+    _set_cache(_parse_lvm_cache(out), vids, log)
+
+@asyncio.coroutine
+def refresh_volumes_coro(vids, log=logging.getLogger('qubes.storage.lvm')):
+    ''' Refresh :py:data:`size_cache` entries of given volumes only
+
+    Coroutine version of :py:func:`refresh_volumes`'''
+    if not vids:
+        return
+    environ = os.environ.copy()
+    environ['LC_ALL'] = 'C.utf8'
+    p = yield from asyncio.create_subprocess_exec(*_get_lvs_cmdline(vids),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        close_fds=True, env=environ)
+    out, _ = yield from p.communicate()
+    # missing volumes make lvs fail, but the others are still listed
+    _set_cache(_parse_lvm_cache(out), vids, log)
+
 size_cache_time = 0
 size_cache = init_cache()
 
@@ -449,13 +596,11 @@ class ThinVolume(qubes.storage.Volume):
             cmd = ['rename', self.vid,
                    '{}-{}-back'.format(self.vid, int(time.time()))]
             yield from qubes_lvm_coro(cmd, self.log)
-            yield from reset_cache_coro()
 
         cmd = ['clone' if keep else 'rename',
                vid_to_commit,
                self.vid]
         yield from qubes_lvm_coro(cmd, self.log)
-        yield from reset_cache_coro()
         # make sure the one we've committed right now is properly
         # detected as the current one - before removing anything
         assert self._vid_current == self.vid
@@ -479,7 +624,6 @@ class ThinVolume(qubes.storage.Volume):
                     str(self.size)
                 ]
             yield from qubes_lvm_coro(cmd, self.log)
-            yield from reset_cache_coro()
         return self
 
     @locked
@@ -505,7 +649,6 @@ class ThinVolume(qubes.storage.Volume):
             return
         cmd = ['remove', self.path]
         yield from qubes_lvm_coro(cmd, self.log)
-        yield from reset_cache_coro()
         # pylint: disable=protected-access
         self.pool._volume_objects_cache.pop(self.vid, None)
 
@@ -571,7 +714,6 @@ class ThinVolume(qubes.storage.Volume):
         cmd = ['create', self.pool._pool_id, self._vid_import.split('/')[1],
                str(self.size)]
         yield from qubes_lvm_coro(cmd, self.log)
-        yield from reset_cache_coro()
         devpath = '/dev/' + self._vid_import
         return devpath
 
@@ -632,7 +774,6 @@ class ThinVolume(qubes.storage.Volume):
             yield from qubes_lvm_coro(cmd, self.log)
         cmd = ['clone', self.vid + '-' + revision, self.vid]
         yield from qubes_lvm_coro(cmd, self.log)
-        yield from reset_cache_coro()
         return self
 
     @locked
@@ -666,7 +807,6 @@ class ThinVolume(qubes.storage.Volume):
         elif self.save_on_stop or not self.snap_on_start:
             cmd = ['extend', self._vid_current, str(size)]
             yield from qubes_lvm_coro(cmd, self.log)
-        yield from reset_cache_coro()
 
     @asyncio.coroutine
     def _snapshot(self):
@@ -686,30 +826,24 @@ class ThinVolume(qubes.storage.Volume):
     @asyncio.coroutine
     def start(self):
         self.abort_if_import_in_progress()
-        try:
-            if self.snap_on_start or self.save_on_stop:
-                if not self.save_on_stop or not self.is_dirty():
-                    yield from self._snapshot()
-            else:
-                yield from self._reset()
-        finally:
-            yield from reset_cache_coro()
+        if self.snap_on_start or self.save_on_stop:
+            if not self.save_on_stop or not self.is_dirty():
+                yield from self._snapshot()
+        else:
+            yield from self._reset()
         return self
 
     @locked
     @asyncio.coroutine
     def stop(self):
-        try:
-            if self.save_on_stop:
-                yield from self._commit()
-            if self.snap_on_start and not self.save_on_stop:
-                cmd = ['remove', self._vid_snap]
-                yield from qubes_lvm_coro(cmd, self.log)
-            elif not self.snap_on_start and not self.save_on_stop:
-                cmd = ['remove', self.vid]
-                yield from qubes_lvm_coro(cmd, self.log)
-        finally:
-            yield from reset_cache_coro()
+        if self.save_on_stop:
+            yield from self._commit()
+        if self.snap_on_start and not self.save_on_stop:
+            cmd = ['remove', self._vid_snap]
+            yield from qubes_lvm_coro(cmd, self.log)
+        elif not self.snap_on_start and not self.save_on_stop:
+            cmd = ['remove', self.vid]
+            yield from qubes_lvm_coro(cmd, self.log)
         return self
 
     def verify(self):
@@ -761,13 +895,13 @@ def pool_exists(pool_id):
     except KeyError:
         return False
 
-def _get_lvm_cmdline(cmd):
-    ''' Build command line for :program:`lvm` call.
-    The purpose of this function is to keep all the detailed lvm options in
-    one place.
+def _get_lvm_args(cmd):
+    ''' Build LVM command for an operation, without the :program:`lvm`
+    prefix. The purpose of this function is to keep all the detailed lvm
+    options in one place.
 
     :param cmd: array of str, where cmd[0] is action and the rest are arguments
-    :return array of str appropriate for subprocess.Popen
+    :return array of str like ``['lvremove', '-f', vid]``
     '''
     action = cmd[0]
     if action == 'remove':
@@ -789,6 +923,15 @@ def _get_lvm_cmdline(cmd):
     if lvm_is_very_old:
         # old lvm in trusty image used there does not support -k option
         lvm_cmd = [x for x in lvm_cmd if x != '-kn']
+    return lvm_cmd
+
+def _get_lvm_cmdline(cmd):
+    ''' Build command line for :program:`lvm` call.
+
+    :param cmd: array of str, where cmd[0] is action and the rest are arguments
+    :return array of str appropriate for subprocess.Popen
+    '''
+    lvm_cmd = _get_lvm_args(cmd)
     if os.getuid() != 0:
         cmd = ['sudo', 'lvm'] + lvm_cmd
     else:
@@ -814,22 +957,274 @@ def _process_lvm_output(returncode, stdout, stderr, log):
         raise qubes.storage.StoragePoolException(err)
     return True
 
+class LvmShell:
+    ''' Long running :program:`lvm shell` executing LVM operations
+
+    Starting :program:`lvm`, including reading its configuration and
+    scanning devices, takes most of the time of small operations like
+    creating a snapshot. Instead, commands are written one at a time to
+    a :program:`lvm shell` process, which is started on first use and
+    again after it fails (or is killed, if it does not finish a command in
+    time). The result of each command is read from its log
+    report, written in JSON format to a separate pipe (``LVM_REPORT_FD``).
+
+    :param cmd: command line starting the shell
+    '''
+    prompt = b'lvm> '
+    #: options making LVM write the log report of a command
+    report_args = ['--reportformat', 'json',
+        '--config', 'log{report_command_log=1}']
+    #: how long to wait for the shell to start, and for the report after
+    #: a command finished, in seconds
+    timeout = 10
+    #: how long to wait for a command to finish, in seconds
+    command_timeout = 120
+
+    def __init__(self, cmd=('lvm', 'shell'),
+            log=logging.getLogger('qubes.storage.lvm')):
+        self.cmd = list(cmd)
+        self.log = log
+        self.loop = asyncio.get_event_loop()
+        #: the shell could not be started, LVM operations should spawn
+        #: :program:`lvm` instead
+        self.broken = False
+        self._lock = asyncio.Lock()
+        self._process = None
+        self._report = None
+        self._report_transport = None
+        self._report_buffer = ''
+
+    @asyncio.coroutine
+    def _start(self):
+        read_fd, write_fd = os.pipe()
+        environ = os.environ.copy()
+        environ['LC_ALL'] = 'C.utf8'
+        environ['LVM_REPORT_FD'] = str(write_fd)
+        # no terminal control sequences around the prompt
+        environ['TERM'] = 'dumb'
+        report_pipe = open(read_fd, 'rb', 0)
+        try:
+            # stderr is inherited, diagnostics end up in qubesd log
+            self._process = yield from asyncio.create_subprocess_exec(
+                *self.cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                pass_fds=(write_fd,),
+                close_fds=True, env=environ)
+        except OSError:
+            report_pipe.close()
+            raise
+        finally:
+            os.close(write_fd)
+        self._report = asyncio.StreamReader()
+        self._report_buffer = ''
+        self._report_transport, _ = yield from self.loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self._report), report_pipe)
+        yield from self._read_until_prompt(self.timeout)
+        self.log.debug('Started lvm shell (pid %d)', self._process.pid)
+
+    @asyncio.coroutine
+    def _read_until_prompt(self, timeout):
+        output = yield from asyncio.wait_for(
+            self._process.stdout.readuntil(self.prompt), timeout)
+        return output[:-len(self.prompt)]
+
+    @asyncio.coroutine
+    def _read_report(self):
+        decoder = json.JSONDecoder()
+        while True:
+            self._report_buffer = self._report_buffer.lstrip()
+            try:
+                report, end = decoder.raw_decode(self._report_buffer)
+            except ValueError:
+                pass
+            else:
+                self._report_buffer = self._report_buffer[end:]
+                return report
+            chunk = yield from self._report.read(4096)
+            if not chunk:
+                raise EOFError('log report closed')
+            self._report_buffer += chunk.decode()
+
+    @staticmethod
+    def _parse_report(report):
+        ''' Convert log report of a command to ``(returncode, stderr)`` '''
+        returncode = 0
+        messages = []
+        for entry in report.get('log', []):
+            if entry.get('log_type') == 'status' and \
+                    str(entry.get('log_ret_code')) != '1':
+                returncode = 5
+            elif entry.get('log_type') in ('error', 'warn') and \
+                    entry.get('log_message'):
+                messages.append(entry['log_message'])
+        if returncode != 0 and not messages:
+            messages.append('lvm shell: command failed')
+        return returncode, '\n'.join(messages).encode()
+
+    def close(self, kill=False):
+        ''' Close the shell; it exits after finishing the current command,
+        unless *kill* is set '''
+        if self._process is None:
+            return
+        if not self.loop.is_closed():
+            if kill:
+                try:
+                    self._process.kill()
+                except ProcessLookupError:
+                    pass
+            self._process.stdin.close()
+            if self._report_transport is not None:
+                self._report_transport.close()
+        self._process = None
+        self._report = None
+        self._report_transport = None
+
+    @asyncio.coroutine
+    def execute(self, args):
+        ''' Execute LVM command *args*, like ``['lvremove', '-f', vid]``
+
+        :return: ``(returncode, stdout, stderr)``, like of :program:`lvm`
+            process, or None if the command should be executed by
+            spawning :program:`lvm`
+        '''
+        # the shell splits the line on whitespace
+        if any(not arg or set(arg).intersection(' \t\n\'"#')
+                for arg in args):
+            return None
+        with (yield from self._lock):
+            if self._process is None or self._process.returncode is not None:
+                self.close()
+                try:
+                    yield from self._start()
+                except asyncio.CancelledError:
+                    self.close()
+                    raise
+                except Exception as e:  # pylint: disable=broad-except
+                    self.log.warning('Failed to start lvm shell, '
+                        'starting lvm for each operation instead: %s', e)
+                    self.close()
+                    self.broken = True
+                    return None
+
+            line = ' '.join(args + self.report_args) + '\n'
+            try:
+                self._process.stdin.write(line.encode())
+                yield from self._process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # the shell exited without reading the command; start it
+                # again next time
+                self.close()
+                return None
+
+            try:
+                out = yield from self._read_until_prompt(self.command_timeout)
+                report = yield from asyncio.wait_for(self._read_report(),
+                    self.timeout)
+            except asyncio.CancelledError:
+                self.close()
+                raise
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                    asyncio.TimeoutError, EOFError, ValueError) as e:
+                self.log.warning('lvm shell failed, restarting it: %r', e)
+                self.close(kill=True)
+                return (1, b'', 'lvm shell failed, result of {} unknown'.format(
+                    args[0]).encode())
+            returncode, err = self._parse_report(report)
+            return returncode, out, err
+
+
+class LvmShellPool:
+    ''' Pool of :py:class:`LvmShell`, so independent LVM operations do not
+    wait for each other
+
+    Up to *size* operations are executed concurrently, each by an idle
+    shell, or a new one.
+
+    :param size: maximum number of shells
+    :param cmd: command line starting a shell
+    '''
+    def __init__(self, size=LVM_SHELL_POOL_SIZE, cmd=('lvm', 'shell'),
+            log=logging.getLogger('qubes.storage.lvm')):
+        self.cmd = list(cmd)
+        self.log = log
+        self.loop = asyncio.get_event_loop()
+        #: a shell could not be started, LVM operations should spawn
+        #: :program:`lvm` instead
+        self.broken = False
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle = []
+
+    def close(self):
+        ''' Close idle shells; busy ones are not reused '''
+        for shell in self._idle:
+            shell.close()
+        self._idle = []
+
+    @asyncio.coroutine
+    def execute(self, args):
+        ''' Execute LVM command *args*, see :py:meth:`LvmShell.execute` '''
+        with (yield from self._semaphore):
+            if self._idle:
+                shell = self._idle.pop()
+            else:
+                shell = LvmShell(self.cmd, self.log)
+            try:
+                return (yield from shell.execute(args))
+            finally:
+                # a shell which failed is started again on next use, unless
+                # it could not be started at all
+                if shell.broken:
+                    self.broken = True
+                else:
+                    self._idle.append(shell)
+
+
+_lvm_shell = None
+
+def _get_lvm_shell():
+    ''' Return :py:class:`LvmShellPool` for the current event loop, or None
+    if LVM operations should spawn :program:`lvm` '''
+    global _lvm_shell  # pylint: disable=global-statement
+    # sudo does not pass LVM_REPORT_FD
+    if not use_lvm_shell or lvm_is_very_old or os.getuid() != 0:
+        return None
+    if _lvm_shell is None or _lvm_shell.loop is not asyncio.get_event_loop():
+        if _lvm_shell is not None:
+            _lvm_shell.close()
+        _lvm_shell = LvmShellPool(LVM_SHELL_POOL_SIZE)
+    if _lvm_shell.broken:
+        return None
+    return _lvm_shell
+
 def qubes_lvm(cmd, log=logging.getLogger('qubes.storage.lvm')):
-    ''' Call :program:`lvm` to execute an LVM operation '''
+    ''' Call :program:`lvm` to execute an LVM operation
+
+    :py:data:`size_cache` is updated accordingly.
+    '''
     # the only caller for this non-coroutine version is ThinVolume.export()
-    cmd = _get_lvm_cmdline(cmd)
+    lvm_cmd = _get_lvm_cmdline(cmd)
     environ = os.environ.copy()
     environ['LC_ALL'] = 'C.utf8'
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-        close_fds=True, env=environ)
+    p = subprocess.Popen(lvm_cmd, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, close_fds=True, env=environ)
     out, err = p.communicate()
-    return _process_lvm_output(p.returncode, out, err, log)
+    try:
+        _process_lvm_output(p.returncode, out, err, log)
+    except qubes.storage.StoragePoolException:
+        # the operation may have been partially done
+        refresh_volumes(_cache_affected_vids(cmd), log)
+        raise
+    if not _update_cache(cmd):
+        refresh_volumes(_cache_affected_vids(cmd), log)
+    return True
 
 @asyncio.coroutine
 def qubes_lvm_coro(cmd, log=logging.getLogger('qubes.storage.lvm')):
     ''' Call :program:`lvm` to execute an LVM operation
 
-    Coroutine version of :py:func:`qubes_lvm`'''
+    Coroutine version of :py:func:`qubes_lvm`. If possible, the operation is
+    sent to :py:class:`LvmShell` instead of starting a new process.'''
     environ = os.environ.copy()
     environ['LC_ALL'] = 'C.utf8'
     if cmd[0] == "remove":
@@ -839,25 +1234,36 @@ def qubes_lvm_coro(cmd, log=logging.getLogger('qubes.storage.lvm')):
             stderr=subprocess.DEVNULL,
             close_fds=True, env=environ)
         _, _ = yield from p.communicate()
-    cmd = _get_lvm_cmdline(cmd)
-    p = yield from asyncio.create_subprocess_exec(*cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        close_fds=True, env=environ)
-    out, err = yield from p.communicate()
-    return _process_lvm_output(p.returncode, out, err, log)
+    result = None
+    lvm_shell = _get_lvm_shell()
+    if lvm_shell is not None:
+        result = yield from lvm_shell.execute(_get_lvm_args(cmd))
+    if result is None:
+        lvm_cmd = _get_lvm_cmdline(cmd)
+        p = yield from asyncio.create_subprocess_exec(*lvm_cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True, env=environ)
+        out, err = yield from p.communicate()
+        result = (p.returncode, out, err)
+    try:
+        _process_lvm_output(*result, log=log)
+    except qubes.storage.StoragePoolException:
+        # the operation may have been partially done
+        yield from refresh_volumes_coro(_cache_affected_vids(cmd), log)
+        raise
+    if not _update_cache(cmd):
+        yield from refresh_volumes_coro(_cache_affected_vids(cmd), log)
+    return True
 
 
 def reset_cache():
-    qubes.storage.lvm.size_cache = init_cache()
-    qubes.storage.lvm.size_cache_time = time.monotonic()
-
-@asyncio.coroutine
-def reset_cache_coro():
-    qubes.storage.lvm.size_cache = yield from init_cache_coro()
-    qubes.storage.lvm.size_cache_time = time.monotonic()
+    ''' Scan all the volumes again, reporting cache entries updated in place
+    which turned out to be wrong '''
+    _set_cache(init_cache())
 
 def refresh_cache():
-    '''Reset size cache, if it's older than 30sec '''
+    '''Reset size cache, if it's older than 30sec; besides refreshing usage,
+    this reconciles entries updated in place after LVM operations '''
     if size_cache_time+30 < time.monotonic():
         reset_cache()
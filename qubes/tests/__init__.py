@@ -728,6 +728,8 @@ class SystemTestCase(QubesTestCase):
                 app=self.app, debug=True))
 
         self.addCleanup(self.cleanup_app)
+        # cleanups are called in reverse order
+        self.addCleanup(self.assertLibvirtStateCacheConsistent, self.app)
 
         self.app.add_handler('domain-delete', self.close_qdb_on_remove)
 
@@ -740,6 +742,21 @@ class SystemTestCase(QubesTestCase):
             vm._qdb_connection_watch.close()
             vm._qdb_connection_watch = None
 
+    def assertLibvirtStateCacheConsistent(self, app):
+        '''Check if cached libvirt state of all the domains is up to date'''
+        def get_mismatches():
+            return {vm.name: mismatch for vm, mismatch in (
+                (vm, vm.check_libvirt_state_cache()) for vm in app.domains
+                if isinstance(vm, qubes.vm.qubesvm.QubesVM))
+                if mismatch is not None}
+        mismatches = get_mismatches()
+        if mismatches:
+            # give a chance to process already queued libvirt events
+            self.loop.run_until_complete(asyncio.sleep(1))
+            mismatches = get_mismatches()
+        self.assertEqual(mismatches, {},
+            'cached libvirt state (cached, actual) is outdated')
+
     def cleanup_app(self):
         self.remove_test_vms()
 
@@ -1404,6 +1421,8 @@ def load_tests(loader, tests, pattern): # pylint: disable=unused-argument
             'qubes.tests.api_admin',
             'qubes.tests.api_misc',
             'qubes.tests.api_internal',
+            'qubes.tests.bulk',
+            'qubes.tests.qmemman',
             ):
         tests.addTests(loader.loadTestsFromName(modname))
 
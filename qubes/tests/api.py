@@ -19,15 +19,22 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import os
+import shutil
 import socket
+import tempfile
 import unittest.mock
 
 import qubes.api
+import qubes.events
 import qubes.tests
+import qubes.tests.perf
+import qubes.tests.perf.api
 
 
 class TestMgmt(object):
-    def __init__(self, app, src, method, dest, arg, send_event=None):
+    def __init__(self, app, src, method, dest, arg, send_event=None,
+            permission_cache=None):
         self.app = app
         self.src = src
         self.method = method
@@ -170,3 +177,210 @@ class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
         with self.assertNotRaises(asyncio.TimeoutError):
             self.loop.run_until_complete(
                 asyncio.wait_for(self.protocol.mgmt.task, 1))
+
+
+class TestPermissionVM(qubes.events.Emitter):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.events_enabled = True
+        self.tags = set()
+        self.calls = 0
+
+    def __str__(self):
+        return self.name
+
+
+class TestPermissionDomains(dict):
+    def __iter__(self):
+        return iter(self.values())
+
+
+class TestPermissionApp(qubes.events.Emitter):
+    def __init__(self):
+        super().__init__()
+        self.events_enabled = True
+        self.domains = TestPermissionDomains()
+
+    def add_vm(self, name):
+        vm = TestPermissionVM(name)
+        self.domains[name] = vm
+        self.fire_event('domain-add', vm=vm)
+        return vm
+
+
+class TestPermissionAPI(qubes.api.AbstractQubesAPI):
+    @qubes.api.method('test.Call', no_payload=True)
+    @asyncio.coroutine
+    def call(self):
+        self.fire_event_for_permission()
+
+    @qubes.api.method('test.CallWithValue', no_payload=True)
+    @asyncio.coroutine
+    def call_with_value(self):
+        self.fire_event_for_permission(value='value')
+
+
+class TC_10_PermissionCache(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = TestPermissionApp()
+        self.cache = qubes.api.PermissionCache(self.app)
+        self.src = self.app.add_vm('src')
+        self.dest = self.app.add_vm('dest')
+
+    def tearDown(self):
+        self.cache.close()
+        del self.app
+        super().tearDown()
+
+    def add_permission_handler(self, invalidated_by=None):
+        def handler(subject, event, dest, arg, **kwargs):
+            # pylint: disable=unused-argument
+            subject.calls += 1
+            if arg in subject.tags:
+                raise qubes.api.PermissionDenied('tag ' + arg)
+            return [lambda x: x != arg]
+        if invalidated_by is not None:
+            handler.ha_invalidated_by = invalidated_by
+        self.src.add_handler('admin-permission:test.Call*', handler)
+
+    def call(self, method=b'test.Call', arg=b'arg'):
+        mgmt = TestPermissionAPI(self.app, b'src', method, b'dest', arg,
+            permission_cache=self.cache)
+        self.loop.run_until_complete(mgmt.execute(untrusted_payload=b''))
+        return mgmt
+
+    def test_000_cached(self):
+        self.add_permission_handler(invalidated_by=())
+        self.call()
+        self.call()
+        self.assertEqual(self.src.calls, 1)
+        self.assertEqual(len(self.cache), 1)
+        self.call(arg=b'other')
+        self.assertEqual(self.src.calls, 2)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_001_filters(self):
+        self.add_permission_handler(invalidated_by=())
+        for _ in range(2):
+            mgmt = self.call()
+            self.assertEqual(
+                list(mgmt.fire_event_for_filter(['arg', 'other'])),
+                ['other'])
+        self.assertEqual(self.src.calls, 1)
+
+    def test_002_denied_cached(self):
+        self.add_permission_handler(invalidated_by=())
+        self.src.tags.add('arg')
+        for _ in range(2):
+            with self.assertRaises(qubes.api.PermissionDenied) as e:
+                self.call()
+            self.assertEqual(e.exception.args, ('tag arg',))
+        self.assertEqual(self.src.calls, 1)
+
+    def test_003_undeclared_not_cached(self):
+        self.add_permission_handler()
+        self.call()
+        self.call()
+        self.assertEqual(self.src.calls, 2)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_004_kwargs_not_cached(self):
+        self.add_permission_handler(invalidated_by=())
+        self.call(method=b'test.CallWithValue')
+        self.call(method=b'test.CallWithValue')
+        self.assertEqual(self.src.calls, 2)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_005_no_cache(self):
+        self.add_permission_handler(invalidated_by=())
+        for _ in range(2):
+            mgmt = TestPermissionAPI(self.app, b'src', b'test.Call', b'dest',
+                b'arg')
+            self.loop.run_until_complete(
+                mgmt.execute(untrusted_payload=b''))
+        self.assertEqual(self.src.calls, 2)
+
+    def test_006_max_entries(self):
+        self.cache.max_entries = 3
+        self.add_permission_handler(invalidated_by=())
+        for i in range(5):
+            self.call(arg='arg{}'.format(i).encode())
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.src.calls, 5)
+        # the least recently used ones were dropped
+        self.call(arg=b'arg2')
+        self.assertEqual(self.src.calls, 5)
+        self.call(arg=b'arg5')
+        self.assertEqual(self.src.calls, 6)
+        self.assertEqual(len(self.cache), 3)
+        self.call(arg=b'arg2')
+        self.call(arg=b'arg0')
+        self.assertEqual(self.src.calls, 7)
+
+    def test_010_invalidated_by_event(self):
+        self.add_permission_handler(invalidated_by=('domain-tag-add:*',))
+        self.call()
+        self.src.tags.add('arg')
+        self.dest.fire_event('domain-tag-add:arg', tag='arg')
+        self.assertEqual(len(self.cache), 0)
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call()
+        self.assertEqual(self.src.calls, 2)
+
+    def test_011_invalidated_by_event_on_new_vm(self):
+        self.add_permission_handler(invalidated_by=('domain-tag-add:*',))
+        self.call()
+        new_vm = self.app.add_vm('new')
+        self.call()
+        self.assertEqual(len(self.cache), 1)
+        new_vm.fire_event('domain-tag-add:arg', tag='arg')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_012_invalidated_by_domain_delete(self):
+        self.add_permission_handler(invalidated_by=('domain-tag-add:*',))
+        self.app.add_vm('removed')
+        self.call()
+        vm = self.app.domains.pop('removed')
+        self.app.fire_event('domain-delete', vm=vm)
+        self.assertEqual(len(self.cache), 0)
+        # no longer watched
+        self.call()
+        vm.fire_event('domain-tag-add:arg', tag='arg')
+        self.assertEqual(len(self.cache), 1)
+
+
+class TC_20_LoadTest(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = qubes.tests.perf.api.create_app(
+            os.path.join(self.tmpdir, 'qubes.xml'), vms=3, templates=1)
+
+    def tearDown(self):
+        self.app.close()
+        del self.app
+        shutil.rmtree(self.tmpdir)
+        super().tearDown()
+
+    def test_000_synthetic(self):
+        requests = list(qubes.tests.perf.api.synthetic_requests(
+            self.app, 50, seed=0))
+        self.assertEqual(len(requests), 50)
+        stats, elapsed = self.loop.run_until_complete(
+            qubes.tests.perf.api.run_benchmark(self.app, requests,
+                self.tmpdir, clients=4))
+        self.assertEqual(len(stats), 50)
+        self.assertEqual(sum(stats.errors.values()), 0)
+        self.assertGreater(elapsed, 0)
+        summary = stats.summary(elapsed)
+        self.assertEqual(sum(entry[1] for entry in summary), 50)
+        self.assertIn('internal.GetSystemInfo',
+            [entry[0] for entry in summary])
+
+    def test_001_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(qubes.tests.perf.percentile(values, 0.5), 50)
+        self.assertEqual(qubes.tests.perf.percentile(values, 0.99), 99)
+        self.assertEqual(qubes.tests.perf.percentile([5], 0.99), 5)
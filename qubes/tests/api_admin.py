@@ -995,6 +995,106 @@ netvm default=True type=vm
         self.assertIsNone(value)
         func_mock.assert_called_once_with()
 
+    def test_221_bulk_start(self):
+        func_mock = unittest.mock.Mock()
+
+        @asyncio.coroutine
+        def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+        self.vm.start = coroutine_mock
+        value = self.call_mgmt_func(b'admin.vm.BulkStart', b'dom0',
+            payload=b'test-vm1\n')
+        self.assertEqual(value, 'test-vm1 ok\n')
+        func_mock.assert_called_once_with()
+
+    def test_222_bulk_start_error(self):
+        @asyncio.coroutine
+        def coroutine_mock(*args, **kwargs):
+            raise qubes.exc.QubesVMError(self.vm, 'Start failed:\ndetails')
+        self.vm.start = coroutine_mock
+        value = self.call_mgmt_func(b'admin.vm.BulkStart', b'dom0',
+            b'2', payload=b'test-vm1')
+        self.assertEqual(value,
+            'test-vm1 error QubesVMError Start failed: details\n')
+
+    def test_223_bulk_start_invalid(self):
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.BulkStart', b'dom0',
+                payload=b'test-vm1 no-such-vm')
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.BulkStart', b'dom0',
+                payload=b'')
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.BulkStart', b'dom0',
+                b'0', payload=b'test-vm1')
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.BulkStart', b'test-vm1',
+                payload=b'test-vm1')
+
+    def test_224_start_autostart_pending(self):
+        log = []
+
+        class Scheduler:
+            @staticmethod
+            def is_pending(vm):
+                return True
+
+            @staticmethod
+            @asyncio.coroutine
+            def wait_for(vm):
+                log.append(('wait_for', vm))
+
+        @asyncio.coroutine
+        def coroutine_mock():
+            log.append(('start', self.vm))
+        self.vm.start = coroutine_mock
+        self.app.autostart_scheduler = Scheduler()
+        self.call_mgmt_func(b'admin.vm.Start', b'test-vm1')
+        self.assertEqual(log, [('wait_for', self.vm), ('start', self.vm)])
+
+    def test_225_dispvm_pool_info(self):
+        self.vm.template_for_dispvms = True
+        self.vm.features['dispvm-pool-size'] = '2'
+        manager = qubes.vm.dispvm.DispVMPoolManager(self.app)
+        pool = manager.get_pool(self.vm)
+        pool.hits = 3
+        pool.misses = 1
+        pool.refill_latencies.extend([1.0, 2.0])
+        value = self.call_mgmt_func(b'admin.vm.DispVMPoolInfo', b'test-vm1')
+        self.assertEqual(value,
+            'hits=3\nmisses=1\nprestart=0\nready=0\nrefill_count=2\n'
+            'refill_latency_avg=1.500\nrefill_latency_last=2.000\nsize=2\n')
+
+    def test_226_dispvm_pool_info_disabled(self):
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_mgmt_func(b'admin.vm.DispVMPoolInfo', b'test-vm1')
+
+    def test_227_timings(self):
+        timing = qubes.vm.qubesvm.OperationTiming('start')
+        timing.started = 1000.0
+        timing.phases = [('pre-start', 0.5), ('prepare', 1.25)]
+        timing.result = 'ok'
+        timing.total = 2.0
+        self.vm.operation_timings.append(timing)
+        value = self.call_mgmt_func(b'admin.vm.Timings', b'test-vm1')
+        self.assertEqual(value,
+            '1000.000 start ok total=2.000 pre-start=0.500 prepare=1.250\n')
+
+    def test_228_timings_empty(self):
+        value = self.call_mgmt_func(b'admin.vm.Timings', b'test-vm1')
+        self.assertEqual(value, '')
+
+    def test_229_autostart_status(self):
+        self.app.autostart_scheduler = unittest.mock.Mock()
+        self.app.autostart_scheduler.format_report.return_value = \
+            'status=finished elapsed=1.000\n'
+        value = self.call_mgmt_func(b'admin.autostart.Status', b'dom0')
+        self.assertEqual(value, 'status=finished elapsed=1.000\n')
+
+    def test_229_autostart_status_not_run(self):
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_mgmt_func(b'admin.autostart.Status', b'dom0')
+
     def test_230_shutdown(self):
         func_mock = unittest.mock.Mock()
 
@@ -1006,6 +1106,26 @@ netvm default=True type=vm
         self.assertIsNone(value)
         func_mock.assert_called_once_with()
 
+    def test_231_bulk_shutdown(self):
+        func_mock = unittest.mock.Mock()
+
+        @asyncio.coroutine
+        def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+        self.vm.shutdown = coroutine_mock
+        value = self.call_mgmt_func(b'admin.vm.BulkShutdown', b'dom0',
+            b'kill', payload=b'test-vm1\n')
+        self.assertEqual(value, 'test-vm1 ok\n')
+        func_mock.assert_called_once_with(wait=True, timeout=None)
+
+    def test_232_bulk_shutdown_invalid(self):
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.BulkShutdown', b'dom0',
+                b'force', payload=b'test-vm1')
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.BulkShutdown', b'dom0',
+                payload=b'no-such-vm')
+
     def test_240_pause(self):
         func_mock = unittest.mock.Mock()
 
@@ -2373,6 +2493,51 @@ netvm default=True type=vm
                 b'test-vm1')
         self.assertFalse(self.app.save.called)
 
+    @unittest.mock.patch('qubes.storage.Storage.create')
+    def test_643_vm_create_disposable_prestarted(self, mock_storage):
+        mock_storage.side_effect = self.dummy_coro
+        states = {}
+        def set_state(state):
+            @asyncio.coroutine
+            def method(vm, **kwargs):
+                # pylint: disable=unused-argument
+                states[vm.name] = state
+                return vm
+            return method
+        patch = unittest.mock.patch.multiple(qubes.vm.dispvm.DispVM,
+            start=set_state('Running'),
+            pause=set_state('Paused'),
+            unpause=set_state('Running'),
+            is_halted=lambda vm: states.get(vm.name, 'Halted') == 'Halted',
+            is_paused=lambda vm: states.get(vm.name) == 'Paused')
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.vm.template_for_dispvms = True
+        self.vm.features['dispvm-pool-prestart'] = True
+        self.vm.features['dispvm-pool-size'] = 1
+        manager = qubes.vm.dispvm.DispVMPoolManager(self.app)
+        pool = manager.get_pool(self.vm)
+        self.loop.run_until_complete(pool.schedule_refill())
+        pooled = pool.ready[0]
+        self.assertEqual(states[pooled.name], 'Paused')
+        retval = self.call_mgmt_func(b'admin.vm.CreateDisposable',
+            b'test-vm1', b'prestarted')
+        self.assertEqual(retval, pooled.name)
+        self.assertEqual(states[pooled.name], 'Running')
+        self.assertEqual(pool.hits, 1)
+        self.assertEqual(pool.misses, 0)
+        self.assertNotIn('dispvm-pool', pooled.features)
+        self.loop.run_until_complete(pool.schedule_refill())
+        self.assertEqual(len(pool.ready), 1)
+        self.assertNotEqual(pool.ready[0], pooled)
+
+    def test_644_vm_create_disposable_invalid_arg(self):
+        self.vm.template_for_dispvms = True
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.CreateDisposable',
+                b'test-vm1', b'running')
+        self.assertFalse(self.app.save.called)
+
     def test_650_vm_device_set_persistent_true(self):
         self.vm.add_handler('device-list:testclass',
             self.device_list_testclass)
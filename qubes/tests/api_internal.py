@@ -18,7 +18,9 @@
 # You should have received a copy of the GNU General Public License along
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 import asyncio
+import json
 import qubes.api.internal
+import qubes.events
 import qubes.tests
 import qubes.vm.adminvm
 from unittest import mock
@@ -76,6 +78,7 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
 
     def test_000_suspend_pre(self):
         dom0 = mock.NonCallableMock(spec=qubes.vm.adminvm.AdminVM)
+        dom0.features = {}
 
         running_vm = self.create_mockvm(features={'qrexec': True})
         running_vm.is_running.return_value = True
@@ -95,7 +98,7 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
         self.addCleanup(domains_dict.clear)
         self.app.domains = mock.MagicMock(**{
             '__iter__': lambda _: iter(domains_dict.values()),
-            '__getitem__': domains_dict.get,
+            '__getitem__': lambda _, key: domains_dict[key],
         })
 
         ret = self.call_mgmt_func(b'internal.SuspendPre')
@@ -119,6 +122,7 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
 
     def test_001_suspend_post(self):
         dom0 = mock.NonCallableMock(spec=qubes.vm.adminvm.AdminVM)
+        dom0.features = {}
 
         running_vm = self.create_mockvm(features={'qrexec': True})
         running_vm.is_running.return_value = True
@@ -141,7 +145,7 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
         self.addCleanup(domains_dict.clear)
         self.app.domains = mock.MagicMock(**{
             '__iter__': lambda _: iter(domains_dict.values()),
-            '__getitem__': domains_dict.get,
+            '__getitem__': lambda _, key: domains_dict[key],
         })
 
         ret = self.call_mgmt_func(b'internal.SuspendPost')
@@ -162,3 +166,276 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
             no_qrexec_vm.mock_calls)
         self.assertIn(('resume', (), {}),
             no_qrexec_vm.mock_calls)
+
+    def create_slow_vms(self, dom0_features, count=4, delay=0.05):
+        dom0 = mock.NonCallableMock(spec=qubes.vm.adminvm.AdminVM)
+        dom0.features = dom0_features
+        log = []
+        vms = []
+        procs = []
+        for i in range(count):
+            vm = self.create_mockvm(features={'qrexec': True})
+            vm.name = 'vm{}'.format(i)
+            vm.is_running.return_value = True
+
+            @asyncio.coroutine
+            def wait(name=vm.name):
+                log.append(('begin', name))
+                yield from asyncio.sleep(delay)
+                log.append(('end', name))
+            proc = mock.Mock()
+            proc.wait = wait
+            vm.run_service = mock_coro(mock.Mock(return_value=proc))
+            vms.append(vm)
+            procs.append(proc)
+
+        domains_dict = {'dom0': dom0}
+        domains_dict.update((vm.name, vm) for vm in vms)
+        self.addCleanup(domains_dict.clear)
+        self.app.domains = mock.MagicMock(**{
+            '__iter__': lambda _: iter(domains_dict.values()),
+            '__getitem__': lambda _, key: domains_dict[key],
+        })
+        return vms, procs, log
+
+    def test_002_suspend_pre_parallel(self):
+        vms, _, log = self.create_slow_vms({'suspend-max-concurrency': '2'})
+        ret = self.call_mgmt_func(b'internal.SuspendPre')
+        self.assertIsNone(ret)
+        running = max_running = 0
+        for event, _ in log:
+            running += 1 if event == 'begin' else -1
+            max_running = max(running, max_running)
+        self.assertEqual(max_running, 2)
+        self.assertEqual(len(log), 8)
+        for vm in vms:
+            self.assertIn(('suspend', (), {}), vm.mock_calls)
+        self.assertFalse(self.app.log.warning.called)
+
+    def test_003_suspend_pre_timeout(self):
+        vms, procs, log = self.create_slow_vms({'suspend-timeout': '0.1'})
+        @asyncio.coroutine
+        def wait_forever():
+            yield from asyncio.sleep(10)
+        procs[1].wait = wait_forever
+        ret = self.call_mgmt_func(b'internal.SuspendPre')
+        self.assertIsNone(ret)
+        self.assertEqual(len(log), 6)
+        procs[1].kill.assert_called_once_with()
+        self.assertFalse(procs[0].kill.called)
+        self.app.log.warning.assert_called_once_with(
+            'Timeout while trying to %s: %s', 'run qubes.SuspendPreAll',
+            'vm1')
+        # VMs are suspended even if the notification timed out
+        for vm in vms:
+            self.assertIn(('suspend', (), {}), vm.mock_calls)
+
+    def test_004_suspend_post_parallel(self):
+        vms, _, log = self.create_slow_vms({})
+        for vm in vms:
+            vm.get_power_state.return_value = 'Suspended'
+        ret = self.call_mgmt_func(b'internal.SuspendPost')
+        self.assertIsNone(ret)
+        self.assertEqual([event for event, _ in log],
+            ['begin'] * 4 + ['end'] * 4)
+        for vm in vms:
+            self.assertIn(('resume', (), {}), vm.mock_calls)
+
+    def test_005_suspend_pre_invalid_concurrency(self):
+        for value in ('0', '-1'):
+            with self.subTest(value):
+                self.app.log.reset_mock()
+                vms, _, log = self.create_slow_vms(
+                    {'suspend-max-concurrency': value})
+                ret = self.call_mgmt_func(b'internal.SuspendPre')
+                self.assertIsNone(ret)
+                self.assertEqual([event for event, _ in log],
+                    ['begin', 'end'] * 4)
+                self.app.log.warning.assert_called_with(
+                    'Too low value of %s feature: %s, using %s',
+                    'suspend-max-concurrency', int(value), 1)
+                for vm in vms:
+                    self.assertIn(('suspend', (), {}), vm.mock_calls)
+
+    def test_006_suspend_pre_invalid_setting(self):
+        vms, _, log = self.create_slow_vms(
+            {'suspend-max-concurrency': 'many'})
+        ret = self.call_mgmt_func(b'internal.SuspendPre')
+        self.assertIsNone(ret)
+        self.assertEqual(len(log), 8)
+        self.app.log.warning.assert_called_with(
+            'Invalid value of %s feature: %r, using %s',
+            'suspend-max-concurrency', 'many',
+            qubes.config.defaults['suspend_max_concurrency'])
+        for vm in vms:
+            self.assertIn(('suspend', (), {}), vm.mock_calls)
+
+
+class TestLabel:
+    def __init__(self, icon):
+        self.icon = icon
+
+
+class TestVM(qubes.events.Emitter):
+    def __init__(self, name, label='red', tags=()):
+        super().__init__()
+        self.events_enabled = True
+        self.name = name
+        self.label = TestLabel('appvm-' + label)
+        self.tags = set(tags)
+        self.template_for_dispvms = False
+        self.default_dispvm = None
+
+    def __str__(self):
+        return self.name
+
+
+class TestDomains(dict):
+    def __iter__(self):
+        return iter(self.values())
+
+
+class TestApp(qubes.events.Emitter):
+    def __init__(self):
+        super().__init__()
+        self.events_enabled = True
+        self.domains = TestDomains()
+
+    def add_vm(self, vm):
+        self.domains[vm.name] = vm
+        self.fire_event('domain-add', vm=vm)
+
+    def remove_vm(self, name):
+        vm = self.domains.pop(name)
+        self.fire_event('domain-delete', vm=vm)
+
+
+class TC_10_SystemInfo(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = TestApp()
+        self.dom0 = TestVM('dom0', label='black')
+        self.app.domains['dom0'] = self.dom0
+        self.vm = TestVM('test-vm', tags=('tag1',))
+        self.app.domains['test-vm'] = self.vm
+
+    def call_mgmt_func(self, method, arg=b''):
+        mgmt_obj = qubes.api.internal.QubesInternalAPI(self.app,
+            b'dom0', method, b'dom0', arg)
+        return self.loop.run_until_complete(
+            mgmt_obj.execute(untrusted_payload=b''))
+
+    def expected_info(self, vm):
+        return {
+            'tags': list(vm.tags),
+            'type': 'TestVM',
+            'template_for_dispvms': vm.template_for_dispvms,
+            'default_dispvm': (str(vm.default_dispvm)
+                if vm.default_dispvm else None),
+            'icon': vm.label.icon,
+        }
+
+    def get_system_info(self):
+        return json.loads(self.call_mgmt_func(b'internal.GetSystemInfo'))
+
+    def get_changes(self, since):
+        return json.loads(self.call_mgmt_func(
+            b'internal.GetSystemInfoChanges', str(since).encode()))
+
+    def test_000_get_system_info(self):
+        self.assertEqual(self.get_system_info(), {'domains': {
+            'dom0': self.expected_info(self.dom0),
+            'test-vm': self.expected_info(self.vm),
+        }})
+
+    def test_001_cached(self):
+        first = self.call_mgmt_func(b'internal.GetSystemInfo')
+        # not watched attribute, not visible until some event
+        self.vm.label = TestLabel('appvm-green')
+        self.assertIs(self.call_mgmt_func(b'internal.GetSystemInfo'), first)
+        self.vm.fire_event('property-set:label', name='label',
+            newvalue=self.vm.label)
+        self.assertEqual(
+            self.get_system_info()['domains']['test-vm']['icon'],
+            'appvm-green')
+
+    def test_002_tags(self):
+        self.get_system_info()
+        self.vm.tags.add('tag2')
+        self.vm.fire_event('domain-tag-add:tag2', tag='tag2')
+        self.assertEqual(
+            sorted(self.get_system_info()['domains']['test-vm']['tags']),
+            ['tag1', 'tag2'])
+        self.vm.tags.remove('tag1')
+        self.vm.fire_event('domain-tag-delete:tag1', tag='tag1')
+        self.assertEqual(
+            self.get_system_info()['domains']['test-vm']['tags'], ['tag2'])
+
+    def test_003_add_remove(self):
+        self.get_system_info()
+        new_vm = TestVM('new-vm')
+        self.app.add_vm(new_vm)
+        self.assertEqual(self.get_system_info()['domains']['new-vm'],
+            self.expected_info(new_vm))
+        self.app.remove_vm('new-vm')
+        self.assertNotIn('new-vm', self.get_system_info()['domains'])
+        # not watched anymore
+        new_vm.fire_event('domain-tag-add:tag2', tag='tag2')
+        self.assertNotIn('new-vm', self.get_system_info()['domains'])
+
+    def test_004_app_default_dispvm(self):
+        self.get_system_info()
+        self.vm.default_dispvm = self.dom0
+        self.app.fire_event('property-set:default_dispvm',
+            name='default_dispvm', newvalue=self.dom0)
+        self.assertEqual(
+            self.get_system_info()['domains']['test-vm']['default_dispvm'],
+            'dom0')
+
+    def test_010_changes_initial(self):
+        changes = self.get_changes(0)
+        self.assertEqual(changes, {
+            'generation': 1,
+            'full': False,
+            'domains': {
+                'dom0': self.expected_info(self.dom0),
+                'test-vm': self.expected_info(self.vm),
+            }})
+        self.assertEqual(self.get_changes(1), {
+            'generation': 1, 'full': False, 'domains': {}})
+
+    def test_011_changes(self):
+        generation = self.get_changes(0)['generation']
+        new_vm = TestVM('new-vm')
+        self.app.add_vm(new_vm)
+        self.vm.tags.add('tag2')
+        self.vm.fire_event('domain-tag-add:tag2', tag='tag2')
+        changes = self.get_changes(generation)
+        self.assertEqual(changes['generation'], generation + 2)
+        self.assertEqual(changes['domains'], {
+            'new-vm': self.expected_info(new_vm),
+            'test-vm': self.expected_info(self.vm),
+        })
+        generation = changes['generation']
+        self.app.remove_vm('new-vm')
+        self.assertEqual(self.get_changes(generation), {
+            'generation': generation + 1,
+            'full': False,
+            'domains': {'new-vm': None}})
+
+    def test_012_changes_no_change(self):
+        generation = self.get_changes(0)['generation']
+        # event without actual change
+        self.vm.fire_event('property-set:label', name='label',
+            newvalue=self.vm.label)
+        self.assertEqual(self.get_changes(generation)['generation'],
+            generation)
+
+    def test_013_changes_from_future(self):
+        changes = self.get_changes(100)
+        self.assertTrue(changes['full'])
+        self.assertEqual(sorted(changes['domains']), ['dom0', 'test-vm'])
+
+    def test_014_changes_invalid(self):
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'internal.GetSystemInfoChanges', b'-1')
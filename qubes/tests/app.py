@@ -20,13 +20,19 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import asyncio
 import os
+import threading
+import time
 import unittest.mock as mock
 
+import libvirt
 import lxml.etree
 
 import qubes
+import qubes.app
 import qubes.events
+import qubes.utils
 
 import qubes.tests
 import qubes.tests.init
@@ -37,6 +43,121 @@ class TestApp(qubes.tests.TestEmitter):
     pass
 
 
+class SlowDomain:
+    def __init__(self, name, log, lock):
+        self.name = name
+        self.log = log
+        self.lock = lock
+
+    def suspend(self, delay=0.05):
+        with self.lock:
+            self.log.append(('begin', self.name))
+        time.sleep(delay)
+        with self.lock:
+            self.log.append(('end', self.name))
+        return threading.current_thread()
+
+    def destroy(self):
+        raise ValueError('failed')
+
+
+class TC_10_AsyncVirDomainWrapper(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.log = []
+        lock = threading.Lock()
+        self.domains = [
+            qubes.app.AsyncVirDomainWrapper(SlowDomain(name, self.log, lock))
+            for name in ('vm1', 'vm2')]
+
+    def test_000_call(self):
+        thread = self.loop.run_until_complete(self.domains[0].suspend())
+        self.assertIsNot(thread, threading.current_thread())
+        self.assertEqual(self.log, [('begin', 'vm1'), ('end', 'vm1')])
+
+    def test_001_exception(self):
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(self.domains[0].destroy())
+
+    def test_010_same_domain_serialized(self):
+        self.loop.run_until_complete(asyncio.gather(
+            self.domains[0].suspend(), self.domains[0].suspend()))
+        self.assertEqual(self.log, [('begin', 'vm1'), ('end', 'vm1')] * 2)
+
+    def test_011_different_domains_parallel(self):
+        self.loop.run_until_complete(asyncio.gather(
+            self.domains[0].suspend(), self.domains[1].suspend()))
+        self.assertEqual([event for event, _ in self.log],
+            ['begin', 'begin', 'end', 'end'])
+
+    def test_012_for_domain_shared(self):
+        domain = self.domains[0].domain
+        wrapper = qubes.app.AsyncVirDomainWrapper.for_domain(domain)
+        self.assertIs(qubes.app.AsyncVirDomainWrapper.for_domain(domain),
+            wrapper)
+        self.assertIsNot(qubes.app.AsyncVirDomainWrapper.for_domain(
+            self.domains[1].domain), wrapper)
+
+    def test_020_loop_not_blocked(self):
+        monitor = qubes.utils.LoopLagMonitor(interval=0.01, loop=self.loop)
+        monitor.start()
+        self.loop.run_until_complete(self.domains[0].suspend(0.3))
+        monitor.stop()
+        stats = monitor.get_stats()
+        self.assertGreater(stats['count'], 5)
+        self.assertLess(stats['max'], 0.2)
+
+    def test_021_loop_lag_measured(self):
+        log = mock.Mock()
+        monitor = qubes.utils.LoopLagMonitor(interval=0.01, threshold=0.1,
+            log=log, loop=self.loop)
+        monitor.start()
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        # blocking call in the event loop
+        self.loop.call_soon(time.sleep, 0.3)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        monitor.stop()
+        self.assertGreaterEqual(monitor.get_stats()['max'], 0.2)
+        self.assertTrue(log.warning.called)
+
+
+class TC_11_VirConnectWrapper(qubes.tests.QubesTestCase):
+    def test_000_reconnect_cb_in_loop(self):
+        old_conn = mock.Mock()
+        old_conn.isAlive.return_value = False
+        old_conn.listDomainsID.side_effect = libvirt.libvirtError('dead')
+        new_conn = mock.Mock()
+        new_conn.listDomainsID.return_value = [0]
+        calls = []
+        def reconnect_cb(conn):
+            calls.append((conn, threading.current_thread()))
+            self.assertFalse(conn.close.called)
+        with mock.patch('libvirt.open', create=True,
+                side_effect=[old_conn, new_conn]):
+            conn = qubes.app.VirConnectWrapper('xen:///',
+                reconnect_cb=reconnect_cb)
+            result = self.loop.run_until_complete(
+                self.loop.run_in_executor(None, conn.listDomainsID))
+        self.assertEqual(result, [0])
+        self.assertEqual(calls, [(old_conn, threading.current_thread())])
+        old_conn.close.assert_called_once_with()
+
+    def test_001_reconnect_cb_outside_loop(self):
+        old_conn = mock.Mock()
+        old_conn.isAlive.return_value = False
+        old_conn.listDomainsID.side_effect = libvirt.libvirtError('dead')
+        new_conn = mock.Mock()
+        new_conn.listDomainsID.return_value = [0]
+        reconnect_cb = mock.Mock()
+        with mock.patch('libvirt.open', create=True,
+                side_effect=[old_conn, new_conn]):
+            conn = qubes.app.VirConnectWrapper('xen:///',
+                reconnect_cb=reconnect_cb)
+            self.assertEqual(conn.listDomainsID(), [0])
+        reconnect_cb.assert_called_once_with(old_conn)
+        old_conn.close.assert_called_once_with()
+
+
 class TC_20_QubesHost(qubes.tests.QubesTestCase):
     sample_xc_domain_getinfo = [
         {'paused': 0, 'cpu_time': 243951379111104, 'ssidref': 0,
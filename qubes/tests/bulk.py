@@ -0,0 +1,408 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import socket
+from unittest import mock
+
+import qubes.bulk
+import qubes.exc
+import qubes.tests
+
+
+class TestDevice:
+    def __init__(self, backend_domain):
+        self.backend_domain = backend_domain
+
+
+class TestDeviceCollection:
+    def __init__(self):
+        self.devices = []
+
+    def persistent(self):
+        return self.devices
+
+
+class TestVM:
+    def __init__(self, name, log, netvm=None, memory=400, fail=False):
+        self.name = name
+        self.netvm = netvm
+        self.guivm = None
+        self.memory = memory
+        self.devices = {'block': TestDeviceCollection()}
+        self.template = None
+        self.running = False
+        self.fail = fail
+        self.shutdown_delay = 0.01
+        self.log = mock.Mock()
+        self.events = log
+
+    def __lt__(self, other):
+        return self.name < other.name
+
+    def __repr__(self):
+        return '<TestVM {}>'.format(self.name)
+
+    def is_running(self):
+        return self.running
+
+    @asyncio.coroutine
+    def start(self):
+        self.events.append(('start', self.name))
+        yield from asyncio.sleep(0.01)
+        if self.fail:
+            self.events.append(('fail', self.name))
+            raise qubes.exc.QubesException('failed')
+        self.running = True
+        self.events.append(('started', self.name))
+        return self
+
+    @asyncio.coroutine
+    def shutdown(self, wait=False, timeout=None):
+        if not self.running:
+            raise qubes.exc.QubesVMNotStartedError(self)
+        self.events.append(('shutdown', self.name))
+        if self.fail:
+            raise qubes.exc.QubesVMError(self, 'failed')
+        if timeout is not None and self.shutdown_delay > timeout:
+            yield from asyncio.sleep(timeout)
+            raise qubes.exc.QubesVMShutdownTimeoutError(self)
+        yield from asyncio.sleep(self.shutdown_delay)
+        self.running = False
+        self.events.append(('halted', self.name))
+        return self
+
+    @asyncio.coroutine
+    def kill(self):
+        if not self.running:
+            raise qubes.exc.QubesVMNotStartedError(self)
+        self.events.append(('kill', self.name))
+        self.running = False
+        return self
+
+    def fire_event(self, event, **kwargs):
+        self.events.append((event, self.name, kwargs))
+
+
+class TC_00_BulkStart(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = mock.NonCallableMock()
+        self.app.vmm.offline_mode = True
+        self.events = []
+        self.netvm = TestVM('netvm', self.events)
+        self.firewall = TestVM('firewall', self.events, netvm=self.netvm)
+        self.vms = [TestVM('vm{}'.format(i), self.events, netvm=self.firewall)
+            for i in range(4)]
+
+    def start(self, vms, **kwargs):
+        return self.loop.run_until_complete(
+            qubes.bulk.start_domains(self.app, vms, **kwargs))
+
+    def max_concurrent(self):
+        running = 0
+        max_running = 0
+        for event, _ in self.events:
+            if event == 'start':
+                running += 1
+                max_running = max(max_running, running)
+            else:
+                running -= 1
+        return max_running
+
+    def assertStartedBefore(self, first, second):
+        self.assertLess(self.events.index(('started', first.name)),
+            self.events.index(('start', second.name)))
+
+    def test_000_dependency_graph(self):
+        self.vms[0].guivm = self.netvm
+        self.vms[0].devices['block'].devices.append(TestDevice(self.vms[1]))
+        graph = qubes.bulk.get_dependency_graph([self.vms[0]])
+        self.assertEqual(graph, {
+            self.vms[0]: {self.firewall, self.netvm, self.vms[1]},
+            self.vms[1]: {self.firewall},
+            self.firewall: {self.netvm},
+            self.netvm: set(),
+        })
+
+    def test_010_start_order(self):
+        results = self.start(self.vms)
+        self.assertEqual(results,
+            dict.fromkeys(self.vms + [self.firewall, self.netvm]))
+        self.assertStartedBefore(self.netvm, self.firewall)
+        for vm in self.vms:
+            self.assertStartedBefore(self.firewall, vm)
+            self.assertTrue(vm.running)
+        # all the vm* started at once
+        self.assertEqual(self.max_concurrent(), 4)
+
+    def test_011_max_concurrency(self):
+        self.start(self.vms, max_concurrency=2)
+        self.assertEqual(self.max_concurrent(), 2)
+        self.assertTrue(all(vm.running for vm in self.vms))
+
+    def test_012_memory_budget(self):
+        self.start(self.vms, memory_budget=1000)
+        self.assertEqual(self.max_concurrent(), 2)
+        self.assertTrue(all(vm.running for vm in self.vms))
+
+    def test_013_memory_budget_too_small(self):
+        self.start(self.vms, memory_budget=100)
+        self.assertEqual(self.max_concurrent(), 1)
+        self.assertTrue(all(vm.running for vm in self.vms))
+
+    def test_014_running_needs_no_memory(self):
+        self.netvm.running = True
+        self.firewall.running = True
+        self.vms[0].running = True
+        self.start(self.vms, memory_budget=800)
+        self.assertEqual(self.max_concurrent(), 3)
+
+    def test_020_failed_dependency(self):
+        self.firewall.fail = True
+        other = TestVM('other', self.events)
+        results = self.start(self.vms + [other])
+        self.assertIsNone(results[self.netvm])
+        self.assertIsNone(results[other])
+        self.assertIsInstance(results[self.firewall],
+            qubes.exc.QubesException)
+        for vm in self.vms:
+            self.assertIsInstance(results[vm], qubes.exc.QubesVMError)
+            self.assertIn('firewall', str(results[vm]))
+            self.assertNotIn(('start', vm.name), self.events)
+
+    def test_021_circular_dependency(self):
+        self.netvm.netvm = self.firewall
+        results = self.start([self.vms[0]])
+        self.assertEqual(set(results), {self.vms[0], self.firewall,
+            self.netvm})
+        self.assertTrue(all(isinstance(exc, qubes.exc.QubesVMError)
+            for exc in results.values()))
+        self.assertEqual(self.events, [])
+
+
+class TC_10_BulkShutdown(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = mock.NonCallableMock()
+        self.events = []
+        self.template = TestVM('template', self.events)
+        self.netvm = TestVM('netvm', self.events)
+        self.firewall = TestVM('firewall', self.events, netvm=self.netvm)
+        self.firewall.template = self.template
+        self.vms = [TestVM('vm{}'.format(i), self.events, netvm=self.firewall)
+            for i in range(3)]
+        self.all_vms = [self.template, self.netvm, self.firewall] + self.vms
+        for vm in self.all_vms:
+            vm.running = True
+
+    def shutdown(self, vms, **kwargs):
+        return self.loop.run_until_complete(
+            qubes.bulk.shutdown_domains(self.app, vms, **kwargs))
+
+    def progress(self, vm):
+        return [(event[2]['wave'], event[2]['status'])
+            for event in self.events
+            if event[:2] == ('domain-bulk-shutdown', vm.name)]
+
+    def test_000_waves(self):
+        bulk_shutdown = qubes.bulk.BulkShutdown(self.app, self.all_vms)
+        self.assertEqual(bulk_shutdown.get_waves(), ([
+            self.vms,
+            [self.firewall],
+            [self.netvm, self.template],
+        ], set()))
+
+    def test_001_waves_partial(self):
+        bulk_shutdown = qubes.bulk.BulkShutdown(self.app,
+            [self.vms[0], self.netvm])
+        self.assertEqual(bulk_shutdown.get_waves(),
+            ([[self.netvm, self.vms[0]]], set()))
+
+    def test_010_shutdown(self):
+        results = self.shutdown(self.all_vms)
+        self.assertEqual(results, dict.fromkeys(self.all_vms))
+        self.assertFalse(any(vm.running for vm in self.all_vms))
+        halted_firewall = self.events.index(('halted', 'firewall'))
+        for vm in self.vms:
+            self.assertLess(self.events.index(('halted', vm.name)),
+                self.events.index(('shutdown', 'firewall')))
+            self.assertEqual(self.progress(vm),
+                [(0, 'shutdown'), (0, 'halted')])
+        self.assertLess(halted_firewall,
+            self.events.index(('shutdown', 'netvm')))
+        self.assertLess(halted_firewall,
+            self.events.index(('shutdown', 'template')))
+        self.assertEqual(self.progress(self.netvm),
+            [(2, 'shutdown'), (2, 'halted')])
+
+    def test_011_already_halted(self):
+        self.vms[0].running = False
+        results = self.shutdown(self.vms)
+        self.assertEqual(results, dict.fromkeys(self.vms))
+        self.assertNotIn(('shutdown', 'vm0'), self.events)
+
+    def test_020_failed(self):
+        self.vms[1].fail = True
+        results = self.shutdown(self.all_vms)
+        self.assertIsNone(results[self.vms[0]])
+        self.assertIsInstance(results[self.vms[1]], qubes.exc.QubesVMError)
+        self.assertIn('vm1', str(results[self.firewall]))
+        self.assertIn('firewall', str(results[self.netvm]))
+        self.assertIn('firewall', str(results[self.template]))
+        self.assertTrue(self.firewall.running)
+        self.assertTrue(self.netvm.running)
+        self.assertNotIn(('shutdown', 'firewall'), self.events)
+        self.assertEqual(self.progress(self.vms[1]),
+            [(0, 'shutdown'), (0, 'failed')])
+        self.assertEqual(self.progress(self.firewall), [(1, 'failed')])
+
+    def test_030_timeout(self):
+        self.vms[0].shutdown_delay = 10
+        results = self.shutdown(self.vms, timeout=0.05)
+        self.assertIsInstance(results[self.vms[0]],
+            qubes.exc.QubesVMShutdownTimeoutError)
+        self.assertIsNone(results[self.vms[1]])
+        self.assertTrue(self.vms[0].running)
+
+    def test_031_timeout_kill(self):
+        self.vms[0].shutdown_delay = 10
+        results = self.shutdown(self.all_vms, timeout=0.05, kill=True)
+        self.assertEqual(results, dict.fromkeys(self.all_vms))
+        self.assertFalse(self.vms[0].running)
+        self.assertIn(('kill', 'vm0'), self.events)
+        self.assertEqual(self.progress(self.vms[0]),
+            [(0, 'shutdown'), (0, 'kill'), (0, 'halted')])
+
+
+class TC_20_AutostartScheduler(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = mock.NonCallableMock()
+        self.app.vmm.offline_mode = True
+        self.events = []
+        self.netvm = TestVM('netvm', self.events)
+        self.netvm.provides_network = True
+        self.vms = [TestVM('vm{}'.format(i), self.events) for i in range(3)]
+        self.vms[0].netvm = self.netvm
+        for vm in self.vms + [self.netvm]:
+            vm.autostart = True
+
+    def test_000_get_autostart_vms(self):
+        self.vms[1].autostart = False
+        self.app.domains = [self.vms[2], self.vms[1], self.netvm, self.vms[0]]
+        self.assertEqual(qubes.bulk.get_autostart_vms(self.app),
+            [self.netvm, self.vms[0], self.vms[2]])
+
+    def test_001_concurrency(self):
+        self.assertEqual(qubes.bulk.AutostartScheduler.get_concurrency(
+            self.vms, 1000), 2)
+        self.assertEqual(qubes.bulk.AutostartScheduler.get_concurrency(
+            self.vms, 100), 1)
+        self.assertEqual(qubes.bulk.AutostartScheduler.get_concurrency(
+            self.vms, 100000), qubes.bulk.AUTOSTART_MAX_CONCURRENCY)
+        self.assertEqual(qubes.bulk.AutostartScheduler.get_concurrency(
+            self.vms, None), qubes.bulk.AUTOSTART_MAX_CONCURRENCY)
+
+    def test_002_qmemman_free_memory(self):
+        self.app.vmm.offline_mode = False
+        status = {
+            'xen_free_memory': 1000 * 1024 ** 2,
+            'reserve': 100 * 1024 ** 2,
+            'reserved_memory': 200 * 1024 ** 2,
+            'domains': {
+                '0': {'memory_actual': 4000 * 1024 ** 2,
+                    'prefmem': 3000 * 1024 ** 2},
+                '1': {'memory_actual': 400 * 1024 ** 2,
+                    'prefmem': 500 * 1024 ** 2},
+                '2': {'memory_actual': 400 * 1024 ** 2},
+            },
+        }
+        with mock.patch('qubes.qmemman.client.QMemmanClient.get_status',
+                return_value=status):
+            self.assertEqual(qubes.bulk.get_qmemman_free_memory(self.app),
+                1700)
+            scheduler = qubes.bulk.AutostartScheduler(self.app, self.vms)
+        self.assertEqual(scheduler.memory_budget, 1700)
+
+    def test_003_qmemman_not_running(self):
+        self.app.vmm.offline_mode = False
+        self.app.host.memory_total = 2000 * 1024
+        self.app.domains = self.vms
+        with mock.patch('qubes.qmemman.client.QMemmanClient.get_status',
+                side_effect=FileNotFoundError):
+            self.assertIsNone(qubes.bulk.get_qmemman_free_memory(self.app))
+            scheduler = qubes.bulk.AutostartScheduler(self.app, self.vms)
+        self.assertEqual(scheduler.memory_budget, 2000)
+        self.assertTrue(self.app.log.warning.called)
+
+    def test_004_qmemman_timeout(self):
+        self.app.vmm.offline_mode = False
+        self.app.host.memory_total = 2000 * 1024
+        self.app.domains = self.vms
+        with mock.patch('qubes.qmemman.client.QMemmanClient.get_status',
+                side_effect=socket.timeout('timed out')):
+            scheduler = qubes.bulk.AutostartScheduler(self.app, self.vms)
+        self.assertEqual(scheduler.memory_budget, 2000)
+        self.assertTrue(self.app.log.warning.called)
+
+    def test_010_network_first(self):
+        scheduler = qubes.bulk.AutostartScheduler(self.app,
+            self.vms[1:] + [self.netvm], memory_budget=400)
+        self.assertEqual(scheduler.max_concurrency, 1)
+        results = self.loop.run_until_complete(scheduler.execute())
+        self.assertEqual(results, dict.fromkeys(self.vms[1:] + [self.netvm]))
+        self.assertEqual([vm for vm, _, _, _ in scheduler.report],
+            [self.netvm, self.vms[1], self.vms[2]])
+        for _, start, end, error in scheduler.report:
+            self.assertLessEqual(start, end)
+            self.assertIsNone(error)
+        self.assertRegex(scheduler.format_report(),
+            r'^status=finished elapsed=[0-9.]+\n'
+            r'netvm start=[0-9.]+ end=[0-9.]+ result=ok\n'
+            r'vm1 start=[0-9.]+ end=[0-9.]+ result=ok\n'
+            r'vm2 start=[0-9.]+ end=[0-9.]+ result=ok\n$')
+
+    def test_011_failed(self):
+        self.netvm.fail = True
+        scheduler = qubes.bulk.AutostartScheduler(self.app,
+            [self.vms[0]], memory_budget=None)
+        self.loop.run_until_complete(scheduler.execute())
+        self.assertRegex(scheduler.format_report(),
+            r'^status=finished elapsed=[0-9.]+\n'
+            r'netvm start=[0-9.]+ end=[0-9.]+ result=failed\n'
+            r'vm0 result=failed\n$')
+
+    def test_020_wait_for(self):
+        scheduler = qubes.bulk.AutostartScheduler(self.app, self.vms,
+            memory_budget=400)
+        other = TestVM('other', self.events)
+        self.assertEqual(scheduler.format_report(),
+            'status=pending elapsed=0.000\n')
+        self.assertTrue(scheduler.is_pending(self.vms[2]))
+        self.assertFalse(scheduler.is_pending(other))
+
+        @asyncio.coroutine
+        def wait_for_vm2():
+            yield from scheduler.wait_for(self.vms[2])
+            self.events.append(('waited', 'vm2'))
+
+        self.loop.run_until_complete(asyncio.gather(
+            scheduler.execute(), wait_for_vm2()))
+        self.assertEqual(self.events[-2:],
+            [('started', 'vm2'), ('waited', 'vm2')])
+        self.assertFalse(scheduler.is_pending(self.vms[2]))
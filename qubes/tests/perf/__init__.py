@@ -0,0 +1,93 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Benchmarks of core components.
+
+Modules in this package are not unit tests. They are meant to be run
+manually (``python3 -m qubes.tests.perf.<module>``) and do not need Xen.
+'''
+
+import collections
+import math
+
+
+def percentile(values, fraction):
+    '''Return a percentile of *values*, using nearest-rank method
+
+    :param list values: sorted list of numbers
+    :param float fraction: the percentile, as a number between 0 and 1
+    '''
+    if not values:
+        return float('nan')
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+class Stats:
+    '''Latency statistics, grouped by an arbitrary key (like method name)'''
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def add(self, key, latency, error=False):
+        '''Record a single call
+
+        :param str key: grouping key
+        :param float latency: duration of the call, in seconds
+        :param bool error: was the call unsuccessful?
+        '''
+        self.latencies[key].append(latency)
+        if error:
+            self.errors[key] += 1
+
+    def update(self, other):
+        '''Merge statistics from *other* :py:class:`Stats` object'''
+        for key, latencies in other.latencies.items():
+            self.latencies[key].extend(latencies)
+        self.errors.update(other.errors)
+
+    def __len__(self):
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    def summary(self, elapsed):
+        '''Return list of ``(key, count, errors, p50, p99, throughput)``
+
+        Latencies are in seconds, throughput in calls per second of
+        *elapsed* time.
+        '''
+        result = []
+        for key in sorted(self.latencies):
+            latencies = sorted(self.latencies[key])
+            result.append((key, len(latencies), self.errors[key],
+                percentile(latencies, 0.5), percentile(latencies, 0.99),
+                len(latencies) / elapsed if elapsed else float('nan')))
+        return result
+
+    def format(self, elapsed, title='key'):
+        '''Format :py:meth:`summary` as a table'''
+        width = max([len(title)] + [len(key) for key in self.latencies])
+        lines = ['{:{width}} {:>8} {:>6} {:>10} {:>10} {:>10}'.format(
+            title, 'count', 'errors', 'p50 [ms]', 'p99 [ms]', 'per sec',
+            width=width)]
+        for key, count, errors, p50, p99, throughput in self.summary(elapsed):
+            lines.append(
+                '{:{width}} {:8d} {:6d} {:10.3f} {:10.3f} {:10.1f}'.format(
+                    key, count, errors, p50 * 1000, p99 * 1000, throughput,
+                    width=width))
+        lines.append('total: {} calls in {:.3f} s ({:.1f} per sec)'.format(
+            len(self), elapsed, len(self) / elapsed if elapsed else 0))
+        return '\n'.join(lines)
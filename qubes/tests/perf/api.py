@@ -0,0 +1,292 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Load test of qubesd API servers.
+
+Servers are started with :py:func:`qubes.api.create_servers` in a temporary
+directory, backed by an offline :py:class:`qubes.Qubes` object populated
+with synthetic qubes. In offline mode libvirt is never contacted (all qubes
+are halted) and there are no QubesDB connections, so this runs on any Linux
+machine without Xen. Clients run in a separate process and talk to the
+servers over the UNIX sockets, just like real Admin API clients do.
+
+Request mix is either synthetic (see :py:data:`SYNTHETIC_MIX`) or replayed
+from a file, where each line is ``SRC METHOD DEST [ARG]``.
+
+Example::
+
+    python3 -m qubes.tests.perf.api --vms 200 --clients 32 --requests 20000
+'''
+
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import qubes
+import qubes.api
+import qubes.api.admin
+import qubes.api.internal
+import qubes.api.misc
+import qubes.tests.perf
+
+#: API classes to serve
+API_CLASSES = (
+    qubes.api.admin.QubesAdminAPI,
+    qubes.api.internal.QubesInternalAPI,
+    qubes.api.misc.QubesMiscAPI,
+)
+
+#: synthetic request mix: ``(weight, method, dest, arg)``; *dest* ``None``
+#: means a random qube other than dom0, *arg* ``None`` means a random tag of
+#: that qube
+SYNTHETIC_MIX = (
+    (10, 'admin.vm.List', 'dom0', ''),
+    (5, 'admin.vm.List', None, ''),
+    (20, 'admin.vm.property.Get', None, 'label'),
+    (10, 'admin.vm.property.Get', None, 'netvm'),
+    (10, 'admin.vm.property.Get', None, 'qid'),
+    (5, 'admin.vm.property.List', None, ''),
+    (10, 'admin.vm.tag.List', None, ''),
+    (5, 'admin.vm.tag.Get', None, None),
+    (5, 'admin.vm.feature.List', None, ''),
+    (5, 'admin.vm.feature.CheckWithTemplate', None, 'qrexec'),
+    (5, 'admin.label.List', 'dom0', ''),
+    (10, 'internal.GetSystemInfo', 'dom0', ''),
+)
+
+
+def create_app(store, vms=100, templates=5, seed=None):
+    '''Create offline :py:class:`qubes.Qubes` with synthetic qubes
+
+    :param str store: path to the qubes.xml file (will be created)
+    :param int vms: number of AppVMs
+    :param int templates: number of TemplateVMs
+    '''
+    rng = random.Random(seed)
+    app = qubes.Qubes.create_empty_store(store, offline_mode=True)
+    labels = [label.name for label in app.labels.values()]
+    # no kernels in the test environment
+    app.default_kernel = None
+
+    template_list = [
+        app.add_new_vm('TemplateVM', name='template-{}'.format(i),
+            label='black')
+        for i in range(templates)]
+    for template in template_list:
+        template.features['qrexec'] = True
+    app.default_template = template_list[0]
+
+    netvm = app.add_new_vm('AppVM', name='sys-net', label='red',
+        template=template_list[0], provides_network=True, netvm=None)
+    firewallvm = app.add_new_vm('AppVM', name='sys-firewall', label='green',
+        template=template_list[0], provides_network=True, netvm=netvm)
+    app.default_netvm = firewallvm
+
+    for i in range(vms):
+        vm = app.add_new_vm('AppVM', name='vm-{}'.format(i),
+            label=rng.choice(labels),
+            template=rng.choice(template_list))
+        for tag_idx in range(rng.randint(0, 5)):
+            vm.tags.add('tag-{}'.format(tag_idx))
+        vm.features['service.feature-{}'.format(i % 10)] = True
+
+    app.save()
+    return app
+
+
+def synthetic_requests(app, count, seed=None):
+    '''Generate *count* requests ``(src, method, dest, arg)`` from dom0
+    according to :py:data:`SYNTHETIC_MIX`'''
+    rng = random.Random(seed)
+    names = [vm.name for vm in app.domains if vm.qid != 0]
+    weights = [entry[0] for entry in SYNTHETIC_MIX]
+    for _ in range(count):
+        _, method, dest, arg = rng.choices(SYNTHETIC_MIX, weights)[0]
+        if dest is None:
+            dest = rng.choice(names)
+        if arg is None:
+            tags = sorted(app.domains[dest].tags)
+            arg = rng.choice(tags) if tags else 'no-tag'
+        yield ('dom0', method, dest, arg)
+
+
+def load_requests(path):
+    '''Load recorded requests, one ``SRC METHOD DEST [ARG]`` per line'''
+    requests = []
+    with open(path) as requests_file:
+        for line in requests_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) == 3:
+                fields.append('')
+            requests.append(tuple(fields))
+    return requests
+
+
+def get_api_classes(sockdir):
+    '''Return subclasses of :py:data:`API_CLASSES` listening in *sockdir*'''
+    return [type(cls.__name__, (cls,), {'SOCKNAME': os.path.join(sockdir,
+            os.path.basename(cls.SOCKNAME))})
+        for cls in API_CLASSES]
+
+
+def get_socket(api_classes, method):
+    '''Find the socket serving *method*'''
+    for cls in api_classes:
+        if any(cls.list_methods(method)):
+            return cls.SOCKNAME
+    raise KeyError(method)
+
+
+@asyncio.coroutine
+def call(sockname, src, method, dest, arg):
+    '''Make a single call, return ``True`` if it succeeded'''
+    reader, writer = yield from asyncio.open_unix_connection(sockname)
+    try:
+        writer.write('\0'.join((src, method, dest, arg)).encode('ascii'))
+        writer.write(b'\0')
+        writer.write_eof()
+        response = yield from reader.read()
+    finally:
+        writer.close()
+    return response[:2] == b'0\0'
+
+
+@asyncio.coroutine
+def client(queue, stats):
+    '''Process requests from *queue* until it is empty'''
+    while True:
+        try:
+            sockname, request = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        start = time.perf_counter()
+        try:
+            success = yield from call(sockname, *request)
+        except OSError:
+            success = False
+        stats.add(request[1], time.perf_counter() - start, error=not success)
+
+
+def run_clients(requests, clients):
+    '''Send *requests* (``(sockname, (src, method, dest, arg))``) using
+    *clients* concurrent connections
+
+    This is executed in a separate process, with its own event loop.
+
+    :return: ``(stats, elapsed)``
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        queue = asyncio.Queue(loop=loop)
+        for request in requests:
+            queue.put_nowait(request)
+        stats = qubes.tests.perf.Stats()
+        start = time.perf_counter()
+        loop.run_until_complete(asyncio.gather(
+            *(client(queue, stats) for _ in range(clients)), loop=loop))
+        return stats, time.perf_counter() - start
+    finally:
+        loop.close()
+
+
+@asyncio.coroutine
+def run_benchmark(app, requests, sockdir, clients=16, loop=None, **kwargs):
+    '''Start the servers for *app* in *sockdir* and send *requests*
+
+    *kwargs* are passed to :py:func:`qubes.api.create_servers`.
+
+    :return: ``(stats, elapsed)``
+    '''
+    loop = loop or asyncio.get_event_loop()
+    api_classes = get_api_classes(sockdir)
+    requests = [(get_socket(api_classes, request[1]), request)
+        for request in requests]
+
+    servers = yield from qubes.api.create_servers(*api_classes,
+        app=app, loop=loop, group=None, **kwargs)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(1) as executor:
+            return (yield from loop.run_in_executor(executor,
+                run_clients, requests, clients))
+    finally:
+        for server in servers:
+            server.close()
+        yield from asyncio.wait([
+            asyncio.ensure_future(server.wait_closed(), loop=loop)
+            for server in servers], loop=loop)
+
+
+parser = argparse.ArgumentParser(
+    description='Load test of qubesd API servers')
+parser.add_argument('--vms', type=int, default=100,
+    help='number of synthetic AppVMs (default: %(default)s)')
+parser.add_argument('--templates', type=int, default=5,
+    help='number of synthetic TemplateVMs (default: %(default)s)')
+parser.add_argument('--clients', type=int, default=16,
+    help='number of concurrent clients (default: %(default)s)')
+parser.add_argument('--requests', type=int, default=10000,
+    help='number of synthetic requests (default: %(default)s)')
+parser.add_argument('--replay', metavar='FILE',
+    help='send requests from FILE instead of synthetic ones')
+parser.add_argument('--seed', type=int, default=0,
+    help='seed for synthetic qubes and requests (default: %(default)s)')
+parser.add_argument('--cache-permissions', action='store_true',
+    help='enable admin-permission cache')
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    tmpdir = tempfile.mkdtemp(prefix='qubesd-perf-')
+    loop = asyncio.get_event_loop()
+    app = None
+    try:
+        app = create_app(os.path.join(tmpdir, 'qubes.xml'),
+            vms=args.vms, templates=args.templates, seed=args.seed)
+        if args.replay:
+            requests = load_requests(args.replay)
+        else:
+            requests = list(synthetic_requests(app, args.requests,
+                seed=args.seed))
+
+        permission_cache = None
+        if args.cache_permissions:
+            permission_cache = qubes.api.PermissionCache(app)
+
+        stats, elapsed = loop.run_until_complete(run_benchmark(app,
+            requests, tmpdir, clients=args.clients,
+            permission_cache=permission_cache))
+        print(stats.format(elapsed, title='method'))
+    finally:
+        if app is not None:
+            app.close()
+        loop.close()
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Benchmark of LVM volume start and stop.
+
+Creates volumes in an existing LVM thin pool, like private (kept, with
+revisions) and volatile (recreated at each start) volumes of qubes, then
+starts and stops all of them *iterations* times. Volumes of a qube are
+started (and stopped) concurrently, like qubesd does; by default one qube
+after another, with ``--parallel`` several qubes at the same time, like when
+starting many of them at once. This is done twice: with LVM operations sent
+to long running :program:`lvm shell` processes
+(:py:class:`qubes.storage.lvm.LvmShellPool`) and with :program:`lvm`
+started for each of them.
+
+Unlike other benchmarks here, this one needs root and a real thin pool.
+Volumes are named ``vm-perf-lvm-*`` and are removed at the end.
+
+Example::
+
+    python3 -m qubes.tests.perf.lvm --pool qubes_dom0/vm-pool --volumes 10
+    python3 -m qubes.tests.perf.lvm --pool qubes_dom0/vm-pool --parallel 10
+'''
+
+import argparse
+import asyncio
+import time
+
+import qubes.storage.lvm
+import qubes.tests.perf
+
+#: volume configurations, see :py:class:`qubes.storage.Volume`
+VOLUME_KINDS = {
+    'private': {'rw': True, 'save_on_stop': True, 'revisions_to_keep': 1},
+    'volatile': {'rw': True, 'revisions_to_keep': 0},
+}
+
+
+@asyncio.coroutine
+def create_volumes(pool, count, size):
+    '''Create *count* sets of volumes of each of :py:data:`VOLUME_KINDS` in
+    *pool*, one set for each (simulated) qube
+
+    :return: list of volume lists
+    '''
+    volumes = []
+    for i in range(count):
+        vm_volumes = []
+        for kind, config in VOLUME_KINDS.items():
+            config = dict(config, name=kind, size=size,
+                vid='{}/vm-perf-lvm-{}-{}'.format(pool.volume_group, i, kind))
+            volume = pool.init_volume(None, config)
+            yield from volume.create()
+            vm_volumes.append(volume)
+        volumes.append(vm_volumes)
+    return volumes
+
+
+@asyncio.coroutine
+def timed(stats, key, coro):
+    '''Run *coro* and record its duration as *key* in *stats*'''
+    start = time.perf_counter()
+    try:
+        yield from coro
+    except qubes.storage.StoragePoolException:
+        stats.add(key, time.perf_counter() - start, error=True)
+    else:
+        stats.add(key, time.perf_counter() - start)
+
+
+@asyncio.coroutine
+def run_action(stats, semaphore, vm_volumes, action, mode):
+    '''Start or stop volumes of a qube, concurrently'''
+    with (yield from semaphore):
+        yield from asyncio.gather(*(
+            timed(stats, '{} ({}, {})'.format(action, volume.name, mode),
+                getattr(volume, action)())
+            for volume in vm_volumes))
+
+
+@asyncio.coroutine
+def run_benchmark(volumes, iterations, lvm_shell, parallel):
+    '''Start and stop all *volumes* *iterations* times, volumes of up to
+    *parallel* qubes at a time
+
+    :return: ``(stats, elapsed)``
+    '''
+    qubes.storage.lvm.use_lvm_shell = lvm_shell
+    mode = 'lvm shell' if lvm_shell else 'lvm process'
+    stats = qubes.tests.perf.Stats()
+    semaphore = asyncio.Semaphore(parallel)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for action in ('start', 'stop'):
+            yield from asyncio.gather(*(
+                run_action(stats, semaphore, vm_volumes, action, mode)
+                for vm_volumes in volumes))
+            # like qubesd, which refreshes usage of running qubes
+            qubes.storage.lvm.refresh_cache()
+    return stats, time.perf_counter() - start
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmark of LVM volume start and stop')
+parser.add_argument('--pool', required=True, metavar='VG/POOL',
+    help='existing LVM thin pool to create volumes in')
+parser.add_argument('--volumes', type=int, default=10,
+    help='number of volumes of each kind, that is of qubes '
+        '(default: %(default)s)')
+parser.add_argument('--parallel', type=int, default=1, metavar='N',
+    help='number of qubes whose volumes are started and stopped at the '
+        'same time (default: %(default)s)')
+parser.add_argument('--shells', type=int,
+    default=qubes.storage.lvm.LVM_SHELL_POOL_SIZE,
+    help='number of lvm shell processes (default: %(default)s)')
+parser.add_argument('--iterations', type=int, default=5,
+    help='number of start/stop rounds (default: %(default)s)')
+parser.add_argument('--size', type=int, default=64,
+    help='volume size, in MiB (default: %(default)s)')
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    qubes.storage.lvm.LVM_SHELL_POOL_SIZE = args.shells
+    volume_group, thin_pool = args.pool.split('/', 1)
+    loop = asyncio.get_event_loop()
+    pool = qubes.storage.lvm.ThinPool(name='perf-lvm',
+        volume_group=volume_group, thin_pool=thin_pool)
+    pool.setup()
+    volumes = []
+    try:
+        volumes = loop.run_until_complete(create_volumes(pool,
+            args.volumes, args.size * 1024 ** 2))
+        for lvm_shell in (False, True):
+            stats, elapsed = loop.run_until_complete(run_benchmark(
+                volumes, args.iterations, lvm_shell, args.parallel))
+            print(stats.format(elapsed, title='operation'))
+    finally:
+        for vm_volumes in volumes:
+            for volume in vm_volumes:
+                loop.run_until_complete(volume.remove())
+        loop.close()
+    return 0
+
+
+if __name__ == '__main__':
+    main()
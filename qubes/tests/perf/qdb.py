@@ -0,0 +1,122 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Benchmark of QubesDB entries creation at qube start.
+
+Calls :py:meth:`qubes.vm.qubesvm.QubesVM.create_qdb_entries` (including
+``domain-qdb-create`` handlers of extensions) for every qube of a synthetic
+offline :py:class:`qubes.Qubes` object, with and without
+:py:meth:`qubes.vm.qubesvm.QubesVM.batched_qdb`. QubesDB connections are
+replaced with a fake one, which only counts operations and sleeps for
+*latency* on each of them, to simulate the round trip to qubesdb-daemon.
+All qubes are considered running, so network qubes get firewall entries of
+all connected qubes.
+
+Example::
+
+    python3 -m qubes.tests.perf.qdb --vms 200 --latency 0.05
+'''
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import unittest.mock
+
+import qubes.tests.perf
+import qubes.tests.perf.api
+
+
+class FakeQubesDB:
+    '''QubesDB connection counting write and rm operations'''
+    def __init__(self, latency):
+        self.latency = latency
+        self.ops = 0
+
+    def _op(self):
+        self.ops += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def write(self, path, value):
+        # pylint: disable=unused-argument
+        self._op()
+
+    def rm(self, path):
+        # pylint: disable=unused-argument
+        self._op()
+
+
+def run_benchmark(app, batched, latency=0):
+    '''Create QubesDB entries for all qubes of *app*
+
+    :return: ``(stats, ops, elapsed)``
+    '''
+    stats = qubes.tests.perf.Stats()
+    vms = [vm for vm in app.domains if vm.qid != 0]
+    connections = {vm: FakeQubesDB(latency) for vm in vms}
+    for vm, qdb in connections.items():
+        vm._qdb_connection = qdb  # pylint: disable=protected-access
+    key = 'batched' if batched else 'unbatched'
+    start = time.perf_counter()
+    for vm in vms:
+        vm_start = time.perf_counter()
+        if batched:
+            with vm.batched_qdb(empty=True):
+                vm.create_qdb_entries()
+        else:
+            vm.create_qdb_entries()
+        stats.add(key, time.perf_counter() - vm_start)
+    elapsed = time.perf_counter() - start
+    for vm in vms:
+        vm._qdb_connection = None  # pylint: disable=protected-access
+    return stats, sum(qdb.ops for qdb in connections.values()), elapsed
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmark of QubesDB entries creation at qube start')
+parser.add_argument('--vms', type=int, default=100,
+    help='number of synthetic AppVMs (default: %(default)s)')
+parser.add_argument('--latency', type=float, default=0.05,
+    help='simulated latency of a QubesDB operation, in milliseconds '
+        '(default: %(default)s)')
+parser.add_argument('--seed', type=int, default=0,
+    help='seed for synthetic qubes (default: %(default)s)')
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    tmpdir = tempfile.mkdtemp(prefix='qubesd-perf-')
+    try:
+        app = qubes.tests.perf.api.create_app(
+            os.path.join(tmpdir, 'qubes.xml'), vms=args.vms, seed=args.seed)
+        with unittest.mock.patch('qubes.vm.qubesvm.QubesVM.is_running',
+                lambda self: True):
+            for batched in (False, True):
+                stats, ops, elapsed = run_benchmark(app, batched,
+                    latency=args.latency / 1000)
+                print(stats.format(elapsed, title='mode'))
+                print('QubesDB operations: {}'.format(ops))
+        app.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    main()
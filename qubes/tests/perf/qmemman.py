@@ -0,0 +1,126 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Benchmark of qmemman balance algorithms.
+
+Compares :py:func:`qubes.qmemman.algo.balance` and
+:py:func:`qubes.qmemman.algo.balloon` with their
+:py:class:`~qubes.qmemman.algo.DomainTable` based versions, on synthetic
+domains.
+
+Example::
+
+    python3 -m qubes.tests.perf.qmemman --domains 50 200 1000
+'''
+
+import argparse
+import random
+import time
+
+import qubes.qmemman
+import qubes.qmemman.algo
+
+MiB = 1024 * 1024
+
+
+def create_domains(count, seed=None):
+    '''Create *count* synthetic :py:class:`qubes.qmemman.DomainState`
+    objects (plus dom0), in various states
+
+    :return: dict like :py:attr:`qubes.qmemman.SystemState.domdict`
+    '''
+    rng = random.Random(seed)
+    domdict = {}
+    for domid in range(count + 1):
+        dom = qubes.qmemman.DomainState(str(domid))
+        if domid == 0:
+            dom.memory_maximum = 16000 * MiB
+        else:
+            dom.memory_maximum = rng.choice((1000, 2000, 4000, 8000)) * MiB
+        dom.last_target = rng.randint(200, dom.memory_maximum // MiB) * MiB
+        dom.memory_current = dom.last_target - rng.randint(0, 100) * MiB
+        dom.memory_actual = max(dom.memory_current, dom.last_target)
+        roll = rng.random()
+        if roll < 0.05:
+            # not reported meminfo yet
+            dom.mem_used = None
+        else:
+            dom.mem_used = rng.randint(50, dom.memory_maximum // MiB) * MiB
+            if roll < 0.1:
+                dom.no_progress = True
+        domdict[dom.id] = dom
+    return domdict
+
+
+def create_scenarios(count, domains, seed=None):
+    '''Create *count* ``(xen_free_memory, domdict)`` pairs, with both
+    plenty and too little free memory'''
+    rng = random.Random(seed)
+    return [(rng.randint(-2000, 20000) * MiB,
+            create_domains(domains, seed=rng.random()))
+        for _ in range(count)]
+
+
+def measure(func, scenarios, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for xen_free_memory, domdict in scenarios:
+            func(xen_free_memory, domdict)
+    return (time.perf_counter() - start) / (repeat * len(scenarios))
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmark of qmemman balance algorithms')
+parser.add_argument('--domains', type=int, nargs='+', default=[50, 200, 1000],
+    help='numbers of domains to test (default: %(default)s)')
+parser.add_argument('--scenarios', type=int, default=20,
+    help='number of different domain sets (default: %(default)s)')
+parser.add_argument('--repeat', type=int, default=10,
+    help='number of repetitions of each scenario (default: %(default)s)')
+parser.add_argument('--seed', type=int, default=0,
+    help='seed for synthetic domains (default: %(default)s)')
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    # do not measure formatting of info messages
+    qubes.qmemman.algo.log.disabled = True
+    functions = (
+        ('balance', qubes.qmemman.algo.balance,
+            qubes.qmemman.algo.balance_fast),
+        ('balloon', qubes.qmemman.algo.balloon,
+            qubes.qmemman.algo.balloon_fast),
+    )
+    print('{:>8} {:8} {:>12} {:>12} {:>8}'.format(
+        'domains', 'function', 'dict [ms]', 'table [ms]', 'speedup'))
+    for domains in args.domains:
+        scenarios = create_scenarios(args.scenarios, domains, seed=args.seed)
+        for name, func, func_fast in functions:
+            if name == 'balloon':
+                # request the amount of memory, instead of passing free memory
+                scenarios = [(abs(xen_free_memory), domdict)
+                    for xen_free_memory, domdict in scenarios]
+            time_dict = measure(func, scenarios, args.repeat)
+            time_table = measure(func_fast, scenarios, args.repeat)
+            print('{:8d} {:8} {:12.3f} {:12.3f} {:7.2f}x'.format(
+                domains, name, time_dict * 1000, time_table * 1000,
+                time_dict / time_table))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
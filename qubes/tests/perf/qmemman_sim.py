@@ -0,0 +1,625 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Deterministic simulator of qmemman.
+
+Runs the qmemmand logic (:py:class:`qubes.qmemman.SystemState`,
+:py:class:`qubes.qmemman.BalanceScheduler`,
+:py:class:`qubes.tools.qmemmand.XS_Watcher` and
+:py:class:`qubes.tools.qmemmand.QMemmanServer`) against fake ``xc`` and
+``xs`` objects, on an event loop with virtual time. The simulated domains
+balloon with configurable speed and lag, may refuse to give back memory, and
+report meminfo according to a trace. No Xen is needed and the result depends
+only on the trace and the settings.
+
+Trace is either synthetic (see :py:func:`synthetic_trace`) or read from a
+file, one event per line::
+
+    # TIME domain NAME MEMORY_MB STATIC_MAX_MB [refuse]
+    0 domain dom0 4000 0
+    0 domain work 2000 4000
+    # TIME meminfo NAME USED_MB
+    1.5 meminfo work 1200
+    # TIME start NAME MEMORY_MB BOOT_SECONDS (until the memory is allocated)
+    10 start personal 2000 8
+    # TIME stop NAME
+    60 stop personal
+
+Domain named ``dom0`` (with static-max 0, meaning none) must be defined
+first.
+
+Example::
+
+    python3 -m qubes.tests.perf.qmemman_sim --domains 20 --duration 600 \\
+        --xen-free-mem-left 50 --balloon-delay 0.1
+'''
+
+import argparse
+import asyncio
+import collections
+import heapq
+import json
+import logging
+import os
+import random
+import selectors
+
+import qubes.qmemman
+import qubes.qmemman.algo
+import qubes.tests.perf
+import qubes.tools.qmemmand
+import qubes.vm.qubesvm
+
+MiB = 1024 * 1024
+
+#: parameters of qmemman tunable in the simulation, with their defaults
+#: (*None* means the qmemman default)
+TUNABLES = collections.OrderedDict((
+    ('xen_free_mem_left', None),
+    ('balloon_delay', None),
+    ('cache_factor', None),
+    ('balance_interval', None),
+    ('request_timeout', None),
+    ('batch_window', None),
+    ('reserve_max', None),
+    ('reserve_window', None),
+    # use protocol version 2 reservations instead of holding the lock until
+    # the VM is started
+    ('reservations', False),
+))
+
+
+class VirtualTimeSelector(selectors.DefaultSelector):
+    '''Selector which, instead of waiting, advances virtual time to the next
+    timer of *loop*'''
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if not ready and timeout != 0:
+            when = self.loop.next_timer()
+            if when is None:
+                raise RuntimeError('simulation stalled: nothing scheduled')
+            self.now = max(self.now, when)
+        return ready
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    '''Event loop with virtual time; timers fire immediately, in order'''
+    def __init__(self):
+        self._timers = []
+        self._virtual_selector = VirtualTimeSelector(self)
+        super().__init__(self._virtual_selector)
+
+    def time(self):
+        return self._virtual_selector.now
+
+    def call_at(self, when, callback, *args, **kwargs):
+        handle = super().call_at(when, callback, *args, **kwargs)
+        heapq.heappush(self._timers, handle)
+        return handle
+
+    def next_timer(self):
+        '''Return time of the earliest pending timer, or :py:obj:`None`'''
+        while self._timers and (self._timers[0].cancelled() or
+                self._timers[0].when() <= self.time()):
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return self._timers[0].when()
+
+
+class FakeDomain(object):
+    '''Simulated domain, ballooning towards its target'''
+    def __init__(self, domid, name, memory, static_max, now,
+            speed=500 * MiB, lag=0.05, refuse=False):
+        self.domid = domid
+        self.name = name
+        self.memory = memory
+        self.target = memory
+        self.static_max = static_max
+        #: ballooning speed, in bytes per second
+        self.speed = speed
+        #: delay between setting target and start of ballooning
+        self.lag = lag
+        #: never give memory back
+        self.refuse = refuse
+        #: used memory, as reported in meminfo; the domain cannot balloon
+        #: below it
+        self.used = None
+        self.target_set_at = now
+        self.last_update = now
+
+
+class FakeXen(object):
+    '''Simulated Xen memory and xenstore state, shared by
+    :py:class:`FakeXC` and :py:class:`FakeXS` objects'''
+    def __init__(self, total_memory, clock):
+        self.total_memory = total_memory
+        self.clock = clock
+        self.domains = collections.OrderedDict()
+        self.store = {}
+        self.xs_handles = []
+        self.next_domid = 0
+        self.memset_calls = 0
+        self.memory_moved = 0
+
+    @property
+    def free_memory(self):
+        return self.total_memory - sum(dom.memory
+            for dom in self.domains.values())
+
+    def update(self):
+        '''Move domains' memory towards their targets, up to now'''
+        now = self.clock()
+        # first give back memory, then take it
+        for shrinking in (True, False):
+            for dom in self.domains.values():
+                start = max(dom.last_update, dom.target_set_at + dom.lag)
+                if now <= start or (dom.target < dom.memory) != shrinking:
+                    continue
+                step = int(dom.speed * (now - start))
+                if shrinking:
+                    floor = dom.target
+                    if dom.used is not None:
+                        floor = max(floor, dom.used)
+                    if dom.refuse:
+                        floor = dom.memory
+                    dom.memory = max(floor, dom.memory - step)
+                else:
+                    dom.memory = min(dom.target, dom.memory + step,
+                        dom.memory + max(0, self.free_memory))
+        for dom in self.domains.values():
+            dom.last_update = now
+
+    def write(self, path, value):
+        if isinstance(value, str):
+            value = value.encode('ascii')
+        self.store[path] = value
+        self.fire(path)
+
+    def fire(self, path):
+        for handle in self.xs_handles:
+            handle.fire(path)
+
+    def create_domain(self, name, memory, static_max, **kwargs):
+        self.update()
+        domid = self.next_domid
+        self.next_domid += 1
+        dom = FakeDomain(domid, name, memory, static_max, self.clock(),
+            **kwargs)
+        self.domains[domid] = dom
+        prefix = '/local/domain/{}'.format(domid)
+        self.store[prefix + '/domid'] = str(domid).encode()
+        self.store[prefix + '/memory/target'] = \
+            str(memory // 1024 - 16 * 1024).encode()
+        if static_max:
+            self.store[prefix + '/memory/static-max'] = \
+                str(static_max // 1024).encode()
+        self.fire('@introduceDomain')
+        return dom
+
+    def destroy_domain(self, domid):
+        self.update()
+        del self.domains[domid]
+        prefix = '/local/domain/{}/'.format(domid)
+        for path in [path for path in self.store if path.startswith(prefix)]:
+            del self.store[path]
+        self.fire('@releaseDomain')
+
+    def set_meminfo(self, domid, used):
+        self.update()
+        dom = self.domains[domid]
+        dom.used = used
+        self.write('/local/domain/{}/memory/meminfo'.format(domid),
+            str(used // 1024))
+
+
+class FakeXC(object):
+    '''Replacement for :py:class:`xen.lowlevel.xc.xc`'''
+    def __init__(self, xen):
+        self.xen = xen
+
+    def physinfo(self):
+        self.xen.update()
+        return {
+            'total_memory': self.xen.total_memory // 1024,
+            'free_memory': self.xen.free_memory // 1024,
+        }
+
+    def domain_getinfo(self):
+        self.xen.update()
+        return [{'domid': dom.domid, 'mem_kb': dom.memory // 1024}
+            for dom in self.xen.domains.values()]
+
+    def domain_setmaxmem(self, domid, maxmem_kb):
+        pass
+
+    def domain_set_target_mem(self, domid, target_kb):
+        self.xen.update()
+        dom = self.xen.domains[domid]
+        self.xen.memset_calls += 1
+        self.xen.memory_moved += abs(target_kb * 1024 - dom.target)
+        dom.target = target_kb * 1024
+        dom.target_set_at = self.xen.clock()
+
+
+class FakeXS(object):
+    '''Replacement for :py:class:`xen.lowlevel.xs.xs`
+
+    Like the real one, :py:meth:`fileno` is readable as long as there are
+    watch events to read.
+    '''
+    def __init__(self, xen):
+        self.xen = xen
+        self.watches = []
+        self.events = collections.deque()
+        self.pipe_r, self.pipe_w = os.pipe()
+        xen.xs_handles.append(self)
+
+    def close(self):
+        self.xen.xs_handles.remove(self)
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+    def fileno(self):
+        return self.pipe_r
+
+    def read(self, _transaction, path):
+        return self.xen.store.get(path)
+
+    def write(self, _transaction, path, value):
+        self.xen.write(path, value)
+
+    def ls(self, _transaction, path):
+        prefix = path.rstrip('/') + '/'
+        children = []
+        for key in self.xen.store:
+            if key.startswith(prefix):
+                child = key[len(prefix):].split('/')[0]
+                if child not in children:
+                    children.append(child)
+        return children
+
+    def watch(self, path, token):
+        self.watches.append((path, token))
+        # like xenstored, fire the watch once after registration
+        self.queue(path, token)
+
+    def unwatch(self, path, token):
+        self.watches.remove((path, token))
+
+    def queue(self, path, token):
+        if not self.events:
+            os.write(self.pipe_w, b'x')
+        self.events.append((path, token))
+
+    def fire(self, path):
+        for watch_path, token in self.watches:
+            if path == watch_path or path.startswith(watch_path + '/'):
+                self.queue(path, token)
+
+    def read_watch(self):
+        event = self.events.popleft()
+        if not self.events:
+            os.read(self.pipe_r, 1)
+        return event
+
+
+def synthetic_trace(domains=10, duration=300, start_interval=30,
+        meminfo_interval=2, seed=None):
+    '''Generate trace events ``(time, event, args)``
+
+    *domains* VMs (plus dom0) are running from the beginning, report their
+    memory usage (a random walk) every *meminfo_interval* seconds (on
+    average), and a new VM is started every *start_interval* seconds (on
+    average); every started VM is stopped after a while.
+    '''
+    rng = random.Random(seed)
+    events = [(0, 'domain', ('dom0', 4000, 0))]
+    running = {'dom0': (1500, 4000)}
+    for i in range(domains):
+        name = 'vm{}'.format(i)
+        static_max = rng.choice((2000, 4000, 8000))
+        refuse = 'refuse' if rng.random() < 0.05 else ''
+        events.append((0, 'domain',
+            (name, rng.choice((400, 1000, 2000)), static_max, refuse)))
+        running[name] = (rng.randint(200, 1500), static_max)
+
+    def meminfo_updates(name, used, static_max, start):
+        now = start + rng.uniform(0, meminfo_interval)
+        while now < duration:
+            used = min(max(100, used + int(rng.gauss(0, 50))),
+                int(static_max * 0.9))
+            events.append((round(now, 3), 'meminfo', (name, used)))
+            now += rng.expovariate(1 / meminfo_interval)
+
+    for name, (used, static_max) in running.items():
+        meminfo_updates(name, used, static_max, 0)
+
+    now = rng.expovariate(1 / start_interval)
+    i = 0
+    while now < duration:
+        name = 'new{}'.format(i)
+        memory = rng.choice((400, 1000, 2000))
+        boot = rng.uniform(3, 10)
+        events.append((round(now, 3), 'start', (name, memory, round(boot, 3))))
+        meminfo_updates(name, memory // 2, 4000, now + boot)
+        lifetime = rng.expovariate(1 / (duration / 3))
+        if now + boot + lifetime < duration:
+            events.append((round(now + boot + lifetime, 3), 'stop', (name,)))
+        now += rng.expovariate(1 / start_interval)
+        i += 1
+
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def load_trace(path):
+    '''Load trace events from a file'''
+    events = []
+    with open(path) as trace_file:
+        for line in trace_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            events.append((float(fields[0]), fields[1], tuple(fields[2:])))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+class Simulator(object):
+    '''Run qmemmand logic against simulated Xen
+
+    :param float total_memory: host memory, in bytes
+    :param dict tunables: values of :py:data:`TUNABLES` to override
+    '''
+    def __init__(self, events, total_memory=16000 * MiB, **tunables):
+        self.events = events
+        self.tunables = dict(TUNABLES)
+        self.tunables.update(tunables)
+        self.loop = VirtualTimeLoop()
+        self.xen = FakeXen(total_memory, self.loop.time)
+        self.names = {}
+        self.stats = qubes.tests.perf.Stats()
+        self.system_state = None
+        self.balance_scheduler = None
+        self.server = None
+        #: qmemmand status (as returned over its socket) at the end
+        self.status = None
+
+    @asyncio.coroutine
+    def start_vm(self, name, memory, boot):
+        memsize = memory + qubes.vm.qubesvm.MEM_OVERHEAD_BASE + \
+            2 * qubes.vm.qubesvm.MEM_OVERHEAD_PER_VCPU
+        started = self.loop.time()
+        request, got_memory = yield from self.server.submit(memsize,
+            reservation=self.tunables['reservations'])
+        self.stats.add('request', self.loop.time() - started,
+            error=not got_memory)
+        try:
+            if not got_memory:
+                return
+            # the memory is allocated at the end of domain creation; until
+            # then qmemman must keep it free
+            yield from asyncio.sleep(boot)
+            self.xen.update()
+            if self.xen.free_memory < memory:
+                # qmemman said OK, but the memory isn't really there
+                self.stats.add('overcommit', 0, error=True)
+                return
+            dom = self.xen.create_domain(name, memory, 4000 * MiB)
+            self.names[name] = dom.domid
+        finally:
+            self.server.release(request)
+
+    @asyncio.coroutine
+    def replay(self):
+        tasks = []
+        for when, event, args in self.events:
+            if when > self.loop.time():
+                yield from asyncio.sleep(when - self.loop.time())
+            if event == 'domain':
+                name, memory, static_max = args[:3]
+                dom = self.xen.create_domain(name, int(memory) * MiB,
+                    int(static_max) * MiB,
+                    refuse=(len(args) > 3 and args[3] == 'refuse'))
+                self.names[name] = dom.domid
+            elif event == 'meminfo':
+                name, used = args
+                if name in self.names:
+                    self.xen.set_meminfo(self.names[name], int(used) * MiB)
+            elif event == 'start':
+                name, memory, boot = args
+                tasks.append(asyncio.ensure_future(self.start_vm(name,
+                    int(memory) * MiB, float(boot)), loop=self.loop))
+            elif event == 'stop':
+                name, = args
+                if name in self.names:
+                    self.xen.destroy_domain(self.names.pop(name))
+            else:
+                raise ValueError('Unknown trace event: {}'.format(event))
+        if tasks:
+            yield from asyncio.wait(tasks, loop=self.loop)
+
+    def run(self):
+        '''Run the simulation, return :py:meth:`report`'''
+        qmemmand = qubes.tools.qmemmand
+        saved = (qmemmand.system_state, qmemmand.balance_scheduler,
+            qmemmand.memory_lock, qmemmand.force_refresh_domain_list,
+            qubes.qmemman.algo.CACHE_FACTOR)
+        xs_state = FakeXS(self.xen)
+        xs_watcher = FakeXS(self.xen)
+        tasks = []
+        try:
+            self.system_state = qubes.qmemman.SystemState()
+            self.system_state.init(xc=FakeXC(self.xen), xs=xs_state)
+            if self.tunables['xen_free_mem_left'] is not None:
+                self.system_state.XEN_FREE_MEM_LEFT = \
+                    self.tunables['xen_free_mem_left']
+            if self.tunables['balloon_delay'] is not None:
+                self.system_state.BALOON_DELAY = \
+                    self.tunables['balloon_delay']
+            if self.tunables['cache_factor'] is not None:
+                qubes.qmemman.algo.CACHE_FACTOR = self.tunables['cache_factor']
+            self.balance_scheduler = qubes.qmemman.BalanceScheduler(
+                self.system_state, interval=self.tunables['balance_interval'],
+                clock=self.loop.time)
+            if self.tunables['reserve_max']:
+                self.system_state.reserve_policy = \
+                    qubes.qmemman.ReservePolicy(self.tunables['reserve_max'],
+                        window=self.tunables['reserve_window'],
+                        clock=self.loop.time)
+
+            qmemmand.system_state = self.system_state
+            qmemmand.balance_scheduler = self.balance_scheduler
+            qmemmand.memory_lock = asyncio.Lock(loop=self.loop)
+            qmemmand.force_refresh_domain_list = False
+
+            watcher = qmemmand.XS_Watcher(loop=self.loop, handle=xs_watcher)
+            self.server = qmemmand.QMemmanServer(watcher,
+                request_timeout=self.tunables['request_timeout'],
+                batch_window=self.tunables['batch_window'],
+                loop=self.loop)
+            self.loop.add_reader(xs_watcher.fileno(), watcher.handle_watch)
+            tasks.append(self.loop.create_task(watcher.balance_loop()))
+            tasks.append(self.loop.create_task(self.server.process_requests()))
+
+            self.loop.run_until_complete(self.replay())
+            self.status = self.server.get_status()
+            return self.report()
+        finally:
+            try:
+                for task in tasks:
+                    task.cancel()
+                if tasks:
+                    self.loop.run_until_complete(asyncio.wait(tasks,
+                        loop=self.loop))
+            finally:
+                self.loop.remove_reader(xs_watcher.fileno())
+                self.loop.close()
+            xs_state.close()
+            xs_watcher.close()
+            (qmemmand.system_state, qmemmand.balance_scheduler,
+                qmemmand.memory_lock, qmemmand.force_refresh_domain_list,
+                qubes.qmemman.algo.CACHE_FACTOR) = saved
+
+    def report(self):
+        '''Return simulation results, as a dict'''
+        latencies = sorted(self.stats.latencies['request'])
+        requests = len(latencies)
+        failed = self.stats.errors['request']
+        scheduler_stats = self.balance_scheduler.get_stats()
+        return collections.OrderedDict((
+            ('duration', self.loop.time()),
+            ('requests', requests),
+            ('failed', failed),
+            ('failure_rate', failed / requests if requests else 0.0),
+            ('overcommits', self.stats.errors['overcommit']),
+            ('latency_p50', qubes.tests.perf.percentile(latencies, 0.5)),
+            ('latency_p99', qubes.tests.perf.percentile(latencies, 0.99)),
+            ('latency_max', latencies[-1] if latencies else float('nan')),
+            ('meminfo_updates', scheduler_stats['meminfo_updates']),
+            ('balance_passes', scheduler_stats['balance_passes']),
+            ('memset_calls', self.xen.memset_calls),
+            ('memory_moved_mb', self.xen.memory_moved / MiB),
+        ))
+
+
+def format_report(report):
+    lines = []
+    for key, value in report.items():
+        if isinstance(value, float):
+            lines.append('{:16} {:.3f}'.format(key, value))
+        else:
+            lines.append('{:16} {}'.format(key, value))
+    return '\n'.join(lines)
+
+
+parser = argparse.ArgumentParser(
+    description='Deterministic simulator of qmemman')
+parser.add_argument('--trace', metavar='FILE',
+    help='replay trace from FILE instead of a synthetic one')
+parser.add_argument('--domains', type=int, default=10,
+    help='number of running VMs in synthetic trace (default: %(default)s)')
+parser.add_argument('--duration', type=float, default=300,
+    help='length of synthetic trace, in seconds (default: %(default)s)')
+parser.add_argument('--start-interval', type=float, default=30,
+    help='average interval between VM starts in synthetic trace, in seconds '
+        '(default: %(default)s)')
+parser.add_argument('--seed', type=int, default=0,
+    help='seed for synthetic trace (default: %(default)s)')
+parser.add_argument('--total-memory', type=int, default=32000,
+    help='host memory, in MiB (default: %(default)s)')
+parser.add_argument('--xen-free-mem-left', type=int, metavar='MiB',
+    help='SystemState.XEN_FREE_MEM_LEFT')
+parser.add_argument('--balloon-delay', type=float, metavar='SECONDS',
+    help='SystemState.BALOON_DELAY')
+parser.add_argument('--cache-factor', type=float,
+    help='cache-margin-factor')
+parser.add_argument('--balance-interval', type=float, metavar='SECONDS',
+    help='balance-interval')
+parser.add_argument('--request-timeout', type=float, metavar='SECONDS',
+    help='request-timeout')
+parser.add_argument('--reserve-max', type=int, metavar='MiB',
+    help='reserve-max')
+parser.add_argument('--reserve-window', type=float, metavar='SECONDS',
+    help='reserve-window')
+parser.add_argument('--reservations', action='store_true',
+    help='use protocol version 2 reservations')
+parser.add_argument('--status', action='store_true',
+    help='print final qmemmand status (JSON)')
+parser.add_argument('--verbose', '-v', action='store_true',
+    help='show qmemman log')
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.CRITICAL)
+    if args.trace:
+        events = load_trace(args.trace)
+    else:
+        events = synthetic_trace(domains=args.domains,
+            duration=args.duration, start_interval=args.start_interval,
+            seed=args.seed)
+    tunables = {
+        'balloon_delay': args.balloon_delay,
+        'cache_factor': args.cache_factor,
+        'balance_interval': args.balance_interval,
+        'request_timeout': args.request_timeout,
+        'reserve_window': args.reserve_window,
+        'reservations': args.reservations,
+    }
+    if args.xen_free_mem_left is not None:
+        tunables['xen_free_mem_left'] = args.xen_free_mem_left * MiB
+    if args.reserve_max is not None:
+        tunables['reserve_max'] = args.reserve_max * MiB
+    simulator = Simulator(events, total_memory=args.total_memory * MiB,
+        **tunables)
+    print(format_report(simulator.run()))
+    if args.status:
+        print(json.dumps(simulator.status, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
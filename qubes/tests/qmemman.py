@@ -0,0 +1,862 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import json
+import math
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest.mock
+
+import qubes.qmemman
+import qubes.qmemman.algo
+import qubes.tests
+import qubes.tests.perf.qmemman
+import qubes.tests.perf.qmemman_sim
+import qubes.tools.qmemmand
+
+MiB = 1024 * 1024
+
+
+def create_domain(domid, mem_used, actual, maximum=4000 * MiB,
+        no_progress=False):
+    dom = qubes.qmemman.DomainState(domid)
+    dom.mem_used = mem_used
+    dom.memory_actual = actual
+    dom.memory_current = actual
+    dom.last_target = actual
+    dom.memory_maximum = maximum
+    dom.no_progress = no_progress
+    return dom
+
+
+class TC_00_DomainTable(qubes.tests.QubesTestCase):
+    def test_000_skip_domains(self):
+        domdict = {
+            '0': create_domain('0', 1000 * MiB, 2000 * MiB),
+            '1': create_domain('1', None, 400 * MiB),
+            '2': create_domain('2', 300 * MiB, 400 * MiB, no_progress=True),
+            '3': create_domain('3', 500 * MiB, 400 * MiB),
+        }
+        table = qubes.qmemman.algo.DomainTable(domdict)
+        self.assertEqual(table.ids, ['0', '3'])
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.pref,
+            [qubes.qmemman.algo.prefmem(domdict['0']),
+             qubes.qmemman.algo.prefmem(domdict['3'])])
+        self.assertEqual(table.need,
+            [qubes.qmemman.algo.memory_needed(domdict['0']),
+             qubes.qmemman.algo.memory_needed(domdict['3'])])
+
+
+class TC_10_AlgoEquivalence(qubes.tests.QubesTestCase):
+    '''DomainTable based algorithms must return exactly the same requests'''
+    def assertSameBalance(self, xen_free_memory, domdict):
+        self.assertEqual(
+            qubes.qmemman.algo.balance_fast(xen_free_memory, domdict),
+            qubes.qmemman.algo.balance(xen_free_memory, domdict))
+
+    def assertSameBalloon(self, memsize, domdict):
+        self.assertEqual(
+            qubes.qmemman.algo.balloon_fast(memsize, domdict),
+            qubes.qmemman.algo.balloon(memsize, domdict))
+
+    def test_000_balance_enough_memory(self):
+        domdict = {
+            '0': create_domain('0', 1000 * MiB, 2000 * MiB, 8000 * MiB),
+            '1': create_domain('1', 300 * MiB, 400 * MiB),
+            '2': create_domain('2', 900 * MiB, 800 * MiB),
+        }
+        self.assertSameBalance(4000 * MiB, domdict)
+
+    def test_001_balance_static_max(self):
+        # most domains hit static max, left memory is redistributed
+        domdict = {
+            '0': create_domain('0', 1000 * MiB, 2000 * MiB, 8000 * MiB),
+            '1': create_domain('1', 300 * MiB, 400 * MiB, 500 * MiB),
+            '2': create_domain('2', 900 * MiB, 800 * MiB, 1000 * MiB),
+            '3': create_domain('3', 100 * MiB, 400 * MiB, 600 * MiB),
+        }
+        self.assertSameBalance(20000 * MiB, domdict)
+
+    def test_002_balance_low_on_memory(self):
+        domdict = {
+            '0': create_domain('0', 1000 * MiB, 2000 * MiB, 8000 * MiB),
+            '1': create_domain('1', 1000 * MiB, 400 * MiB),
+            '2': create_domain('2', 100 * MiB, 800 * MiB),
+            '3': create_domain('3', 3000 * MiB, 3000 * MiB),
+        }
+        self.assertSameBalance(0, domdict)
+        self.assertSameBalance(-200 * MiB, domdict)
+
+    def test_003_balance_empty(self):
+        self.assertSameBalance(1000 * MiB, {})
+        self.assertSameBalance(-1000 * MiB, {})
+
+    def test_010_balloon(self):
+        domdict = {
+            '0': create_domain('0', 1000 * MiB, 2000 * MiB, 8000 * MiB),
+            '1': create_domain('1', 100 * MiB, 800 * MiB),
+            '2': create_domain('2', 200 * MiB, 1000 * MiB),
+        }
+        self.assertSameBalloon(100 * MiB, domdict)
+        self.assertNotEqual(qubes.qmemman.algo.balloon_fast(100 * MiB,
+            domdict), ())
+
+    def test_011_balloon_not_enough(self):
+        domdict = {
+            '0': create_domain('0', 1000 * MiB, 2000 * MiB, 8000 * MiB),
+            '1': create_domain('1', 100 * MiB, 800 * MiB),
+        }
+        self.assertSameBalloon(10000 * MiB, domdict)
+        self.assertEqual(qubes.qmemman.algo.balloon_fast(10000 * MiB,
+            domdict), ())
+
+    def test_020_random(self):
+        for domains in (1, 5, 50, 200):
+            for xen_free_memory, domdict in \
+                    qubes.tests.perf.qmemman.create_scenarios(
+                        20, domains, seed=domains):
+                with self.subTest(domains=domains,
+                        xen_free_memory=xen_free_memory):
+                    self.assertSameBalance(xen_free_memory, domdict)
+                    self.assertSameBalloon(abs(xen_free_memory), domdict)
+
+
+class TC_12_BalanceScheduler(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_12_BalanceScheduler, self).setUp()
+        self.now = 0.0
+        self.system_state = qubes.qmemman.SystemState()
+        self.system_state.domdict = {
+            '1': create_domain('1', 500 * MiB, 1000 * MiB),
+            '2': create_domain('2', 500 * MiB, 1000 * MiB),
+        }
+        self.passes = []
+
+        def do_balance_iter():
+            self.passes.append(self.now)
+            yield 0.1
+        self.system_state.do_balance_iter = do_balance_iter
+        self.scheduler = qubes.qmemman.BalanceScheduler(self.system_state,
+            interval=1.0, pressure_threshold=100 * MiB,
+            clock=lambda: self.now)
+
+    def meminfo(self, domid, mem_used):
+        self.scheduler.refresh_meminfo(domid,
+            str(mem_used // 1024).encode())
+
+    def balance(self):
+        steps = self.scheduler.balance_if_due_iter()
+        try:
+            while True:
+                self.now += next(steps)
+        except StopIteration as e:
+            return e.value
+
+    def test_000_nothing_to_do(self):
+        self.assertIsNone(self.scheduler.get_timeout())
+        self.assertFalse(self.balance())
+        self.assertEqual(self.passes, [])
+
+    def test_001_first_update(self):
+        self.meminfo('1', 500 * MiB)
+        self.assertEqual(self.scheduler.get_timeout(), 0)
+        self.assertTrue(self.balance())
+        self.assertEqual(self.passes, [0.0])
+        self.assertIsNone(self.scheduler.get_timeout())
+
+    def test_002_coalesce(self):
+        self.meminfo('1', 500 * MiB)
+        self.balance()
+        self.now = 0.5
+        for i in range(10):
+            self.meminfo(str(i % 2 + 1), (500 + i) * MiB)
+        self.assertAlmostEqual(self.scheduler.get_timeout(), 0.5)
+        self.assertFalse(self.balance())
+        self.now = 1.0
+        self.assertEqual(self.scheduler.get_timeout(), 0)
+        self.assertTrue(self.balance())
+        self.assertEqual(self.passes, [0.0, 1.0])
+        self.assertEqual(self.scheduler.get_stats(), {
+            'meminfo_updates': 11,
+            'balance_passes': 2,
+            'immediate_passes': 0,
+            'saved_passes': 9,
+        })
+        self.assertEqual(self.scheduler.balance_latency.count, 2)
+
+    def test_003_pressure(self):
+        self.meminfo('1', 500 * MiB)
+        self.balance()
+        self.now = 0.2
+        self.meminfo('2', 2000 * MiB)
+        self.assertEqual(self.scheduler.under_pressure, {'2'})
+        self.assertEqual(self.scheduler.get_timeout(), 0)
+        self.assertTrue(self.balance())
+        # still under pressure, but that is not news anymore
+        self.now = 0.4
+        self.meminfo('2', 2100 * MiB)
+        self.assertAlmostEqual(self.scheduler.get_timeout(), 0.8)
+        # relieved, and then under pressure again
+        self.meminfo('2', 500 * MiB)
+        self.assertEqual(self.scheduler.under_pressure, set())
+        self.meminfo('2', 2000 * MiB)
+        self.assertEqual(self.scheduler.get_timeout(), 0)
+        self.assertTrue(self.balance())
+        self.assertEqual(self.scheduler.get_stats()['immediate_passes'], 2)
+
+    def test_004_request_balance(self):
+        self.meminfo('1', 500 * MiB)
+        self.balance()
+        self.scheduler.request_balance()
+        self.assertEqual(self.scheduler.get_timeout(), 0)
+        self.assertTrue(self.balance())
+        self.assertEqual(self.passes, [0.0, 0.1])
+
+    def test_005_timer_fired_early(self):
+        self.meminfo('1', 500 * MiB)
+        self.balance()
+        self.meminfo('1', 600 * MiB)
+        # event loop timers may fire slightly before the deadline
+        self.now = 0.9995
+        self.assertEqual(self.scheduler.get_timeout(), 0)
+
+    def test_006_domain_gone(self):
+        self.meminfo('2', 2000 * MiB)
+        del self.system_state.domdict['2']
+        self.balance()
+        self.assertEqual(self.scheduler.under_pressure, set())
+
+
+class TC_13_StaticMax(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_13_StaticMax, self).setUp()
+        self.xenstore = {
+            '/local/domain/1/memory/target': b'1024000',
+            '/local/domain/1/memory/static-max': b'4096000',
+        }
+        self.system_state = qubes.qmemman.SystemState()
+        self.system_state.xs = unittest.mock.Mock()
+        self.system_state.xs.read.side_effect = \
+            lambda tx, path: self.xenstore.get(path)
+        self.system_state.xc = unittest.mock.Mock()
+        self.system_state.xc.domain_getinfo.return_value = [
+            {'domid': 1, 'mem_kb': 1024000}]
+        self.system_state.ALL_PHYS_MEM = 16000 * MiB
+
+    def test_000_read_on_add(self):
+        self.system_state.add_domain('1')
+        self.assertEqual(self.system_state.domdict['1'].memory_maximum,
+            4096000 * 1024)
+        self.assertEqual(self.system_state.domdict['1'].last_target,
+            1024000 * 1024)
+
+    def test_001_not_read_again(self):
+        self.system_state.add_domain('1')
+        self.system_state.xs.read.reset_mock()
+        self.system_state.refresh_memactual()
+        self.assertEqual(self.system_state.domdict['1'].memory_actual,
+            1024000 * 1024)
+        self.assertFalse(self.system_state.xs.read.called)
+
+    def test_002_refresh(self):
+        self.system_state.add_domain('1')
+        self.xenstore['/local/domain/1/memory/static-max'] = b'2048000'
+        self.system_state.refresh_static_max('1')
+        self.assertEqual(self.system_state.domdict['1'].memory_maximum,
+            2048000 * 1024)
+        # no static-max (dom0)
+        del self.xenstore['/local/domain/1/memory/static-max']
+        self.system_state.refresh_static_max('1')
+        self.assertEqual(self.system_state.domdict['1'].memory_maximum,
+            16000 * MiB)
+
+    def test_003_refresh_unknown_domain(self):
+        self.system_state.refresh_static_max('2')
+        self.assertEqual(self.system_state.domdict, {})
+        self.assertFalse(self.system_state.xs.read.called)
+
+    def test_010_watch(self):
+        handle = unittest.mock.Mock()
+        handle.ls.return_value = ['1']
+        handle.read.side_effect = lambda tx, path: (b'1'
+            if path == '/local/domain/1/domid' else None)
+        with unittest.mock.patch.object(qubes.tools.qmemmand,
+                'system_state', self.system_state):
+            watcher = qubes.tools.qmemmand.XS_Watcher(loop=self.loop,
+                handle=handle)
+            watcher.domain_list_changed(refresh_only=True)
+            handle.watch.assert_any_call('/local/domain/1/memory/static-max',
+                watcher.static_max_watch_token_dict['1'])
+            token = watcher.static_max_watch_token_dict['1']
+            self.xenstore['/local/domain/1/memory/static-max'] = b'2048000'
+            token.fn(watcher, token.param)
+            self.assertEqual(self.system_state.domdict['1'].memory_maximum,
+                2048000 * 1024)
+
+            handle.ls.return_value = []
+            watcher.domain_list_changed(refresh_only=True)
+            handle.unwatch.assert_any_call(
+                '/local/domain/1/memory/static-max', token)
+            self.assertEqual(watcher.static_max_watch_token_dict, {})
+            self.assertEqual(self.system_state.domdict, {})
+
+
+class TC_20_Simulator(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.simulators = []
+
+    def tearDown(self):
+        # closed by Simulator.run(), unless it was never called
+        for simulator in self.simulators:
+            simulator.loop.close()
+        super().tearDown()
+
+    def create_simulator(self, events, **kwargs):
+        simulator = qubes.tests.perf.qmemman_sim.Simulator(events, **kwargs)
+        self.simulators.append(simulator)
+        return simulator
+
+    def parse_trace(self, trace):
+        events = []
+        for line in trace.splitlines():
+            fields = line.split()
+            if fields:
+                events.append((float(fields[0]), fields[1], tuple(fields[2:])))
+        return events
+
+    def simulate(self, trace, **kwargs):
+        return self.create_simulator(self.parse_trace(trace), **kwargs).run()
+
+    def test_000_deterministic(self):
+        def run():
+            events = qubes.tests.perf.qmemman_sim.synthetic_trace(
+                domains=3, duration=60, start_interval=10, seed=1)
+            return self.create_simulator(events,
+                total_memory=12000 * MiB).run()
+        report = run()
+        self.assertGreater(report['requests'], 0)
+        self.assertEqual(report, run())
+
+    def test_010_request(self):
+        report = self.simulate('''
+            0 domain dom0 4000 0
+            0 domain vm1 2000 4000
+            1 meminfo dom0 1000
+            1 meminfo vm1 500
+            5 start vm2 1000 3
+        ''', total_memory=8000 * MiB)
+        self.assertEqual(report['requests'], 1)
+        self.assertEqual(report['failed'], 0)
+        self.assertEqual(report['overcommits'], 0)
+
+    def test_011_request_memory_refused(self):
+        # the only donor refuses to give back memory
+        report = self.simulate('''
+            0 domain dom0 2000 0
+            0 domain vm1 5800 6000 refuse
+            1 meminfo dom0 1000
+            1 meminfo vm1 500
+            5 start vm2 1000 3
+        ''', total_memory=8000 * MiB)
+        self.assertEqual(report['requests'], 1)
+        self.assertEqual(report['failed'], 1)
+
+    def test_020_balance_coalesced(self):
+        trace = '0 domain dom0 4000 0\n0 domain vm1 2000 4000\n'
+        for i in range(100):
+            trace += '{} meminfo vm1 {}\n'.format(1 + i * 0.01, 500 + i)
+        report = self.simulate(trace, total_memory=8000 * MiB,
+            balance_interval=1.0)
+        self.assertEqual(report['meminfo_updates'], 100)
+        self.assertLess(report['balance_passes'], 10)
+
+    def test_040_status(self):
+        trace = '''
+            0 domain dom0 4000 0
+            0 domain vm1 2000 4000
+            1 meminfo dom0 1000
+            1 meminfo vm1 500
+            5 start vm2 1000 3
+        '''
+        simulator = self.create_simulator(self.parse_trace(trace),
+            total_memory=8000 * MiB)
+        report = simulator.run()
+        status = json.loads(json.dumps(simulator.status))
+        self.assertEqual(status['requests']['count'], 1)
+        self.assertEqual(status['requests']['granted'], 1)
+        self.assertEqual(status['requests']['latency']['count'], 1)
+        self.assertEqual(status['balance']['balance_passes'],
+            report['balance_passes'])
+        # the last pass may be still running
+        self.assertGreater(status['balance']['latency']['count'], 0)
+        self.assertLessEqual(status['balance']['latency']['count'],
+            report['balance_passes'])
+        self.assertEqual(sorted(status['domains']), ['0', '1', '2'])
+        self.assertIn('prefmem', status['domains']['1'])
+        self.assertNotIn('prefmem', status['domains']['2'])
+        self.assertFalse(status['domains']['1']['no_progress'])
+
+    def test_050_reservations(self):
+        trace = '''
+            0 domain dom0 4000 0
+            0 domain vm1 2000 4000
+            1 meminfo dom0 1000
+            1 meminfo vm1 500
+            5 start vm2 1000 5
+            5.5 start vm3 1000 5
+            6 start vm4 1000 5
+        '''
+        locked = self.simulate(trace, total_memory=10000 * MiB)
+        reserved = self.simulate(trace, total_memory=10000 * MiB,
+            reservations=True)
+        for report in (locked, reserved):
+            self.assertEqual(report['requests'], 3)
+            self.assertEqual(report['failed'], 0)
+            self.assertEqual(report['overcommits'], 0)
+        # without reservations, each start waits for the previous one
+        self.assertGreater(locked['latency_max'], 4)
+        self.assertLess(reserved['latency_max'], 4)
+
+    def test_030_reserve(self):
+        trace = '''
+            0 domain dom0 4000 0
+            0 domain vm1 2000 4000
+            1 meminfo dom0 1000
+            1 meminfo vm1 500
+            5 start vm2 1000 3
+            30 start vm3 1000 3
+        '''
+        without_reserve = self.simulate(trace, total_memory=8000 * MiB)
+        with_reserve = self.simulate(trace, total_memory=8000 * MiB,
+            reserve_max=2000 * MiB)
+        self.assertEqual(with_reserve['failed'], 0)
+        self.assertEqual(with_reserve['overcommits'], 0)
+        # the second request is served from the reserve, without waiting
+        # for VMs to give back memory
+        self.assertLess(with_reserve['latency_p50'],
+            without_reserve['latency_p50'])
+
+
+class TC_30_ReservePolicy(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_30_ReservePolicy, self).setUp()
+        self.now = 0.0
+        self.policy = qubes.qmemman.ReservePolicy(2000 * MiB, window=100,
+            size_weight=0.5, clock=lambda: self.now)
+
+    def test_000_no_requests(self):
+        self.assertEqual(self.policy.get_reserve(), 0)
+
+    def test_001_average_size(self):
+        self.policy.record_request(400 * MiB)
+        self.assertEqual(self.policy.get_reserve(), 400 * MiB)
+        self.policy.record_request(800 * MiB)
+        self.assertEqual(self.policy.avg_size, 600 * MiB)
+        self.assertEqual(self.policy.get_reserve(), 1200 * MiB)
+
+    def test_002_max_reserve(self):
+        for _ in range(10):
+            self.policy.record_request(1000 * MiB)
+        self.assertEqual(self.policy.get_reserve(), 2000 * MiB)
+
+    def test_003_decay(self):
+        self.policy.record_request(1000 * MiB)
+        self.now = 100
+        self.assertAlmostEqual(self.policy.get_recent_requests(),
+            math.exp(-1))
+        self.now = 10000
+        self.assertEqual(self.policy.get_reserve(), 0)
+
+    def test_010_system_state_surplus(self):
+        system_state = qubes.qmemman.SystemState()
+        system_state.XEN_FREE_MEM_LEFT = 50 * MiB
+        system_state.domdict = {
+            '1': create_domain('1', 1000 * MiB, 1000 * MiB),
+        }
+        need = qubes.qmemman.algo.memory_needed(system_state.domdict['1'])
+        self.assertEqual(system_state.get_reserve(4000 * MiB), 0)
+        system_state.reserve_policy = self.policy
+        self.policy.record_request(1000 * MiB)
+        self.assertEqual(system_state.get_reserve(4000 * MiB), 1000 * MiB)
+        # memory needed by domains is not held back
+        self.assertEqual(system_state.get_reserve(1000 * MiB + need),
+            950 * MiB)
+        self.assertEqual(system_state.get_reserve(need), 0)
+
+
+class TC_40_Server(qubes.tests.QubesTestCase):
+    def test_000_histogram(self):
+        histogram = qubes.qmemman.LatencyHistogram(bounds=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.add(value)
+        self.assertEqual(histogram.to_dict(), {
+            'count': 4,
+            'sum': 3.65,
+            'buckets': [
+                {'le': 0.1, 'count': 2},
+                {'le': 1, 'count': 1},
+                {'le': None, 'count': 1},
+            ],
+        })
+
+    def test_010_status_request(self):
+        server = qubes.tools.qmemmand.QMemmanServer(None, loop=self.loop)
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(b'STATUS\n')
+        reader.feed_eof()
+        writer = unittest.mock.Mock()
+        writer.drain.side_effect = asyncio.coroutine(lambda: None)
+        with unittest.mock.patch.object(server, 'get_status',
+                return_value={'domains': {}}):
+            self.loop.run_until_complete(server.handle_client(reader,
+                writer))
+        writer.write.assert_called_once_with(b'{"domains": {}}\n')
+        writer.close.assert_called_once_with()
+        self.assertFalse(server.pending)
+
+    def test_020_session(self):
+        server = qubes.tools.qmemmand.QMemmanServer(None, loop=self.loop)
+        server.release = unittest.mock.Mock()
+        requests = []
+
+        @asyncio.coroutine
+        def submit(memsize, batch=False, reservation=False):
+            self.assertTrue(reservation)
+            request = qubes.tools.qmemmand.MemoryRequest(memsize, 10,
+                self.loop, batch=batch, reservation=reservation)
+            requests.append(request)
+            return request, memsize < 1000
+
+        @asyncio.coroutine
+        def client():
+            reader.feed_data(b'QMEMMAN 2\nRESERVE 1 100\n'
+                b'RESERVE 2 2000 batch\nRESERVE 3 300\n')
+            yield from asyncio.sleep(0.01)
+            reader.feed_data(b'COMMIT 1\nRELEASE 2\n')
+            yield from asyncio.sleep(0.01)
+            reader.feed_eof()
+
+        server.submit = submit
+        reader = asyncio.StreamReader(loop=self.loop)
+        writer = unittest.mock.Mock()
+        self.loop.run_until_complete(asyncio.gather(
+            server.handle_client(reader, writer), client()))
+        self.assertEqual(
+            b''.join(call[0][0] for call in writer.write.call_args_list),
+            b'QMEMMAN 2\n1 OK\n2 FAIL\n3 OK\n')
+        self.assertTrue(requests[1].batch)
+        # failed request released right away, then commit, then the rest
+        # on disconnect
+        self.assertEqual(
+            [call[0][0] for call in server.release.call_args_list],
+            [requests[1], requests[0], requests[2]])
+        writer.close.assert_called_once_with()
+
+
+class TC_41_Requests(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_41_Requests, self).setUp()
+        self.system_state = qubes.qmemman.SystemState()
+        #: memsize of each balloon pass
+        self.balloons = []
+        #: results of next balloon passes, True if missing
+        self.balloon_results = []
+        self.balloon_delay = 0.01
+        #: memsize -> delay, overriding balloon_delay
+        self.balloon_delays = {}
+        self.balloon_closed = []
+
+        def do_balloon_iter(memsize):
+            self.balloons.append(memsize)
+            try:
+                yield self.balloon_delays.get(memsize, self.balloon_delay)
+            except GeneratorExit:
+                self.balloon_closed.append(memsize)
+                raise
+            if self.balloon_results:
+                return self.balloon_results.pop(0)
+            return True
+        self.system_state.do_balloon_iter = do_balloon_iter
+        for name, value in (
+                ('system_state', self.system_state),
+                ('balance_scheduler', unittest.mock.Mock()),
+                ('memory_lock', asyncio.Lock(loop=self.loop)),
+                ('force_refresh_domain_list', False)):
+            patch = unittest.mock.patch.object(qubes.tools.qmemmand, name,
+                value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.server = qubes.tools.qmemmand.QMemmanServer(
+            unittest.mock.Mock(), request_timeout=1, batch_window=0,
+            loop=self.loop)
+        self.processor = None
+
+    def start_processing(self):
+        self.processor = asyncio.ensure_future(
+            self.server.process_requests(), loop=self.loop)
+
+    def tearDown(self):
+        if self.processor is not None:
+            self.processor.cancel()
+            self.loop.run_until_complete(asyncio.wait([self.processor]))
+        super(TC_41_Requests, self).tearDown()
+
+    def submit(self, memsize, delay=0, reservation=True, batch=False):
+        '''Submit request after *delay*, return the task'''
+        @asyncio.coroutine
+        def submit():
+            yield from asyncio.sleep(delay)
+            return (yield from self.server.submit(memsize, batch=batch,
+                reservation=reservation))
+        return asyncio.ensure_future(submit(), loop=self.loop)
+
+    def test_000_run_async(self):
+        def steps():
+            yield 0.01
+            yield 0.01
+            return 'done'
+        self.assertEqual(self.loop.run_until_complete(
+            qubes.tools.qmemmand.run_async(steps())), 'done')
+
+    def test_001_run_async_cancelled(self):
+        self.balloon_delay = 10
+        task = asyncio.ensure_future(qubes.tools.qmemmand.run_async(
+            self.system_state.do_balloon_iter(100)), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(task)
+        self.assertEqual(self.balloon_closed, [100])
+
+    def test_010_order(self):
+        self.balloon_delay = 0.05
+        self.start_processing()
+        tasks = [self.submit(100), self.submit(200, 0.01),
+            self.submit(300, 0.02)]
+        results = self.loop.run_until_complete(asyncio.gather(*tasks))
+        self.assertEqual([got_memory for _, got_memory in results],
+            [True, True, True])
+        # the first request alone, the others waiting for it together
+        self.assertEqual(self.balloons, [100, 500])
+        self.assertEqual(self.system_state.get_reserved_memory(), 600)
+        for request, _ in results:
+            self.server.release(request)
+        self.assertEqual(self.system_state.get_reserved_memory(), 0)
+        self.assertTrue(qubes.tools.qmemmand.force_refresh_domain_list)
+        self.assertEqual(self.server.granted_requests, 3)
+
+    def test_011_failed(self):
+        self.balloon_results = [False]
+        self.start_processing()
+        request, got_memory = self.loop.run_until_complete(self.submit(100))
+        self.assertFalse(got_memory)
+        self.assertEqual(self.system_state.get_reserved_memory(), 0)
+        self.server.release(request)
+        self.assertFalse(qubes.tools.qmemmand.force_refresh_domain_list)
+
+    def test_020_deadline(self):
+        # ballooning for too long is interrupted at the request deadline
+        self.server.request_timeout = 0.1
+        self.balloon_delay = 10
+        self.start_processing()
+        start = self.loop.time()
+        request, got_memory = self.loop.run_until_complete(self.submit(100))
+        self.assertFalse(got_memory)
+        self.assertLess(self.loop.time() - start, 1)
+        self.assertEqual(self.balloon_closed, [100])
+        self.server.release(request)
+
+    def test_021_timeout_waiting(self):
+        # nothing processes requests
+        self.server.request_timeout = 0.05
+        request, got_memory = self.loop.run_until_complete(self.submit(100))
+        self.assertFalse(got_memory)
+        self.assertEqual(self.server.timed_out_requests, 1)
+        self.server.release(request)
+        # the timed out request is skipped
+        self.start_processing()
+        self.loop.run_until_complete(self.submit(200))
+        self.assertEqual(self.balloons, [200])
+
+    def test_022_client_gone(self):
+        self.balloon_delay = 0.05
+        self.start_processing()
+        first = self.submit(100)
+        gone = self.submit(200, 0.01)
+        last = self.submit(300, 0.02)
+        self.loop.run_until_complete(asyncio.sleep(0.03))
+        gone.cancel()
+        self.loop.run_until_complete(asyncio.gather(first, last))
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(gone)
+        self.assertEqual(self.balloons, [100, 300])
+
+    def test_030_lock_held(self):
+        # memory granted to protocol version 1 client is safe until it
+        # closes the connection
+        memory_lock = qubes.tools.qmemmand.memory_lock
+        self.start_processing()
+        request, got_memory = self.loop.run_until_complete(
+            self.submit(100, reservation=False))
+        self.assertTrue(got_memory)
+        self.assertTrue(memory_lock.locked())
+        second = self.submit(200)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertFalse(second.done())
+        self.assertEqual(self.balloons, [100])
+        self.assertEqual(self.system_state.get_reserved_memory(), 0)
+
+        self.server.release(request)
+        self.loop.run_until_complete(second)
+        self.assertEqual(self.balloons, [100, 200])
+        self.assertTrue(qubes.tools.qmemmand.force_refresh_domain_list)
+        self.assertFalse(memory_lock.locked())
+
+    def test_040_merge_retry_oldest(self):
+        self.balloon_delay = 0.05
+        self.balloon_results = [True, False, True, True]
+        self.start_processing()
+        results = self.loop.run_until_complete(asyncio.gather(
+            self.submit(100), self.submit(200, 0.01),
+            self.submit(300, 0.02)))
+        self.assertEqual([got_memory for _, got_memory in results],
+            [True, True, True])
+        # merged target failed, then the oldest alone, then the rest
+        self.assertEqual(self.balloons, [100, 500, 200, 300])
+
+    def test_041_merge_retry_oldest_failed(self):
+        self.balloon_delay = 0.05
+        self.balloon_results = [True, False, False, True]
+        self.start_processing()
+        results = self.loop.run_until_complete(asyncio.gather(
+            self.submit(100), self.submit(200, 0.01),
+            self.submit(300, 0.02)))
+        self.assertEqual([got_memory for _, got_memory in results],
+            [True, False, True])
+        self.assertEqual(self.balloons, [100, 500, 200, 300])
+        self.assertEqual(self.system_state.get_reserved_memory(), 400)
+
+    def test_042_batch_window(self):
+        self.server.batch_window = 0.05
+        self.start_processing()
+        self.loop.run_until_complete(asyncio.gather(
+            self.submit(100, batch=True), self.submit(200, 0.02)))
+        self.assertEqual(self.balloons, [300])
+
+    def test_043_no_batch_hint(self):
+        self.server.batch_window = 0.05
+        self.start_processing()
+        self.loop.run_until_complete(asyncio.gather(
+            self.submit(100), self.submit(200, 0.02)))
+        self.assertEqual(self.balloons, [100, 200])
+
+    def test_044_merged_deadline(self):
+        # ballooning for merged requests ends at the earliest deadline
+        self.balloon_delays = {100: 0.05, 500: 10}
+        self.start_processing()
+        first = self.submit(100)
+        early = self.submit(200, 0.01)
+        late = self.submit(300, 0.02)
+        start = self.loop.time()
+        self.loop.run_until_complete(asyncio.sleep(0.03))
+        for request in self.server.pending:
+            if request.memsize == 200:
+                request.deadline = start + 0.2
+        results = self.loop.run_until_complete(asyncio.gather(first, early,
+            late))
+        self.assertLess(self.loop.time() - start, 1)
+        self.assertEqual([got_memory for _, got_memory in results],
+            [True, False, True])
+        self.assertEqual(self.balloon_closed, [500])
+        # the late one got a chance alone
+        self.assertEqual(self.balloons[-1], 300)
+
+
+class TC_50_Client(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_50_Client, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.sock_path = os.path.join(self.tmpdir, 'qmemman.sock')
+        self.listener = socket.socket(socket.AF_UNIX)
+        self.addCleanup(self.listener.close)
+        self.listener.bind(self.sock_path)
+        self.listener.listen(1)
+        patch = unittest.mock.patch('qubes.qmemman.client.SOCK_PATH',
+            self.sock_path)
+        patch.start()
+        self.addCleanup(patch.stop)
+        patch = unittest.mock.patch('qubes.qmemman.client._connection',
+            None)
+        patch.start()
+        self.addCleanup(patch.stop)
+        #: lines received by the fake server
+        self.received = []
+
+    def serve(self, protocol_2=True, connections=1):
+        def server():
+            for _ in range(connections):
+                conn, _ = self.listener.accept()
+                with conn, conn.makefile('rwb', buffering=0) as conn_file:
+                    for line in conn_file:
+                        line = line.strip()
+                        self.received.append(line)
+                        fields = line.split()
+                        if line == b'QMEMMAN 2':
+                            if not protocol_2:
+                                break
+                            conn_file.write(b'QMEMMAN 2\n')
+                        elif fields[0] == b'RESERVE':
+                            conn_file.write(fields[1] + b' OK\n')
+                        elif fields[0].isdigit():
+                            conn_file.write(b'OK\n')
+        thread = threading.Thread(target=server, daemon=True)
+        thread.start()
+        return thread
+
+    def test_000_reserve_commit(self):
+        thread = self.serve()
+        clients = [qubes.qmemman.client.QMemmanClient() for _ in range(2)]
+        self.assertTrue(clients[0].request_memory(100))
+        self.assertTrue(clients[1].request_memory(200))
+        clients[0].commit()
+        clients[0].close()
+        clients[1].close()
+        qubes.qmemman.client._connection.sock.shutdown(socket.SHUT_WR)
+        thread.join(5)
+        self.assertEqual(self.received, [b'QMEMMAN 2', b'RESERVE 0 100',
+            b'RESERVE 1 200', b'COMMIT 0', b'RELEASE 1'])
+
+    def test_001_fallback(self):
+        # qmemman not supporting protocol version 2 closes the connection
+        thread = self.serve(protocol_2=False, connections=2)
+        client = qubes.qmemman.client.QMemmanClient()
+        self.assertTrue(client.request_memory(100))
+        client.close()
+        thread.join(5)
+        self.assertEqual(self.received, [b'QMEMMAN 2', b'100'])
+
+    def test_002_status_timeout(self):
+        # connected (queued by the listener), but never answered
+        with self.assertRaises(socket.timeout):
+            qubes.qmemman.client.QMemmanClient().get_status(timeout=0.1)
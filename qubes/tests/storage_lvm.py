@@ -25,7 +25,9 @@
     represent a :py:class:`qubes.storage.lvm.ThinPool`.
 '''
 import os
+import shutil
 import subprocess
+import sys
 import tempfile
 import unittest
 import unittest.mock
@@ -1153,3 +1155,310 @@ class TC_02_StorageHelpers(ThinPoolBase):
         pool = qubes.storage.search_pool_containing_dir(
             self.app.pools.values(), self.thin_dir.name)
         self.assertEqual(pool, self.pool)
+
+
+class TC_03_SizeCache(qubes.tests.QubesTestCase):
+    ''' In-place :py:data:`qubes.storage.lvm.size_cache` updates; no LVM
+    needed '''
+
+    def setUp(self):
+        super(TC_03_SizeCache, self).setUp()
+        patch = unittest.mock.patch('qubes.storage.lvm.use_lvm_shell', False)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.cache = {
+            'vg/pool': self.vol_info('', 't', size=100 * 2**30),
+            'vg/vm-test-root': self.vol_info('pool', 'V', usage=2**20),
+            'vg/vm-test-root-snap': self.vol_info('pool', 'V',
+                origin='vm-test-root'),
+        }
+        patch = unittest.mock.patch('qubes.storage.lvm.size_cache',
+            self.cache)
+        patch.start()
+        self.addCleanup(patch.stop)
+        patch = unittest.mock.patch('qubes.storage.lvm._updated_vids', set())
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    @staticmethod
+    def vol_info(pool_lv, kind, size=2**30, usage=0, origin=''):
+        return {'size': size, 'usage': usage, 'pool_lv': pool_lv,
+            'attr': kind + 'wi-a-tz--', 'origin': origin,
+            'metadata_size': '', 'metadata_usage': None}
+
+    def test_000_create(self):
+        # LVM knows better the size after rounding
+        self.assertFalse(qubes.storage.lvm._update_cache(
+            ['create', 'vg/pool', 'vm-test-private', str(2**31)]))
+        self.assertNotIn('vg/vm-test-private', self.cache)
+
+    def test_001_clone(self):
+        self.assertTrue(qubes.storage.lvm._update_cache(
+            ['clone', '/dev/vg/vm-test-root', 'vg/vm-test2-root-snap']))
+        self.assertEqual(self.cache['vg/vm-test2-root-snap'],
+            self.vol_info('pool', 'V', usage=2**20, origin='vm-test-root'))
+
+    def test_002_commit(self):
+        # rename current to revision, then snapshot to current
+        self.assertTrue(qubes.storage.lvm._update_cache(
+            ['rename', 'vg/vm-test-root', 'vg/vm-test-root-1-back']))
+        self.assertEqual(self.cache['vg/vm-test-root-snap']['origin'],
+            'vm-test-root-1-back')
+        self.assertTrue(qubes.storage.lvm._update_cache(
+            ['rename', 'vg/vm-test-root-snap', 'vg/vm-test-root']))
+        self.assertEqual(sorted(self.cache),
+            ['vg/pool', 'vg/vm-test-root', 'vg/vm-test-root-1-back'])
+        self.assertEqual(self.cache['vg/vm-test-root']['origin'],
+            'vm-test-root-1-back')
+
+    def test_003_remove(self):
+        self.assertTrue(qubes.storage.lvm._update_cache(
+            ['remove', '/dev/vg/vm-test-root']))
+        self.assertNotIn('vg/vm-test-root', self.cache)
+        self.assertEqual(self.cache['vg/vm-test-root-snap']['origin'], '')
+
+    def test_004_unknown(self):
+        self.assertFalse(qubes.storage.lvm._update_cache(
+            ['clone', 'vg/vm-missing-root', 'vg/vm-test2-root']))
+        self.assertFalse(qubes.storage.lvm._update_cache(
+            ['extend', 'vg/vm-test-root', str(2**31)]))
+
+    def test_010_reconcile(self):
+        log = unittest.mock.Mock()
+        qubes.storage.lvm._update_cache(
+            ['clone', 'vg/vm-test-root', 'vg/vm-test2-root'])
+        qubes.storage.lvm._update_cache(
+            ['clone', 'vg/vm-test-root', 'vg/vm-test3-root'])
+        actual = dict(self.cache)
+        actual['vg/vm-test2-root'] = self.vol_info('pool', 'V',
+            size=2**31, origin='vm-test-root')
+        # not updated in place, changes are not reported
+        actual['vg/vm-test-root-snap'] = self.vol_info('pool', 'V',
+            size=2**31, origin='vm-test-root')
+        with unittest.mock.patch('time.monotonic', return_value=123):
+            qubes.storage.lvm._set_cache(actual, log=log)
+        self.assertEqual(log.warning.call_count, 1)
+        self.assertEqual(log.warning.call_args[0][1], 'vg/vm-test2-root')
+        self.assertIs(qubes.storage.lvm.size_cache, actual)
+        self.assertEqual(qubes.storage.lvm.size_cache_time, 123)
+        self.assertFalse(qubes.storage.lvm._updated_vids)
+
+    def test_020_lvm_coro(self):
+        proc = unittest.mock.Mock(returncode=0)
+        proc.communicate.side_effect = asyncio.coroutine(
+            lambda: (b'', b''))
+        with unittest.mock.patch('asyncio.create_subprocess_exec',
+                side_effect=asyncio.coroutine(lambda *args, **kwargs: proc)
+                ) as mock_exec:
+            self.loop.run_until_complete(qubes.storage.lvm.qubes_lvm_coro(
+                ['clone', 'vg/vm-test-root', 'vg/vm-test2-root']))
+        # no lvs call
+        self.assertEqual(mock_exec.call_count, 1)
+        self.assertIn('lvcreate', mock_exec.call_args[0])
+        self.assertIn('vg/vm-test2-root', self.cache)
+
+    def test_021_lvm_coro_failed(self):
+        lvcreate = unittest.mock.Mock(returncode=5)
+        lvcreate.communicate.side_effect = asyncio.coroutine(
+            lambda: (b'', b'  Some error\n'))
+        lvs = unittest.mock.Mock(returncode=0)
+        lvs.communicate.side_effect = asyncio.coroutine(lambda: (
+            b'  vg;pool;vm-test-private;1073741824B;1.00;Vwi-a-tz--;;;\n',
+            b''))
+        with unittest.mock.patch('asyncio.create_subprocess_exec',
+                side_effect=asyncio.coroutine(unittest.mock.Mock(
+                    side_effect=[lvcreate, lvs]))) as mock_exec:
+            with self.assertRaises(qubes.storage.StoragePoolException):
+                self.loop.run_until_complete(
+                    qubes.storage.lvm.qubes_lvm_coro(['create', 'vg/pool',
+                        'vm-test-private', str(2**31)]))
+        # the volume was refreshed, and only it
+        self.assertEqual(mock_exec.call_count, 2)
+        self.assertEqual(mock_exec.call_args[0][-1], 'vg/vm-test-private')
+        self.assertEqual(self.cache['vg/vm-test-private']['size'], 2**30)
+
+    def test_022_lvm_coro_create(self):
+        lvcreate = unittest.mock.Mock(returncode=0)
+        lvcreate.communicate.side_effect = asyncio.coroutine(
+            lambda: (b'', b''))
+        lvs = unittest.mock.Mock(returncode=0)
+        lvs.communicate.side_effect = asyncio.coroutine(lambda: (
+            b'  vg;pool;vm-test-private;2151677952B;0.00;Vwi-a-tz--;;;\n',
+            b''))
+        with unittest.mock.patch('asyncio.create_subprocess_exec',
+                side_effect=asyncio.coroutine(unittest.mock.Mock(
+                    side_effect=[lvcreate, lvs]))) as mock_exec:
+            self.loop.run_until_complete(qubes.storage.lvm.qubes_lvm_coro(
+                ['create', 'vg/pool', 'vm-test-private', str(2**31 + 1)]))
+        # the new volume was refreshed, to get the size rounded by LVM
+        self.assertEqual(mock_exec.call_count, 2)
+        self.assertEqual(mock_exec.call_args[0][-1], 'vg/vm-test-private')
+        self.assertEqual(self.cache['vg/vm-test-private']['size'],
+            2**31 + 2**22)
+
+
+#: minimal :program:`lvm shell` replacement: fails commands on 'missing'
+#: volumes, exits on 'crash', does not write a report on 'noreport' and does
+#: not finish 'hang'
+FAKE_LVM_SHELL = r'''
+import json, os, sys, time
+report = os.fdopen(int(os.environ['LVM_REPORT_FD']), 'w')
+while True:
+    sys.stdout.write('lvm> ')
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        break
+    args = line.split()
+    if 'crash' in args:
+        sys.exit(1)
+    if 'noreport' in args:
+        continue
+    if 'hang' in args:
+        time.sleep(60)
+    assert args[-4:] == ['--reportformat', 'json',
+        '--config', 'log{report_command_log=1}'], args
+    if any('missing' in arg for arg in args):
+        log = [{'log_type': 'error', 'log_ret_code': '0',
+                'log_message': 'Failed to find logical volume "missing"'},
+            {'log_type': 'status', 'log_ret_code': '5',
+                'log_message': 'failure'}]
+    else:
+        sys.stdout.write('done {}\n'.format(args[0]))
+        log = [{'log_type': 'status', 'log_ret_code': '1',
+            'log_message': 'success'}]
+    report.write(json.dumps({'log': log}, indent=2) + '\n')
+    report.flush()
+'''
+
+
+class TC_04_LvmShell(qubes.tests.QubesTestCase):
+    ''' :py:class:`qubes.storage.lvm.LvmShell` with a fake shell '''
+
+    def setUp(self):
+        super(TC_04_LvmShell, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.script = os.path.join(self.tmpdir, 'lvm-shell.py')
+        with open(self.script, 'w') as script_file:
+            script_file.write(FAKE_LVM_SHELL)
+        self.shell = qubes.storage.lvm.LvmShell([sys.executable, self.script])
+        self.pool = qubes.storage.lvm.LvmShellPool(2,
+            [sys.executable, self.script])
+        self.processes = []
+        create_subprocess_exec = asyncio.create_subprocess_exec
+        @asyncio.coroutine
+        def spawn(*args, **kwargs):
+            proc = yield from create_subprocess_exec(*args, **kwargs)
+            self.processes.append(proc)
+            return proc
+        patch = unittest.mock.patch('asyncio.create_subprocess_exec',
+            side_effect=spawn)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.shell.close()
+        self.pool.close()
+        for proc in self.processes:
+            self.loop.run_until_complete(proc.wait())
+        super(TC_04_LvmShell, self).tearDown()
+
+    def execute(self, *args):
+        return self.loop.run_until_complete(self.shell.execute(list(args)))
+
+    def test_000_execute(self):
+        self.assertEqual(self.execute('lvremove', '-f', 'vg/vm-test-root'),
+            (0, b'done lvremove\n', b''))
+        pid = self.shell._process.pid
+        self.assertEqual(self.execute('lvcreate', '-n', 'vm-test-root'),
+            (0, b'done lvcreate\n', b''))
+        self.assertEqual(self.shell._process.pid, pid)
+
+    def test_001_failed(self):
+        self.assertEqual(self.execute('lvremove', '-f', 'missing'),
+            (5, b'', b'Failed to find logical volume "missing"'))
+        self.assertEqual(self.execute('lvremove', '-f', 'vg/vm-test-root'),
+            (0, b'done lvremove\n', b''))
+
+    def test_002_restart(self):
+        self.execute('lvremove', '-f', 'vg/vm-test-root')
+        pid = self.shell._process.pid
+        returncode, _, err = self.execute('lvremove', 'crash')
+        self.assertNotEqual(returncode, 0)
+        self.assertIn(b'unknown', err)
+        self.assertIsNone(self.shell._process)
+        self.assertEqual(self.execute('lvremove', '-f', 'vg/vm-test-root'),
+            (0, b'done lvremove\n', b''))
+        self.assertNotEqual(self.shell._process.pid, pid)
+        self.assertFalse(self.shell.broken)
+
+    def test_003_no_report(self):
+        self.shell.timeout = 0.5
+        returncode, _, _ = self.execute('lvremove', 'noreport')
+        self.assertNotEqual(returncode, 0)
+        self.assertIsNone(self.shell._process)
+        self.assertEqual(self.execute('lvremove', '-f', 'vg/vm-test-root'),
+            (0, b'done lvremove\n', b''))
+
+    def test_004_start_failed(self):
+        self.shell.cmd = [os.path.join(self.tmpdir, 'no-such-lvm')]
+        self.assertIsNone(self.execute('lvremove', '-f', 'vg/vm-test-root'))
+        self.assertTrue(self.shell.broken)
+
+    def test_005_unsafe_args(self):
+        self.assertIsNone(self.execute('lvremove', '-f', 'vg/vm test'))
+        self.assertIsNone(self.shell._process)
+
+    def test_006_command_timeout(self):
+        self.shell.command_timeout = 0.5
+        returncode, _, err = self.execute('lvremove', 'hang')
+        self.assertNotEqual(returncode, 0)
+        self.assertIn(b'unknown', err)
+        self.assertIsNone(self.shell._process)
+        # killed, not left running
+        self.loop.run_until_complete(asyncio.wait_for(
+            self.processes[0].wait(), 5))
+        self.assertEqual(self.execute('lvremove', '-f', 'vg/vm-test-root'),
+            (0, b'done lvremove\n', b''))
+
+    def test_010_qubes_lvm_coro(self):
+        with unittest.mock.patch('qubes.storage.lvm._get_lvm_shell',
+                    return_value=self.shell), \
+                unittest.mock.patch('qubes.storage.lvm._update_cache',
+                    return_value=True):
+            self.loop.run_until_complete(qubes.storage.lvm.qubes_lvm_coro(
+                ['rename', 'vg/vm-test-root', 'vg/vm-test2-root']))
+            self.loop.run_until_complete(qubes.storage.lvm.qubes_lvm_coro(
+                ['rename', 'vg/vm-test-root', 'vg/vm-test3-root']))
+            with unittest.mock.patch(
+                    'qubes.storage.lvm.refresh_volumes_coro',
+                    side_effect=asyncio.coroutine(lambda *args: None)):
+                with self.assertRaises(qubes.storage.StoragePoolException):
+                    self.loop.run_until_complete(
+                        qubes.storage.lvm.qubes_lvm_coro(
+                            ['rename', 'vg/missing', 'vg/vm-test3-root']))
+        # only the shell itself
+        self.assertEqual(len(self.processes), 1)
+
+    def test_020_pool(self):
+        for _ in range(3):
+            self.assertEqual(self.loop.run_until_complete(
+                self.pool.execute(['lvremove', '-f', 'vg/vm-test-root'])),
+                (0, b'done lvremove\n', b''))
+        # one shell reused
+        self.assertEqual(len(self.processes), 1)
+
+    def test_021_pool_parallel(self):
+        with unittest.mock.patch.object(qubes.storage.lvm.LvmShell,
+                'command_timeout', 3):
+            hung = asyncio.ensure_future(
+                self.pool.execute(['lvremove', 'hang']))
+            # does not wait for the hung shell
+            self.assertEqual(self.loop.run_until_complete(asyncio.wait_for(
+                self.pool.execute(['lvremove', '-f', 'vg/vm-test-root']), 2)),
+                (0, b'done lvremove\n', b''))
+            self.assertFalse(hung.done())
+            returncode, _, _ = self.loop.run_until_complete(hung)
+        self.assertNotEqual(returncode, 0)
+        self.assertEqual(len(self.processes), 2)
@@ -168,3 +168,259 @@ class TC_00_DispVM(qubes.tests.QubesTestCase):
                 self.app.add_new_vm(qubes.vm.dispvm.DispVM,
                     name='test-dispvm', template=self.appvm)
             self.assertFalse(mock_domains.get_new_unused_dispid.called)
+
+
+class TestVMsCollection(qubes.tests.vm.TestVMsCollection):
+    def __init__(self):
+        super().__init__()
+        self.dispid_counter = 0
+
+    def get_new_unused_dispid(self):
+        self.dispid_counter += 1
+        return self.dispid_counter
+
+    def __delitem__(self, key):
+        vm = self[key]
+        for k in [k for k, v in self.items() if v is vm]:
+            super().__delitem__(k)
+
+
+@asyncio.coroutine
+def fake_start(self, **kwargs):
+    # pylint: disable=unused-argument
+    self.test_state = 'Running'
+
+
+@asyncio.coroutine
+def fake_pause(self):
+    self.test_state = 'Paused'
+
+
+@asyncio.coroutine
+def fake_unpause(self):
+    self.test_state = 'Running'
+
+
+@asyncio.coroutine
+def fake_kill(self):
+    if self.test_state == 'Halted':
+        raise qubes.exc.QubesVMNotStartedError(self)
+    self.test_state = 'Halted'
+    # normally triggered by domain-shutdown event
+    yield from self._auto_cleanup()
+
+
+@asyncio.coroutine
+def fake_coroutine(self):
+    # pylint: disable=unused-argument
+    pass
+
+
+class TC_10_DispVMPool(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = TestApp()
+        self.app.domains = TestVMsCollection()
+        self.app.save = mock.Mock()
+        self.app.pools['default'] = qubes.tests.vm.appvm.TestPool('default')
+        self.app.pools['linux-kernel'] = mock.Mock(**{
+            'init_volume.return_value.pool': 'linux-kernel'})
+        self.app.vmm.offline_mode = True
+        self.template = self.app.add_new_vm(qubes.vm.templatevm.TemplateVM,
+            name='test-template', label='red')
+        self.appvm = self.app.add_new_vm(qubes.vm.appvm.AppVM,
+            name='test-vm', template=self.template, label='red',
+            template_for_dispvms=True)
+        self.dom0 = mock.NonCallableMock(features={})
+        self.app.domains['dom0'] = self.dom0
+
+        patch = mock.patch.multiple(qubes.vm.dispvm.DispVM,
+            test_state='Halted',
+            create_on_disk=fake_coroutine,
+            remove_from_disk=fake_coroutine,
+            start=fake_start,
+            pause=fake_pause,
+            unpause=fake_unpause,
+            kill=fake_kill,
+            is_halted=lambda self: self.test_state == 'Halted',
+            is_paused=lambda self: self.test_state == 'Paused',
+            create=True)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.cleanup_pool)
+
+    def cleanup_pool(self):
+        for vm in set(self.app.domains.values()):
+            if isinstance(vm, qubes.vm.BaseVM):
+                vm.close()
+        self.app.domains.clear()
+        self.app.pools.clear()
+        del self.template
+        del self.appvm
+        # pools keep references to the DispVMs
+        del self.app
+
+    def refill(self, pool):
+        self.loop.run_until_complete(pool.schedule_refill())
+
+    def dispvms(self):
+        return set(vm for vm in self.app.domains.values()
+            if isinstance(vm, qubes.vm.dispvm.DispVM))
+
+    def test_000_refill(self):
+        manager = qubes.vm.dispvm.DispVMPoolManager(self.app)
+        self.assertIs(self.app.dispvm_pools, manager)
+        self.appvm.features['dispvm-pool-size'] = 2
+        pool = manager.get_pool(self.appvm)
+        self.refill(pool)
+        self.assertEqual(len(pool.ready), 2)
+        self.assertEqual(set(pool.ready), self.dispvms())
+        for dispvm in pool.ready:
+            self.assertTrue(dispvm.auto_cleanup)
+            self.assertTrue(dispvm.features['internal'])
+            self.assertTrue(dispvm.features['dispvm-pool'])
+            self.assertTrue(dispvm.is_halted())
+        self.assertEqual(len(pool.refill_latencies), 2)
+
+    def test_001_take(self):
+        manager = qubes.vm.dispvm.DispVMPoolManager(self.app)
+        self.appvm.features['dispvm-pool-size'] = 1
+        pool = manager.get_pool(self.appvm)
+        self.refill(pool)
+        pooled = pool.ready[0]
+        dispvm = self.loop.run_until_complete(
+            qubes.vm.dispvm.DispVM.from_appvm(self.appvm))
+        self.assertIs(dispvm, pooled)
+        self.assertNotIn('dispvm-pool', dispvm.features)
+        self.assertNotIn('internal', dispvm.features)
+        self.assertEqual(pool.hits, 1)
+        self.assertEqual(pool.misses, 0)
+        # refilled in the background
+        self.refill(pool)
+        self.assertEqual(len(pool.ready), 1)
+        self.assertIsNot(pool.ready[0], dispvm)
+
+    def test_002_miss(self):
+        manager = qubes.vm.dispvm.DispVMPoolManager(self.app)
+        pool = manager.get_pool(self.appvm)
+        dispvm = self.loop.run_until_complete(
+            qubes.vm.dispvm.DispVM.from_appvm(self.appvm))
+        # pool not configured, not counted
+        self.assertEqual(pool.misses, 0)
+        self.appvm.features['dispvm-pool-size'] = 1
+        pool.schedule_refill().cancel()
+        dispvm = self.loop.run_until_complete(
+            qubes.vm.dispvm.DispVM.from_appvm(self.appvm))
+        self.assertNotIn('dispvm-pool', dispvm.features)
+        self.assertEqual(pool.misses, 1)
+        self.refill(pool)
+        self.assertEqual(len(pool.ready), 1)
+        self.assertEqual(pool.get_stats()['ready'], 1)
+
+    def test_003_prestart_memory_budget(self):
+        manager = qubes.vm.dispvm.DispVMPoolManager(self.app)
+        self.dom0.features['dispvm-pool-memory'] = '500'
+        self.appvm.features['dispvm-pool-prestart'] = True
+        self.appvm.features['dispvm-pool-size'] = 2
+        pool = manager.get_pool(self.appvm)
+        self.refill(pool)
+        self.assertEqual([vm.test_state for vm in pool.ready],
+            ['Paused', 'Halted'])
+        dispvm = self.loop.run_until_complete(
+            qubes.vm.dispvm.DispVM.from_appvm(self.appvm, prestarted=True))
+        self.assertEqual(dispvm.test_state, 'Running')
+        self.refill(pool)
+        # the handed out one does not count anymore
+        self.assertEqual([vm.test_state for vm in pool.ready],
+            ['Halted', 'Paused'])
+
+    def test_008_prestarted_opt_in(self):
+        manager = qubes.vm.dispvm.DispVMPoolManager(self.app)
+        self.appvm.features['dispvm-pool-prestart'] = True
+        self.appvm.features['dispvm-pool-size'] = 1
+        pool = manager.get_pool(self.appvm)
+        self.refill(pool)
+        pooled = pool.ready[0]
+        self.assertEqual(pooled.test_state, 'Paused')
+        pool.schedule_refill().cancel()
+        dispvm = self.loop.run_until_complete(
+            qubes.vm.dispvm.DispVM.from_appvm(self.appvm))
+        # a running qube is not returned to a caller configuring it
+        self.assertIsNot(dispvm, pooled)
+        self.assertTrue(dispvm.is_halted())
+        self.assertEqual(pool.misses, 1)
+        self.assertEqual(pool.ready, [pooled])
+        dispvm = self.loop.run_until_complete(
+            qubes.vm.dispvm.DispVM.from_appvm(self.appvm, prestarted=True))
+        self.assertIs(dispvm, pooled)
+        self.assertEqual(pool.hits, 1)
+
+    def test_004_shrink(self):
+        manager = qubes.vm.dispvm.DispVMPoolManager(self.app)
+        self.appvm.features['dispvm-pool-prestart'] = True
+        self.appvm.features['dispvm-pool-size'] = 3
+        pool = manager.get_pool(self.appvm)
+        self.refill(pool)
+        self.assertEqual(len(self.dispvms()), 3)
+        self.appvm.features['dispvm-pool-size'] = 1
+        self.refill(pool)
+        self.assertEqual(len(pool.ready), 1)
+        self.assertEqual(set(pool.ready), self.dispvms())
+        self.appvm.template_for_dispvms = False
+        self.refill(pool)
+        self.assertEqual(pool.ready, [])
+        self.assertEqual(self.dispvms(), set())
+
+    def test_006_invalidate(self):
+        manager = qubes.vm.dispvm.DispVMPoolManager(self.app)
+        self.appvm.features['dispvm-pool-size'] = 2
+        pool = manager.get_pool(self.appvm)
+        self.refill(pool)
+        for change in (
+                lambda: setattr(self.appvm, 'memory', 500),
+                lambda: delattr(self.appvm, 'memory'),
+                lambda: self.appvm.tags.add('new-tag'),
+                lambda: self.appvm.features.__setitem__('service.x', '1'),
+                lambda: self.appvm.fire_event('firewall-changed')):
+            with self.subTest(change=change):
+                old = set(pool.ready)
+                change()
+                self.assertEqual(pool.ready, [])
+                self.refill(pool)
+                self.assertEqual(len(pool.ready), 2)
+                self.assertFalse(old.intersection(pool.ready))
+                self.assertEqual(set(pool.ready), self.dispvms())
+        self.assertEqual(pool.ready[0].memory, self.appvm.memory)
+        self.assertIn('new-tag', pool.ready[0].tags)
+        # pool configuration only
+        old = set(pool.ready)
+        self.appvm.features['dispvm-pool-size'] = 3
+        self.refill(pool)
+        self.assertLess(old, set(pool.ready))
+
+    def test_007_invalidate_while_creating(self):
+        manager = qubes.vm.dispvm.DispVMPoolManager(self.app)
+        pool = manager.get_pool(self.appvm)
+        self.appvm.features['dispvm-pool-size'] = 1
+        create = pool._create
+
+        @asyncio.coroutine
+        def change_during_create():
+            dispvm = yield from create()
+            self.appvm.tags.add('new-tag')
+            return dispvm
+
+        with mock.patch.object(pool, '_create', change_during_create):
+            self.refill(pool)
+        self.assertEqual(len(pool.ready), 1)
+        self.assertEqual(set(pool.ready), self.dispvms())
+        self.assertIn('new-tag', pool.ready[0].tags)
+
+    def test_005_adopt(self):
+        manager = qubes.vm.dispvm.DispVMPoolManager(self.app)
+        self.appvm.features['dispvm-pool-size'] = 2
+        self.refill(manager.get_pool(self.appvm))
+        pooled = set(manager.get_pool(self.appvm).ready)
+
+        new_manager = qubes.vm.dispvm.DispVMPoolManager(self.app)
+        self.assertEqual(set(new_manager.get_pool(self.appvm).ready), pooled)
@@ -31,6 +31,7 @@ import datetime
 import asyncio
 
 import functools
+import libvirt
 import lxml.etree
 import unittest.mock
 
@@ -39,6 +40,7 @@ import shutil
 import qubes
 import qubes.exc
 import qubes.config
+import qubes.firewall
 import qubes.devices
 import qubes.vm
 import qubes.vm.qubesvm
@@ -1839,3 +1841,401 @@ class TC_90_QubesVM(QubesVMTestsMixin, qubes.tests.QubesTestCase):
             self.assertEqual(exc.exception.returncode, 1)
             self.assertEqual(exc.exception.output, b'stdout')
             self.assertEqual(exc.exception.stderr, b'stderr')
+
+    def get_vm_with_libvirt_domain(self, state):
+        vm = self.get_vm()
+        self.app.vmm.offline_mode = False
+        libvirt_domain = unittest.mock.Mock()
+        libvirt_domain.isActive.return_value = \
+            state != libvirt.VIR_DOMAIN_SHUTOFF
+        libvirt_domain.state.return_value = [state, 0]
+        vm._libvirt_domain = libvirt_domain
+        return vm, libvirt_domain
+
+    def test_800_libvirt_state_not_cached(self):
+        vm, libvirt_domain = self.get_vm_with_libvirt_domain(
+            libvirt.VIR_DOMAIN_RUNNING)
+        self.assertTrue(vm.is_running())
+        libvirt_domain.isActive.return_value = False
+        self.assertFalse(vm.is_running())
+        self.assertIsNone(vm.check_libvirt_state_cache())
+
+    def test_801_libvirt_state_cached(self):
+        self.app.cache_libvirt_state = True
+        vm, libvirt_domain = self.get_vm_with_libvirt_domain(
+            libvirt.VIR_DOMAIN_PAUSED)
+        self.assertTrue(vm.is_running())
+        self.assertTrue(vm.is_paused())
+        self.assertEqual(vm.get_power_state(), 'Paused')
+        self.assertEqual(libvirt_domain.isActive.call_count, 1)
+        self.assertEqual(libvirt_domain.state.call_count, 1)
+        self.assertIsNone(vm.check_libvirt_state_cache())
+
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_RUNNING, 0]
+        self.assertTrue(vm.is_paused())
+        self.assertEqual(vm.check_libvirt_state_cache(),
+            ((True, libvirt.VIR_DOMAIN_PAUSED),
+             (True, libvirt.VIR_DOMAIN_RUNNING)))
+
+        vm.invalidate_libvirt_state()
+        self.assertFalse(vm.is_paused())
+        self.assertIsNone(vm.check_libvirt_state_cache())
+
+    def test_802_libvirt_state_transitional_not_cached(self):
+        self.app.cache_libvirt_state = True
+        vm, libvirt_domain = self.get_vm_with_libvirt_domain(
+            libvirt.VIR_DOMAIN_SHUTDOWN)
+        self.assertEqual(vm.get_power_state(), 'Halting')
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_SHUTOFF, 0]
+        self.assertEqual(vm.get_power_state(), 'Dying')
+        libvirt_domain.isActive.return_value = False
+        self.assertEqual(vm.get_power_state(), 'Halted')
+        # halted is cached
+        libvirt_domain.isActive.return_value = True
+        self.assertEqual(vm.get_power_state(), 'Halted')
+
+    def test_803_libvirt_state_blocked(self):
+        self.app.cache_libvirt_state = True
+        vm, libvirt_domain = self.get_vm_with_libvirt_domain(
+            libvirt.VIR_DOMAIN_BLOCKED)
+        self.assertTrue(vm.is_running())
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_RUNNING, 0]
+        self.assertIsNone(vm.check_libvirt_state_cache())
+
+    def test_804_libvirt_state_invalidated_on_pause(self):
+        self.app.cache_libvirt_state = True
+        vm, libvirt_domain = self.get_vm_with_libvirt_domain(
+            libvirt.VIR_DOMAIN_RUNNING)
+        libvirt_domain.suspend.side_effect = lambda: \
+            libvirt_domain.state.configure_mock(
+                return_value=[libvirt.VIR_DOMAIN_PAUSED, 0])
+        self.loop.run_until_complete(vm.pause())
+        self.assertTrue(vm.is_paused())
+        self.assertIsNone(vm.check_libvirt_state_cache())
+
+    def test_805_libvirt_state_guest_shutdown(self):
+        self.app.cache_libvirt_state = True
+        vm, libvirt_domain = self.get_vm_with_libvirt_domain(
+            libvirt.VIR_DOMAIN_RUNNING)
+        vm._domain_stopped_event_received = False
+        vm.is_fully_usable = lambda: True
+        self.assertTrue(vm.is_running())
+        self.assertEqual(vm.get_power_state(), 'Running')
+        # the guest shuts down itself, no event yet
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_SHUTDOWN, 0]
+        self.assertEqual(vm.get_power_state(), 'Halting')
+        self.assertIsNone(vm.check_libvirt_state_cache())
+
+    def test_810_libvirt_config_cached(self):
+        vm = self.get_vm()
+        vm.netvm = None
+        vm.virt_mode = 'hvm'
+        with unittest.mock.patch.object(self.app.env, 'select_template',
+                wraps=self.app.env.select_template) as select_template:
+            libvirt_xml = vm.create_config_file()
+            self.assertIs(vm.create_config_file(), libvirt_xml)
+            self.assertEqual(select_template.call_count, 1)
+
+            vm.memory = 500
+            new_libvirt_xml = vm.create_config_file()
+            self.assertNotEqual(new_libvirt_xml, libvirt_xml)
+            self.assertIn('500', new_libvirt_xml)
+            # template resolved only once
+            self.assertEqual(select_template.call_count, 1)
+
+    def test_811_libvirt_config_netvm_change(self):
+        netvm = self.get_vm(qid=2, name='netvm', provides_network=True)
+        vm = self.get_vm()
+        vm.netvm = netvm
+        vm.virt_mode = 'hvm'
+        libvirt_xml = vm.create_config_file()
+        self.assertNotIn('ipv6', libvirt_xml)
+        netvm.features['ipv6'] = True
+        self.assertIn('ipv6', vm.create_config_file())
+
+    def test_812_libvirt_define_skipped(self):
+        vm = self.get_vm()
+        vm.netvm = None
+        vm.virt_mode = 'hvm'
+        libvirt_conn = unittest.mock.Mock()
+        with unittest.mock.patch.object(type(self.app.vmm), 'libvirt_conn',
+                libvirt_conn):
+            vm._update_libvirt_domain()
+            vm._update_libvirt_domain()
+            self.assertEqual(libvirt_conn.defineXML.call_count, 1)
+            vm.vcpus = 4
+            vm._update_libvirt_domain()
+            self.assertEqual(libvirt_conn.defineXML.call_count, 2)
+            self.assertIn('<vcpu placement="static">4</vcpu>',
+                libvirt_conn.defineXML.call_args[0][0])
+
+    @unittest.mock.patch.dict(qubes.config.system_path,
+        {'qubes_kernels_base_dir': '/tmp'})
+    def test_813_libvirt_config_kernelopts_file(self):
+        d = tempfile.mkdtemp(prefix='/tmp/')
+        self.addCleanup(shutil.rmtree, d)
+        open(d + '/vmlinuz', 'w').close()
+        open(d + '/initramfs', 'w').close()
+        with open(d + '/default-kernelopts-nopci.txt', 'w') as f:
+            f.write('some default options')
+        vm = self.get_vm()
+        vm.netvm = None
+        vm.virt_mode = 'pvh'
+        vm.kernel = os.path.basename(d)
+        self.assertIn('some default options', vm.create_config_file())
+        # changed by a kernel package update, without any event
+        with open(d + '/default-kernelopts-nopci.txt', 'w') as f:
+            f.write('new default options')
+        self.assertIn('new default options', vm.create_config_file())
+
+    def get_vm_for_prepare_start(self):
+        netvm = self.get_vm(qid=2, name='netvm', provides_network=True)
+        vm = self.get_vm()
+        vm.netvm = netvm
+        log = []
+
+        def step(name, fail=False):
+            @asyncio.coroutine
+            def coro(*args, **kwargs):
+                log.append((name, 'begin'))
+                yield from asyncio.sleep(0.01)
+                log.append((name, 'end'))
+                if fail:
+                    raise qubes.exc.QubesException(name + ' failed')
+            return coro
+
+        netvm.is_running = lambda: False
+        netvm.start = step('netvm')
+        vm.storage = unittest.mock.Mock()
+        vm.storage.start = step('storage')
+        vm.storage.stop = step('storage-stop')
+        vm.request_memory = unittest.mock.Mock(
+            side_effect=lambda *args: log.append(('memory', 'request'))
+                or unittest.mock.DEFAULT)
+        vm.create_config_file = unittest.mock.Mock()
+        return vm, log, step
+
+    def test_820_prepare_start_concurrent(self):
+        vm, log, _ = self.get_vm_for_prepare_start()
+        qmemman_client = self.loop.run_until_complete(
+            vm._prepare_start(True, None, None))
+        self.assertIs(qmemman_client, vm.request_memory.return_value)
+        vm.request_memory.assert_called_once_with(None)
+        vm.create_config_file.assert_called_once_with()
+        # both started before any of them finished
+        self.assertEqual(set(log[:2]),
+            {('netvm', 'begin'), ('storage', 'begin')})
+        self.assertNotIn(('storage-stop', 'begin'), log)
+        self.assertFalse(qmemman_client.close.called)
+
+    def test_821_prepare_start_storage_failed(self):
+        vm, log, step = self.get_vm_for_prepare_start()
+        vm.storage.start = step('storage', fail=True)
+        with self.assertRaisesRegex(qubes.exc.QubesException,
+                'storage failed'):
+            self.loop.run_until_complete(vm._prepare_start(True, None, None))
+        vm.request_memory.return_value.close.assert_called_once_with()
+        self.assertNotIn(('storage-stop', 'begin'), log)
+        self.assertIn(('netvm', 'end'), log)
+
+    def test_822_prepare_start_memory_failed(self):
+        vm, log, _ = self.get_vm_for_prepare_start()
+        vm.request_memory.side_effect = qubes.exc.QubesMemoryError(vm)
+        with self.assertRaises(qubes.exc.QubesMemoryError):
+            self.loop.run_until_complete(vm._prepare_start(True, None, None))
+        self.assertEqual(log[-2:],
+            [('storage-stop', 'begin'), ('storage-stop', 'end')])
+
+    def test_823_prepare_start_memory_after_netvm(self):
+        vm, log, _ = self.get_vm_for_prepare_start()
+        self.loop.run_until_complete(vm._prepare_start(True, None, None))
+        # netvm requests memory for itself, which could wait for the
+        # reservation of this qube otherwise
+        self.assertLess(log.index(('netvm', 'end')),
+            log.index(('memory', 'request')))
+
+    def test_824_prepare_start_netvm_failed(self):
+        vm, log, step = self.get_vm_for_prepare_start()
+        vm.netvm.start = step('netvm', fail=True)
+        with self.assertRaisesRegex(qubes.exc.QubesException,
+                'netvm failed'):
+            self.loop.run_until_complete(vm._prepare_start(True, None, None))
+        self.assertFalse(vm.request_memory.called)
+        self.assertEqual(log[-2:],
+            [('storage-stop', 'begin'), ('storage-stop', 'end')])
+
+    def test_830_qdb_batch(self):
+        qdb = unittest.mock.Mock()
+        batch = qubes.vm.qubesvm.QubesDBBatch(qdb)
+        batch.write('/a', '1')
+        batch.write('/b', '1')
+        batch.write('/a', '2')
+        batch.write('/dir/x', '1')
+        batch.write('/dir/y', '1')
+        batch.rm('/dir/')
+        batch.write('/dir/y', '2')
+        batch.rm('/b')
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(qdb.mock_calls, [])
+        batch.flush()
+        self.assertEqual(qdb.mock_calls, [
+            unittest.mock.call.write('/a', '2'),
+            unittest.mock.call.rm('/dir/'),
+            unittest.mock.call.write('/dir/y', '2'),
+            unittest.mock.call.rm('/b'),
+        ])
+        self.assertEqual(len(batch), 0)
+
+    def test_831_qdb_batch_read(self):
+        qdb = unittest.mock.Mock()
+        batch = qubes.vm.qubesvm.QubesDBBatch(qdb)
+        batch.write('/a', '1')
+        self.assertIs(batch.read('/a'), qdb.read.return_value)
+        self.assertEqual(qdb.mock_calls, [
+            unittest.mock.call.write('/a', '1'),
+            unittest.mock.call.read('/a'),
+        ])
+
+    def test_832_qdb_batch_empty(self):
+        qdb = unittest.mock.Mock()
+        batch = qubes.vm.qubesvm.QubesDBBatch(qdb, empty=True)
+        batch.rm('/qubes-firewall/10.137.0.2/')
+        batch.write('/qubes-firewall/10.137.0.2/0000', 'action=accept')
+        batch.rm('/qubes-firewall/10.137.0.2/')
+        batch.write('/qubes-firewall/10.137.0.2', '')
+        batch.flush()
+        batch.rm('/qubes-firewall/10.137.0.2/')
+        batch.flush()
+        self.assertEqual(qdb.mock_calls, [
+            unittest.mock.call.write('/qubes-firewall/10.137.0.2', ''),
+            unittest.mock.call.rm('/qubes-firewall/10.137.0.2/'),
+        ])
+
+    def test_833_batched_qdb(self):
+        vm = self.get_vm()
+        qdb = unittest.mock.Mock()
+        vm._qdb_connection = qdb
+        with vm.batched_qdb():
+            vm.untrusted_qdb.write('/name', 'test')
+            with vm.batched_qdb():
+                vm.untrusted_qdb.write('/type', 'AppVM')
+            self.assertEqual(qdb.mock_calls, [])
+        self.assertIs(vm.untrusted_qdb, qdb)
+        self.assertEqual(qdb.mock_calls, [
+            unittest.mock.call.write('/name', 'test'),
+            unittest.mock.call.write('/type', 'AppVM'),
+        ])
+
+        qdb.reset_mock()
+        with self.assertRaises(ValueError):
+            with vm.batched_qdb():
+                vm.untrusted_qdb.write('/name', 'test')
+                raise ValueError
+        self.assertEqual(qdb.mock_calls, [])
+        self.assertIs(vm.untrusted_qdb, qdb)
+
+    def test_834_firewall_reload_batched(self):
+        template = self.get_vm(cls=qubes.vm.templatevm.TemplateVM,
+            name='template')
+        template.netvm = None
+        netvm = self.get_vm(cls=qubes.vm.appvm.AppVM, template=template,
+            name='netvm', qid=2, provides_network=True)
+        vm = self.get_vm(cls=qubes.vm.appvm.AppVM, template=template,
+            name='appvm', qid=3)
+        vm.netvm = netvm
+        qdb = unittest.mock.Mock()
+        netvm._qdb_connection = qdb
+        sent_before_rules = []
+        qdb_entries = qubes.firewall.Firewall.qdb_entries
+
+        def record_qdb_entries(firewall, **kwargs):
+            sent_before_rules.append(len(qdb.mock_calls))
+            return qdb_entries(firewall, **kwargs)
+
+        with unittest.mock.patch('qubes.vm.qubesvm.QubesVM.is_running',
+                    lambda _: True), \
+                unittest.mock.patch('qubes.firewall.Firewall.qdb_entries',
+                    record_qdb_entries):
+            vm.fire_event('firewall-changed')
+        # r3compatibility extension writes its own entries first
+        calls = qdb.mock_calls
+        first = calls.index(unittest.mock.call.write(
+            '/mapped-ip/10.137.0.3/visible-ip', '10.137.0.3'))
+        # mapped IP entries were not sent before computing rules
+        self.assertEqual(sent_before_rules, [first])
+        self.assertEqual(calls[first + 1:first + 3], [
+            unittest.mock.call.write('/mapped-ip/10.137.0.3/visible-gateway',
+                '10.137.0.2'),
+            unittest.mock.call.rm('/qubes-firewall/10.137.0.3/'),
+        ])
+        self.assertEqual(sorted(calls[first + 3:-1]), [
+            unittest.mock.call.write('/qubes-firewall/10.137.0.3/0000',
+                'action=accept'),
+            unittest.mock.call.write('/qubes-firewall/10.137.0.3/policy',
+                'drop'),
+        ])
+        self.assertEqual(calls[-1],
+            unittest.mock.call.write('/qubes-firewall/10.137.0.3', ''))
+
+    def test_840_operation_timing(self):
+        timing = qubes.vm.qubesvm.OperationTiming('start')
+        timing.phase('pre-start')
+        timing.record('storage', 0.25)
+        timing.phase('prepare')
+        self.assertIsNone(timing.result)
+        timing.finish('ok')
+        self.assertEqual(timing.result, 'ok')
+        self.assertEqual([name for name, _ in timing.phases],
+            ['pre-start', 'storage', 'prepare'])
+        self.assertGreaterEqual(timing.total,
+            sum(duration for name, duration in timing.phases
+                if name != 'storage'))
+        self.assertRegex(str(timing),
+            r'^start ok total=\d+\.\d{3} pre-start=\d+\.\d{3} '
+            r'storage=0\.250 prepare=\d+\.\d{3}$')
+
+    def test_841_timed_operation(self):
+        vm = self.get_vm()
+        events = []
+        vm.add_handler('domain-start-timing',
+            lambda subject, event, timing: events.append(timing))
+        with vm._timed_operation('start', 'domain-start-timing') as timing:
+            timing.phase('pre-start')
+        with self.assertRaises(qubes.exc.QubesException):
+            with vm._timed_operation('start', 'domain-start-timing'):
+                raise qubes.exc.QubesException('failed')
+        self.assertEqual([timing.result for timing in events],
+            ['ok', 'failed'])
+        self.assertEqual(list(vm.operation_timings), events)
+        self.assertEqual([name for name, _ in events[0].phases],
+            ['pre-start'])
+
+    def test_842_timed_operation_history(self):
+        vm = self.get_vm()
+        for _ in range(qubes.config.defaults['operation_timings_count'] + 1):
+            with vm._timed_operation('shutdown', 'domain-shutdown-timing'):
+                pass
+        self.assertEqual(len(vm.operation_timings),
+            qubes.config.defaults['operation_timings_count'])
+
+    def test_843_prepare_start_timing(self):
+        vm, _, _ = self.get_vm_for_prepare_start()
+        timing = qubes.vm.qubesvm.OperationTiming('start')
+        self.loop.run_until_complete(
+            vm._prepare_start(True, None, None, timing=timing))
+        self.assertEqual(sorted(name for name, _ in timing.phases),
+            ['memory', 'netvm', 'storage'])
+        self.assertGreaterEqual(dict(timing.phases)['storage'], 0.01)
+
+    def test_844_timed_operation_handler_failed(self):
+        vm = self.get_vm()
+        def handler(subject, event, timing):
+            raise RuntimeError('handler failed')
+        vm.add_handler('domain-start-timing', handler)
+        with self.assertRaises(qubes.exc.QubesException):
+            with vm._timed_operation('start', 'domain-start-timing'):
+                raise qubes.exc.QubesException('failed')
+        with vm._timed_operation('start', 'domain-start-timing'):
+            pass
+        self.assertEqual([timing.result for timing in vm.operation_timings],
+            ['failed', 'ok'])
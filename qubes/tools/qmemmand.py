@@ -19,16 +19,22 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 #
+import asyncio
+import collections
 import configparser
-import socketserver
+import json
 import logging
 import logging.handlers
 import os
 import socket
 import sys
-import threading
+import time
 
-import xen.lowlevel.xs
+try:
+    import xen.lowlevel.xs
+except ImportError:
+    # allow running with simulated Xen, see qubes.tests.perf.qmemman_sim
+    pass
 
 import qubes.qmemman
 import qubes.qmemman.algo
@@ -36,9 +42,21 @@ import qubes.utils
 
 SOCK_PATH = '/var/run/qubes/qmemman.sock'
 LOG_PATH = '/var/log/qubes/qmemman.log'
+# how often to log balance scheduler statistics
+STATS_LOG_INTERVAL = 600
+# This is only default - can be overridden with value from config file
+# how long (in seconds) a memory request may wait for memory, including time
+# spent waiting for earlier requests
+REQUEST_TIMEOUT = 120
+# how long (in seconds) to wait for more requests to merge with a request
+# sent with "batch" hint
+REQUEST_BATCH_WINDOW = 0.05
 
 system_state = qubes.qmemman.SystemState()
-global_lock = threading.Lock()
+balance_scheduler = None
+# held while ballooning, while balancing, and by a client which got memory,
+# until it closes the connection (its VM is started)
+memory_lock = None
 # If XS_Watcher will
 # handle meminfo event before @introduceDomain, it will use
 # incomplete domain list for that and may redistribute memory
@@ -59,6 +77,23 @@ def only_in_first_list(l1, l2):
 def get_domain_meminfo_key(domain_id):
     return '/local/domain/'+domain_id+'/memory/meminfo'
 
+def get_domain_static_max_key(domain_id):
+    return '/local/domain/'+domain_id+'/memory/static-max'
+
+
+@asyncio.coroutine
+def run_async(steps):
+    '''Run a step generator (like
+    :py:meth:`qubes.qmemman.SystemState.do_balloon_iter`) without blocking
+    the event loop; return its result'''
+    try:
+        while True:
+            yield from asyncio.sleep(next(steps))
+    except StopIteration as e:
+        return e.value
+    finally:
+        steps.close()
+
 
 class WatchType(object):
     def __init__(self, fn, param):
@@ -66,70 +101,72 @@ class WatchType(object):
         self.param = param
 
 class XS_Watcher(object):
-    def __init__(self):
+    def __init__(self, loop=None, handle=None):
         self.log = logging.getLogger('qmemman.daemon.xswatcher')
         self.log.debug('XS_Watcher()')
 
-        self.handle = xen.lowlevel.xs.xs()
+        self.loop = loop or asyncio.get_event_loop()
+        self.handle = handle or xen.lowlevel.xs.xs()
         self.handle.watch('@introduceDomain', WatchType(
             XS_Watcher.domain_list_changed, False))
         self.handle.watch('@releaseDomain', WatchType(
             XS_Watcher.domain_list_changed, False))
         self.watch_token_dict = {}
+        self.static_max_watch_token_dict = {}
+        self.last_stats_log = time.monotonic()
+        #: set when balance may be due
+        self.balance_wakeup = asyncio.Event(loop=self.loop)
 
     def domain_list_changed(self, refresh_only=False):
         """
         Check if any domain was created/destroyed. If it was, update
-        appropriate list. Then redistribute memory.
+        appropriate list. Then schedule memory redistribution.
 
         :param refresh_only If True, only refresh domain list, do not
-        redistribute memory. In this mode, caller must already hold
-        global_lock.
+        redistribute memory.
         """
         self.log.debug('domain_list_changed(only_refresh={!r})'.format(
             refresh_only))
 
-        got_lock = False
-        if not refresh_only:
-            self.log.debug('acquiring global_lock')
-            global_lock.acquire()
-            got_lock = True
-            self.log.debug('global_lock acquired')
-        try:
-            curr = self.handle.ls('', '/local/domain')
-            if curr is None:
-                return
+        global force_refresh_domain_list
+        force_refresh_domain_list = False
 
-            # check if domain is really there, it may happen that some empty
-            # directories are left in xenstore
-            curr = list(filter(
-                lambda x:
-                self.handle.read('',
-                                 '/local/domain/{}/domid'.format(x)
-                                 ) is not None,
-                curr
-            ))
-            self.log.debug('curr={!r}'.format(curr))
-
-            for i in only_in_first_list(curr, self.watch_token_dict.keys()):
-                # new domain has been created
-                watch = WatchType(XS_Watcher.meminfo_changed, i)
-                self.watch_token_dict[i] = watch
-                self.handle.watch(get_domain_meminfo_key(i), watch)
-                system_state.add_domain(i)
-
-            for i in only_in_first_list(self.watch_token_dict.keys(), curr):
-                # domain destroyed
-                self.handle.unwatch(get_domain_meminfo_key(i), self.watch_token_dict[i])
-                self.watch_token_dict.pop(i)
-                system_state.del_domain(i)
-        finally:
-            if got_lock:
-                global_lock.release()
-                self.log.debug('global_lock released')
+        curr = self.handle.ls('', '/local/domain')
+        if curr is None:
+            return
+
+        # check if domain is really there, it may happen that some empty
+        # directories are left in xenstore
+        curr = list(filter(
+            lambda x:
+            self.handle.read('',
+                             '/local/domain/{}/domid'.format(x)
+                             ) is not None,
+            curr
+        ))
+        self.log.debug('curr={!r}'.format(curr))
+
+        for i in only_in_first_list(curr, self.watch_token_dict.keys()):
+            # new domain has been created
+            watch = WatchType(XS_Watcher.meminfo_changed, i)
+            self.watch_token_dict[i] = watch
+            self.handle.watch(get_domain_meminfo_key(i), watch)
+            system_state.add_domain(i)
+            watch = WatchType(XS_Watcher.static_max_changed, i)
+            self.static_max_watch_token_dict[i] = watch
+            self.handle.watch(get_domain_static_max_key(i), watch)
+
+        for i in only_in_first_list(self.watch_token_dict.keys(), curr):
+            # domain destroyed
+            self.handle.unwatch(get_domain_meminfo_key(i), self.watch_token_dict[i])
+            self.watch_token_dict.pop(i)
+            self.handle.unwatch(get_domain_static_max_key(i),
+                self.static_max_watch_token_dict.pop(i))
+            system_state.del_domain(i)
 
         if not refresh_only:
-            system_state.do_balance()
+            balance_scheduler.request_balance()
+            self.balance_wakeup.set()
 
 
     def meminfo_changed(self, domain_id):
@@ -139,76 +176,410 @@ class XS_Watcher(object):
         if untrusted_meminfo_key == None or untrusted_meminfo_key == b'':
             return
 
-        self.log.debug('acquiring global_lock')
-        global_lock.acquire()
-        self.log.debug('global_lock acquired')
-        try:
-            if force_refresh_domain_list:
-                self.domain_list_changed(refresh_only=True)
+        if force_refresh_domain_list:
+            self.domain_list_changed(refresh_only=True)
+        if domain_id not in system_state.domdict:
+            return
 
-            system_state.refresh_meminfo(domain_id, untrusted_meminfo_key)
-        finally:
-            global_lock.release()
-            self.log.debug('global_lock released')
+        balance_scheduler.refresh_meminfo(domain_id, untrusted_meminfo_key)
+        self.balance_wakeup.set()
 
+    def static_max_changed(self, domain_id):
+        self.log.debug('static_max_changed(domain_id={!r})'.format(domain_id))
+        system_state.refresh_static_max(domain_id)
 
-    def watch_loop(self):
-        self.log.debug('watch_loop()')
-        while True:
+    def log_stats(self):
+        now = time.monotonic()
+        if now - self.last_stats_log < STATS_LOG_INTERVAL:
+            return
+        self.last_stats_log = now
+        self.log.info('balance stats: {meminfo_updates} meminfo updates, '
+            '{balance_passes} balance passes ({immediate_passes} immediate), '
+            '{saved_passes} passes saved'.format(
+                **balance_scheduler.get_stats()))
+
+    def handle_watch(self):
+        '''Handle a single xenstore watch event; called by the event loop
+        when the watch fd is readable'''
+        try:
             result = self.handle.read_watch()
-            self.log.debug('watch_loop result={!r}'.format(result))
+            self.log.debug('handle_watch result={!r}'.format(result))
             token = result[1]
             token.fn(self, token.param)
+        except Exception as e:
+            self.log.exception(
+                'exception while handling xenstore watch: {!r}'.format(e))
 
+    @asyncio.coroutine
+    def balance_loop(self):
+        '''Run balance passes when :py:attr:`balance_scheduler` wants them'''
+        self.log.debug('balance_loop()')
+        while True:
+            timeout = balance_scheduler.get_timeout()
+            if timeout != 0:
+                self.balance_wakeup.clear()
+                # not asyncio.wait_for(), which may swallow a cancellation
+                # arriving together with the wakeup
+                timer = None
+                if timeout is not None:
+                    timer = self.loop.call_later(timeout,
+                        self.balance_wakeup.set)
+                try:
+                    yield from self.balance_wakeup.wait()
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                continue
+
+            with (yield from memory_lock):
+                if force_refresh_domain_list:
+                    self.domain_list_changed(refresh_only=True)
+                try:
+                    yield from run_async(
+                        balance_scheduler.balance_if_due_iter())
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.log.exception(
+                        'exception while balancing: {!r}'.format(e))
+            self.log_stats()
+
+
+class MemoryRequest(object):
+    '''A client request for *memsize* bytes of Xen free memory
+
+    *batch* is a client hint that more requests are likely to follow.
+    Memory granted to a *reservation* request is accounted in
+    :py:attr:`qubes.qmemman.SystemState.reservations` until released, instead
+    of holding :py:data:`memory_lock`.
+    '''
+    def __init__(self, memsize, timeout, loop, batch=False,
+            reservation=False):
+        self.memsize = memsize
+        self.batch = batch
+        self.reservation = reservation
+        self.deadline = loop.time() + timeout
+        #: future with True/False result (memory granted or not)
+        self.result = asyncio.Future(loop=loop)
+        #: future done when the client closes the connection
+        self.released = asyncio.Future(loop=loop)
+
+    def abandon(self):
+        '''Fail the request if not yet decided'''
+        if not self.result.done():
+            self.result.set_result(False)
+
+    def release(self):
+        self.abandon()
+        if not self.released.done():
+            self.released.set_result(None)
+
+
+class QMemmanServer(object):
+    '''Memory requests server
+
+    Requests are served in order of arrival. All requests pending at the
+    time (and, if some has "batch" hint, arriving within *batch_window*
+    seconds) are merged into a single balloon target and satisfied together.
+    If that fails, the oldest request is retried alone and the others are
+    put back. Ballooning does not block the event loop, so xenstore events
+    are still handled while a request waits for memory. A request not
+    satisfied within *timeout* seconds (including time waiting for earlier
+    requests) fails. Memory granted to a client is not yet allocated by its
+    VM, so it must not be given to other domains: protocol version 1 clients
+    hold :py:data:`memory_lock` until all of them close their connections;
+    with protocol version 2 the memory is accounted as reserved until the
+    client commits or releases it, and other requests and balancing go on
+    meanwhile.
+
+    Protocol version 1: client sends ``AMOUNT [batch]\n`` and gets ``OK\n``
+    or ``FAIL\n``; then it keeps the connection open until its VM is
+    started. Alternatively, client sends ``STATUS\n`` and gets
+    :py:meth:`get_status` encoded as JSON (single line), then the connection
+    is closed.
+
+    Protocol version 2 is started by client sending ``QMEMMAN 2\n``, to
+    which server replies the same. Then the (persistent) connection carries
+    any number of concurrent requests, identified by client-chosen numeric
+    IDs:
+
+    - ``RESERVE ID AMOUNT [batch]\n`` - request memory; server replies
+      ``ID OK\n`` or ``ID FAIL\n``, not necessarily in order of requests.
+      After ``FAIL`` the ID is finished.
+    - ``COMMIT ID\n`` - the VM is started (its memory is allocated)
+    - ``RELEASE ID\n`` - the memory is not needed anymore (VM start failed)
+
+    Closing the connection releases all its reservations.
+    '''
+    def __init__(self, watcher, request_timeout=None, batch_window=None,
+            loop=None):
+        self.log = logging.getLogger('qmemman.daemon.reqhandler')
+        self.watcher = watcher
+        self.loop = loop or asyncio.get_event_loop()
+        if request_timeout is None:
+            request_timeout = REQUEST_TIMEOUT
+        self.request_timeout = request_timeout
+        if batch_window is None:
+            batch_window = REQUEST_BATCH_WINDOW
+        self.batch_window = batch_window
+        #: requests waiting to be served, oldest first
+        self.pending = collections.deque()
+        self.request_added = asyncio.Event(loop=self.loop)
+        self.requests = 0
+        self.granted_requests = 0
+        self.timed_out_requests = 0
+        #: time from request arrival until the decision
+        self.request_latency = qubes.qmemman.LatencyHistogram()
+
+    def get_status(self):
+        '''Return state of memory management and statistics, as
+        JSON-serializable dict'''
+        status = system_state.get_status()
+        status['balance'] = balance_scheduler.get_stats()
+        status['balance']['latency'] = \
+            balance_scheduler.balance_latency.to_dict()
+        status['requests'] = {
+            'count': self.requests,
+            'granted': self.granted_requests,
+            'failed': self.request_latency.count - self.granted_requests,
+            'timed_out': self.timed_out_requests,
+            'pending': len(self.pending),
+            'latency': self.request_latency.to_dict(),
+        }
+        return status
+
+    def take_pending(self):
+        '''Remove and return all pending, still valid requests'''
+        batch = [request for request in self.pending
+            if not request.result.done()]
+        self.pending.clear()
+        return batch
+
+    @asyncio.coroutine
+    def balloon(self, batch):
+        '''Try to get memory for all requests in *batch*'''
+        memsize = sum(request.memsize for request in batch)
+        timeout = min(request.deadline for request in batch) - \
+            self.loop.time()
+        try:
+            return (yield from asyncio.wait_for(
+                run_async(system_state.do_balloon_iter(memsize)),
+                max(0, timeout), loop=self.loop))
+        except asyncio.TimeoutError:
+            self.log.warning('timeout while ballooning for {}'.format(
+                memsize))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log.exception('exception while ballooning: {!r}'.format(e))
+        return False
+
+    @asyncio.coroutine
+    def process_requests(self):
+        '''Satisfy pending requests, oldest first'''
+        while True:
+            while not self.pending:
+                self.request_added.clear()
+                yield from self.request_added.wait()
+
+            with (yield from memory_lock):
+                if any(request.batch for request in self.pending) and \
+                        self.batch_window:
+                    yield from asyncio.sleep(self.batch_window)
+                batch = self.take_pending()
+                if not batch:
+                    continue
+                if len(batch) > 1:
+                    self.log.info('merging {} memory requests'.format(
+                        len(batch)))
+                got_memory = yield from self.balloon(batch)
+                if not got_memory and len(batch) > 1:
+                    # give the oldest request a chance alone
+                    self.pending.extendleft(reversed(batch[1:]))
+                    batch = batch[:1]
+                    got_memory = yield from self.balloon(batch)
+
+                granted = []
+                for request in batch:
+                    # skip requests timed out meanwhile
+                    if request.result.done():
+                        continue
+                    request.result.set_result(got_memory)
+                    if not request.reservation:
+                        granted.append(request)
+                    elif got_memory:
+                        system_state.add_reservation(request, request.memsize)
+                if not granted:
+                    continue
+                yield from asyncio.wait(
+                    [request.released for request in granted],
+                    loop=self.loop)
+                global force_refresh_domain_list
+                force_refresh_domain_list = True
+
+    def release(self, request):
+        '''Release memory granted to *request* (or abandon it, if not yet
+        decided)'''
+        request.release()
+        if system_state.remove_reservation(request):
+            # the memory is either used by the new domain, or free again
+            global force_refresh_domain_list
+            force_refresh_domain_list = True
+            balance_scheduler.request_balance()
+            self.watcher.balance_wakeup.set()
+
+    @asyncio.coroutine
+    def submit(self, memsize, batch=False, reservation=False):
+        '''Queue a request for *memsize* bytes and wait for the decision
+
+        The caller must call :py:meth:`release` when done.
+
+        :return: tuple (request, got_memory)
+        '''
+        request = MemoryRequest(memsize, self.request_timeout, self.loop,
+            batch=batch, reservation=reservation)
+        self.requests += 1
+        started = self.loop.time()
+        self.pending.append(request)
+        self.request_added.set()
+        try:
+            got_memory = yield from asyncio.wait_for(
+                asyncio.shield(request.result, loop=self.loop),
+                self.request_timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            self.log.warning('memory request for {} timed out'.format(
+                request.memsize))
+            request.abandon()
+            got_memory = request.result.result()
+            if not got_memory:
+                self.timed_out_requests += 1
+        except asyncio.CancelledError:
+            self.release(request)
+            raise
+        self.request_latency.add(self.loop.time() - started)
+        if got_memory:
+            self.granted_requests += 1
+        return request, got_memory
+
+    @asyncio.coroutine
+    def handle_client(self, reader, writer):
+        request = None
+        try:
+            untrusted_data = (yield from reader.readline()).strip()
+            self.log.debug('data={!r}'.format(untrusted_data))
+            if len(untrusted_data) == 0:
+                self.log.info('EOF')
+                return
 
-class QMemmanReqHandler(socketserver.BaseRequestHandler):
-    """
-    The RequestHandler class for our server.
-
-    It is instantiated once per connection to the server, and must
-    override the handle() method to implement communication to the
-    client.
-    """
+            if untrusted_data == b'QMEMMAN 2':
+                yield from self.handle_session(reader, writer)
+                return
 
-    def handle(self):
-        self.log = logging.getLogger('qmemman.daemon.reqhandler')
+            if untrusted_data == b'STATUS':
+                writer.write(json.dumps(self.get_status()).encode() + b'\n')
+                yield from writer.drain()
+                return
 
-        got_lock = False
-        try:
-            # self.request is the TCP socket connected to the client
-            while True:
-                self.data = self.request.recv(1024).strip()
-                self.log.debug('data={!r}'.format(self.data))
-                if len(self.data) == 0:
-                    self.log.info('EOF')
-                    if got_lock:
-                        global force_refresh_domain_list
-                        force_refresh_domain_list = True
-                    return
-
-                # XXX something is wrong here: return without release?
-                if got_lock:
-                    self.log.warning('Second request over qmemman.sock?')
-                    return
-
-                self.log.debug('acquiring global_lock')
-                global_lock.acquire()
-                self.log.debug('global_lock acquired')
-
-                got_lock = True
-                if system_state.do_balloon(int(self.data.decode('ascii'))):
-                    resp = b"OK\n"
-                else:
-                    resp = b"FAIL\n"
-                self.log.debug('resp={!r}'.format(resp))
-                self.request.send(resp)
+            untrusted_fields = untrusted_data.decode('ascii').split()
+            if len(untrusted_fields) > 2 or (len(untrusted_fields) == 2 and
+                    untrusted_fields[1] != 'batch'):
+                raise ValueError('invalid request')
+            request, got_memory = yield from self.submit(
+                int(untrusted_fields[0]), batch=(len(untrusted_fields) == 2))
+
+            if got_memory:
+                resp = b"OK\n"
+            else:
+                resp = b"FAIL\n"
+            self.log.debug('resp={!r}'.format(resp))
+            writer.write(resp)
+            yield from writer.drain()
+
+            # wait for the client to finish starting its VM
+            untrusted_data = yield from reader.read(1024)
+            if len(untrusted_data) == 0:
+                self.log.info('EOF')
+            else:
+                self.log.warning('Second request over qmemman.sock?')
         except BaseException as e:
             self.log.exception(
                 "exception while handling request: {!r}".format(e))
         finally:
-            if got_lock:
-                global_lock.release()
-                self.log.debug('global_lock released')
+            if request is not None:
+                self.release(request)
+            writer.close()
+
+    @asyncio.coroutine
+    def reserve(self, request_id, memsize, batch, writer, tasks):
+        '''Handle ``RESERVE`` request of protocol version 2
+
+        :param dict tasks: session's tasks, the ID is removed from there if
+            the request fails
+        :return: the request, if memory was granted
+        '''
+        request, got_memory = yield from self.submit(memsize, batch=batch,
+            reservation=True)
+        if not got_memory:
+            self.release(request)
+            tasks.pop(request_id, None)
+        writer.write('{} {}\n'.format(request_id,
+            'OK' if got_memory else 'FAIL').encode('ascii'))
+        return request if got_memory else None
+
+    def finish_reservation(self, task):
+        '''Release the request of ``RESERVE`` *task*, or cancel it if still
+        pending'''
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None \
+                and task.result() is not None:
+            self.release(task.result())
+
+    @asyncio.coroutine
+    def handle_session(self, reader, writer):
+        '''Handle protocol version 2 connection'''
+        writer.write(b'QMEMMAN 2\n')
+        #: ID -> RESERVE task
+        tasks = {}
+        try:
+            while True:
+                untrusted_data = yield from reader.readline()
+                if not untrusted_data:
+                    self.log.debug('EOF')
+                    break
+                untrusted_fields = untrusted_data.decode('ascii').split()
+                self.log.debug('session data={!r}'.format(untrusted_fields))
+                if not untrusted_fields:
+                    raise ValueError('empty request')
+                command = untrusted_fields[0]
+                if command == 'RESERVE' and len(untrusted_fields) in (3, 4):
+                    if len(untrusted_fields) == 4 and \
+                            untrusted_fields[3] != 'batch':
+                        raise ValueError('invalid request')
+                    request_id = int(untrusted_fields[1])
+                    memsize = int(untrusted_fields[2])
+                    if request_id in tasks:
+                        raise ValueError(
+                            'duplicate request ID {}'.format(request_id))
+                    tasks[request_id] = asyncio.ensure_future(
+                        self.reserve(request_id, memsize,
+                            len(untrusted_fields) == 4, writer, tasks),
+                        loop=self.loop)
+                elif command in ('COMMIT', 'RELEASE') and \
+                        len(untrusted_fields) == 2:
+                    request_id = int(untrusted_fields[1])
+                    if request_id not in tasks:
+                        # may have failed meanwhile
+                        self.log.warning('{} of unknown request ID {}'.format(
+                            command, request_id))
+                        continue
+                    self.log.info('{} {}'.format(command.lower(), request_id))
+                    self.finish_reservation(tasks.pop(request_id))
+                else:
+                    raise ValueError('invalid request')
+        finally:
+            for task in list(tasks.values()):
+                self.finish_reservation(task)
 
 
 parser = qubes.tools.QubesArgumentParser(want_app=False)
@@ -252,7 +623,14 @@ def main():
     config = configparser.SafeConfigParser({
             'vm-min-mem': str(qubes.qmemman.algo.MIN_PREFMEM),
             'dom0-mem-boost': str(qubes.qmemman.algo.DOM0_MEM_BOOST),
-            'cache-margin-factor': str(qubes.qmemman.algo.CACHE_FACTOR)
+            'cache-margin-factor': str(qubes.qmemman.algo.CACHE_FACTOR),
+            'balance-interval': str(qubes.qmemman.BALANCE_INTERVAL),
+            'balance-pressure-threshold':
+                str(qubes.qmemman.BALANCE_PRESSURE_THRESHOLD),
+            'request-timeout': str(REQUEST_TIMEOUT),
+            'request-batch-window': str(REQUEST_BATCH_WINDOW),
+            'reserve-max': str(qubes.qmemman.RESERVE_MAX),
+            'reserve-window': str(qubes.qmemman.RESERVE_WINDOW),
             })
     config.read(args.config)
 
@@ -263,11 +641,32 @@ def main():
             qubes.utils.parse_size(config.get('global', 'dom0-mem-boost'))
         qubes.qmemman.algo.CACHE_FACTOR = \
             config.getfloat('global', 'cache-margin-factor')
+        qubes.qmemman.BALANCE_INTERVAL = \
+            config.getfloat('global', 'balance-interval')
+        qubes.qmemman.BALANCE_PRESSURE_THRESHOLD = \
+            qubes.utils.parse_size(
+                config.get('global', 'balance-pressure-threshold'))
+        request_timeout = config.getfloat('global', 'request-timeout')
+        batch_window = config.getfloat('global', 'request-batch-window')
+        qubes.qmemman.RESERVE_MAX = \
+            qubes.utils.parse_size(config.get('global', 'reserve-max'))
+        qubes.qmemman.RESERVE_WINDOW = \
+            config.getfloat('global', 'reserve-window')
+    else:
+        request_timeout = REQUEST_TIMEOUT
+        batch_window = REQUEST_BATCH_WINDOW
 
     log.info('MIN_PREFMEM={algo.MIN_PREFMEM}'
         ' DOM0_MEM_BOOST={algo.DOM0_MEM_BOOST}'
-        ' CACHE_FACTOR={algo.CACHE_FACTOR}'.format(
-            algo=qubes.qmemman.algo))
+        ' CACHE_FACTOR={algo.CACHE_FACTOR}'
+        ' BALANCE_INTERVAL={qmemman.BALANCE_INTERVAL}'
+        ' BALANCE_PRESSURE_THRESHOLD={qmemman.BALANCE_PRESSURE_THRESHOLD}'
+        ' REQUEST_TIMEOUT={request_timeout}'
+        ' REQUEST_BATCH_WINDOW={batch_window}'
+        ' RESERVE_MAX={qmemman.RESERVE_MAX}'
+        ' RESERVE_WINDOW={qmemman.RESERVE_WINDOW}'
+        .format(algo=qubes.qmemman.algo, qmemman=qubes.qmemman,
+            request_timeout=request_timeout, batch_window=batch_window))
 
     try:
         os.unlink(SOCK_PATH)
@@ -280,7 +679,20 @@ def main():
     # Initialize the connection to Xen and to XenStore
     system_state.init()
 
-    server = socketserver.UnixStreamServer(SOCK_PATH, QMemmanReqHandler)
+    loop = asyncio.get_event_loop()
+
+    global balance_scheduler, memory_lock
+    balance_scheduler = qubes.qmemman.BalanceScheduler(system_state)
+    if qubes.qmemman.RESERVE_MAX > 0:
+        system_state.reserve_policy = qubes.qmemman.ReservePolicy(
+            qubes.qmemman.RESERVE_MAX)
+    memory_lock = asyncio.Lock(loop=loop)
+
+    watcher = XS_Watcher(loop=loop)
+    server = QMemmanServer(watcher, request_timeout=request_timeout,
+        batch_window=batch_window, loop=loop)
+    loop.run_until_complete(asyncio.start_unix_server(server.handle_client,
+        SOCK_PATH, loop=loop))
     os.umask(0o077)
 
     # notify systemd
@@ -294,5 +706,7 @@ def main():
         s.sendall(b"READY=1")
         s.close()
 
-    threading.Thread(target=server.serve_forever).start()
-    XS_Watcher().watch_loop()
+    loop.add_reader(watcher.handle.fileno(), watcher.handle_watch)
+    loop.create_task(watcher.balance_loop())
+    loop.create_task(server.process_requests())
+    loop.run_forever()
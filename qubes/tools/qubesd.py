@@ -11,10 +11,15 @@ import qubes.api
 import qubes.api.admin
 import qubes.api.internal
 import qubes.api.misc
+import qubes.bulk
 import qubes.log
 import qubes.utils
+import qubes.vm.dispvm
 import qubes.vm.qubesvm
 
+#: created when autostart qubes were started, to do that only once per boot
+AUTOSTART_FLAG = '/var/run/qubes/autostart-done'
+
 def sighandler(loop, signame, servers):
     print('caught {}, exiting'.format(signame))
     for server in servers:
@@ -25,6 +30,34 @@ parser = qubes.tools.QubesArgumentParser(description='Qubes OS daemon')
 parser.add_argument('--debug', action='store_true', default=False,
     help='Enable verbose error logging (all exceptions with full '
          'tracebacks) and also send tracebacks to Admin API clients')
+parser.add_argument('--cache-permissions', action='store_true', default=False,
+    help='Cache admin-permission decisions, when all the extensions handling '
+         'them declare which events invalidate the decision')
+parser.add_argument('--autostart', action='store_true', default=False,
+    help='Start qubes with autostart property set, in dependency order '
+         '(once per boot, unless qubes.skip_autostart is given on the kernel '
+         'command line)')
+
+def should_autostart():
+    '''Check if autostart qubes should be started now'''
+    if os.path.exists(AUTOSTART_FLAG):
+        return False
+    try:
+        with open('/proc/cmdline') as cmdline_file:
+            if 'qubes.skip_autostart' in cmdline_file.read().split():
+                return False
+    except FileNotFoundError:
+        pass
+    return True
+
+def start_autostart(app):
+    '''Start autostart qubes in the background'''
+    os.makedirs(os.path.dirname(AUTOSTART_FLAG), exist_ok=True)
+    # before actually starting, so a crash does not repeat it
+    with open(AUTOSTART_FLAG, 'w'):
+        pass
+    app.autostart_scheduler = qubes.bulk.AutostartScheduler(app)
+    return asyncio.ensure_future(app.autostart_scheduler.execute())
 
 def main(args=None):
     loop = asyncio.get_event_loop()
@@ -36,15 +69,23 @@ def main(args=None):
         raise
 
     args.app.register_event_handlers()
+    qubes.vm.dispvm.DispVMPoolManager(args.app).refill_all()
 
     if args.debug:
         qubes.log.enable_debug()
 
+    permission_cache = None
+    if args.cache_permissions:
+        permission_cache = qubes.api.PermissionCache(args.app)
+
     servers = loop.run_until_complete(qubes.api.create_servers(
         qubes.api.admin.QubesAdminAPI,
         qubes.api.internal.QubesInternalAPI,
         qubes.api.misc.QubesMiscAPI,
-        app=args.app, debug=args.debug))
+        app=args.app, debug=args.debug, permission_cache=permission_cache))
+
+    if args.autostart and should_autostart():
+        start_autostart(args.app)
 
     socknames = []
     for server in servers:
@@ -55,12 +96,16 @@ def main(args=None):
         loop.add_signal_handler(getattr(signal, signame),
             sighandler, loop, signame, servers)
 
+    loop_lag_monitor = qubes.utils.LoopLagMonitor(log=args.app.log)
+    loop_lag_monitor.start()
+
     qubes.utils.systemd_notify()
     # make sure children will not inherit this
     os.environ.pop('NOTIFY_SOCKET', None)
 
     try:
         loop.run_forever()
+        loop_lag_monitor.stop()
         loop.run_until_complete(asyncio.wait([
             server.wait_closed() for server in servers]))
         for sockname in socknames:
@@ -22,6 +22,7 @@
 
 import asyncio
 import hashlib
+import logging
 import random
 import string
 import os
@@ -204,3 +205,61 @@ def void_coros_maybe(values):
         done, _ = yield from asyncio.wait(coros)
         for task in done:
             task.result()  # re-raises exception if task failed
+
+class LoopLagMonitor:
+    '''Measure responsiveness of the event loop
+
+    Every *interval* seconds a callback is scheduled, and the delay between
+    the time it was scheduled for and the time it was actually called (the
+    lag) is recorded. Lag larger than *threshold* is logged.
+
+    :param float interval: how often to measure, in seconds
+    :param float threshold: lag worth a warning, in seconds
+    :param log: logger to use
+    '''
+    def __init__(self, interval=0.5, threshold=1.0, log=None, loop=None):
+        self.interval = interval
+        self.threshold = threshold
+        self.log = log or logging.getLogger('qubes.looplag')
+        self.loop = loop or asyncio.get_event_loop()
+        #: number of measurements
+        self.count = 0
+        #: sum of all measured lags
+        self.total_lag = 0.0
+        #: the last measured lag
+        self.last_lag = 0.0
+        #: the largest measured lag
+        self.max_lag = 0.0
+        self._expected = None
+        self._handle = None
+
+    def start(self):
+        '''Start measuring'''
+        self._expected = self.loop.time() + self.interval
+        self._handle = self.loop.call_at(self._expected, self._tick)
+
+    def stop(self):
+        '''Stop measuring'''
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _tick(self):
+        lag = max(0.0, self.loop.time() - self._expected)
+        self.count += 1
+        self.total_lag += lag
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        if lag > self.threshold:
+            self.log.warning('Event loop lagging by %.3f s', lag)
+        self.start()
+
+    def get_stats(self):
+        '''Return dict with ``count``, ``avg``, ``last`` and ``max`` lag (in
+        seconds)'''
+        return {
+            'count': self.count,
+            'avg': self.total_lag / self.count if self.count else 0.0,
+            'last': self.last_lag,
+            'max': self.max_lag,
+        }
@@ -207,6 +207,13 @@ class BaseVM(qubes.PropertyHolder):
         self._qdb_watch_paths = set()
         self._qdb_connection_watch = None
 
+        #: incremented on each configuration change of this qube (properties,
+        #: features, devices); used to detect stale cached libvirt config
+        self.config_generation = 0
+        #: name of the libvirt XML template, see
+        #: :py:meth:`get_libvirt_template`
+        self._libvirt_template_name = None
+
         # self.app must be set before super().__init__, because some property
         # setters need working .app attribute
         #: mother :py:class:`qubes.Qubes` object
@@ -348,16 +355,35 @@ class BaseVM(qubes.PropertyHolder):
     # xml serialising methods
     #
 
-    def create_config_file(self):
-        '''Create libvirt's XML domain config file
+    @qubes.events.handler('property-set:*', 'property-del:*',
+        'domain-feature-set:*', 'domain-feature-delete:*',
+        'device-attach:*', 'device-detach:*')
+    def on_config_change(self, event, **kwargs):
+        '''Bump :py:attr:`config_generation`'''
+        # pylint: disable=unused-argument
+        self.config_generation += 1
 
+    def get_libvirt_template(self):
+        '''Return the template of libvirt's XML domain config
+
+        Which of the candidate templates is used is resolved only once for a
+        qube (adding a ``by-name`` template requires qubesd restart), but the
+        template itself is reloaded whenever its file changes.
         '''
-        domain_config = self.app.env.select_template([
+        if self._libvirt_template_name is None:
+            self._libvirt_template_name = self.app.env.select_template([
                 'libvirt/xen/by-name/{}.xml'.format(self.name),
                 'libvirt/xen-user.xml',
                 'libvirt/xen-dist.xml',
                 'libvirt/xen.xml',
-            ]).render(vm=self)
+            ]).name
+        return self.app.env.get_template(self._libvirt_template_name)
+
+    def create_config_file(self):
+        '''Create libvirt's XML domain config file
+
+        '''
+        domain_config = self.get_libvirt_template().render(vm=self)
         return domain_config
 
     def watch_qdb_path(self, path):
@@ -128,6 +128,14 @@ class AdminVM(qubes.vm.BaseVM):
         '''
         return 'Running'
 
+    @staticmethod
+    def invalidate_libvirt_state():
+        '''Does nothing, dom0 state is not cached.
+
+        .. seealso:
+           :py:meth:`qubes.vm.qubesvm.QubesVM.invalidate_libvirt_state`
+        '''
+
     @staticmethod
     def get_mem():
         '''Get current memory usage of Dom0.
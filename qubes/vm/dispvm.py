@@ -21,6 +21,8 @@
 ''' A disposable vm implementation '''
 
 import asyncio
+import collections
+import time
 
 import qubes.vm.qubesvm
 import qubes.vm.appvm
@@ -157,11 +159,13 @@ class DispVM(qubes.vm.qubesvm.QubesVM):
 
     @classmethod
     @asyncio.coroutine
-    def from_appvm(cls, appvm, **kwargs):
+    def from_appvm(cls, appvm, prestarted=False, **kwargs):
         '''Create a new instance from given AppVM
 
         :param qubes.vm.appvm.AppVM appvm: template from which the VM should \
             be created
+        :param bool prestarted: the caller accepts an already running \
+            DispVM, taken from a pool of pre-started ones
         :returns: new disposable vm
 
         *kwargs* are passed to the newly created VM
@@ -172,13 +176,21 @@ class DispVM(qubes.vm.qubesvm.QubesVM):
         >>> dispvm.cleanup()
 
         This method modifies :file:`qubes.xml` file.
-        The qube returned is not started.
+        The qube returned is not started, unless *prestarted* is set and it
+        was taken from a pool of pre-started DispVMs (see
+        :py:class:`DispVMPool`). Only callers which start the qube right away
+        without changing its configuration should set *prestarted*.
         '''
         if not appvm.template_for_dispvms:
             raise qubes.exc.QubesException(
                 'Refusing to create DispVM out of this AppVM, because '
                 'template_for_dispvms=False')
         app = appvm.app
+        pools = getattr(app, 'dispvm_pools', None)
+        if pools is not None and cls is DispVM and not kwargs:
+            dispvm = yield from pools.get_pool(appvm).take(prestarted)
+            if dispvm is not None:
+                return dispvm
         dispvm = app.add_new_vm(
             cls,
             template=appvm,
@@ -226,3 +238,294 @@ class DispVM(qubes.vm.qubesvm.QubesVM):
     def create_qdb_entries(self):
         super().create_qdb_entries()
         self.untrusted_qdb.write('/qubes-vm-persistence', 'none')
+
+
+class DispVMPool:
+    '''Pool of ready to use DispVMs based on a single AppVM
+
+    The pool is configured with features of the AppVM:
+
+     - ``dispvm-pool-size`` - number of DispVMs to keep ready
+     - ``dispvm-pool-prestart`` - start them and keep them paused
+
+    Total memory of pre-started DispVMs (in all the pools) is limited by
+    ``dispvm-pool-memory`` feature of dom0 (MiB, no limit if not set); DispVMs
+    above that limit are only created, not started. Pre-started DispVMs are
+    handed out only to callers which ask for them (see
+    :py:meth:`DispVM.from_appvm`), like ``admin.vm.CreateDisposable`` called
+    with ``prestarted`` argument.
+
+    Pooled DispVMs have ``internal`` and ``dispvm-pool`` features set; both
+    are removed when a DispVM is handed out. Then the pool is refilled in the
+    background.
+
+    DispVMs copy properties, firewall, features and tags of the AppVM when
+    created. When any of those change, pooled DispVMs are discarded (see
+    :py:meth:`invalidate`) and the pool is filled again.
+    '''
+
+    def __init__(self, manager, appvm):
+        self.manager = manager
+        #: the AppVM the DispVMs are based on
+        self.appvm = appvm
+        #: DispVMs ready to be handed out, oldest first
+        self.ready = []
+        #: number of requests served from the pool
+        self.hits = 0
+        #: number of requests which found the pool empty
+        self.misses = 0
+        #: time (in seconds) to prepare each of the recent DispVMs
+        self.refill_latencies = collections.deque(maxlen=100)
+        #: DispVMs created with outdated configuration of the AppVM, to be
+        #: removed
+        self.stale = []
+        #: incremented on each change of the AppVM configuration
+        self.generation = 0
+        self._refill_task = None
+
+    @property
+    def size(self):
+        '''Configured pool size'''
+        if not getattr(self.appvm, 'template_for_dispvms', False):
+            return 0
+        try:
+            return max(0, int(self.appvm.features.get('dispvm-pool-size', 0)))
+        except ValueError:
+            return 0
+
+    @property
+    def prestart(self):
+        '''Should pooled DispVMs be pre-started?'''
+        return bool(self.appvm.features.get('dispvm-pool-prestart', False))
+
+    def _prune(self):
+        '''Forget DispVMs removed in the meantime (for example after a
+        crash of a pre-started one)'''
+        self.ready = [dispvm for dispvm in self.ready
+            if dispvm in self.appvm.app.domains]
+        self.stale = [dispvm for dispvm in self.stale
+            if dispvm in self.appvm.app.domains]
+
+    def invalidate(self):
+        '''Discard pooled DispVMs, because configuration of the AppVM has
+        changed, and fill the pool again in the background'''
+        self.generation += 1
+        self.stale.extend(self.ready)
+        self.ready = []
+        self.schedule_refill()
+
+    @asyncio.coroutine
+    def take(self, prestarted=False):
+        '''Take a DispVM out of the pool
+
+        :param bool prestarted: a pre-started (running) DispVM may be \
+            returned; otherwise only halted ones are
+        :return: DispVM or :py:obj:`None` if the pool has none suitable
+        '''
+        if not self.size:
+            return None
+        self._prune()
+        self.schedule_refill()
+        candidates = [dispvm for dispvm in self.ready
+            if prestarted or dispvm.is_halted()]
+        if not candidates:
+            self.misses += 1
+            return None
+        dispvm = candidates[0]
+        self.ready.remove(dispvm)
+        self.hits += 1
+        del dispvm.features['dispvm-pool']
+        if 'internal' in self.appvm.features:
+            dispvm.features['internal'] = self.appvm.features['internal']
+        else:
+            del dispvm.features['internal']
+        self.appvm.app.save()
+        if dispvm.is_paused():
+            yield from dispvm.unpause()
+        return dispvm
+
+    @asyncio.coroutine
+    def _create(self):
+        '''Create a new DispVM for the pool'''
+        app = self.appvm.app
+        dispvm = app.add_new_vm(DispVM, template=self.appvm,
+            auto_cleanup=True)
+        dispvm.features['internal'] = True
+        dispvm.features['dispvm-pool'] = True
+        yield from dispvm.create_on_disk()
+        app.save()
+        if self.prestart and self.manager.can_prestart(dispvm):
+            yield from dispvm.start()
+            yield from dispvm.pause()
+        return dispvm
+
+    @asyncio.coroutine
+    def _discard(self, dispvm):
+        '''Remove a DispVM no longer needed in the pool'''
+        yield from dispvm.cleanup()
+        # halted DispVMs are not removed automatically
+        if dispvm in self.appvm.app.domains:
+            del self.appvm.app.domains[dispvm]
+            yield from dispvm.remove_from_disk()
+            self.appvm.app.save()
+
+    @asyncio.coroutine
+    def refill(self):
+        '''Create (or remove) DispVMs until the pool has the configured size'''
+        while True:
+            self._prune()
+            size = self.size
+            if self.stale:
+                yield from self._discard(self.stale.pop())
+            elif len(self.ready) > size:
+                yield from self._discard(self.ready.pop())
+            elif len(self.ready) < size:
+                start_time = time.monotonic()
+                generation = self.generation
+                dispvm = yield from self._create()
+                if generation != self.generation:
+                    # the AppVM changed while creating it
+                    self.stale.append(dispvm)
+                    continue
+                self.ready.append(dispvm)
+                self.refill_latencies.append(time.monotonic() - start_time)
+            else:
+                break
+
+    def schedule_refill(self):
+        '''Run :py:meth:`refill` in the background, unless already running'''
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.ensure_future(self._refill_logged())
+        return self._refill_task
+
+    @asyncio.coroutine
+    def _refill_logged(self):
+        try:
+            yield from self.refill()
+        except Exception:  # pylint: disable=broad-except
+            self.appvm.log.exception('Failed to refill DispVM pool')
+
+    def get_stats(self):
+        '''Return pool statistics, as a dict'''
+        latencies = list(self.refill_latencies)
+        return {
+            'size': self.size,
+            'ready': len(self.ready),
+            'prestart': self.prestart,
+            'hits': self.hits,
+            'misses': self.misses,
+            'refill_count': len(latencies),
+            'refill_latency_last':
+                latencies[-1] if latencies else None,
+            'refill_latency_avg':
+                sum(latencies) / len(latencies) if latencies else None,
+        }
+
+
+class DispVMPoolManager:
+    '''DispVM pools of all the AppVMs
+
+    Creating the manager enables the pools: it is stored as
+    ``app.dispvm_pools`` and used by :py:meth:`DispVM.from_appvm`. DispVMs
+    pooled earlier (halted or paused) are adopted back into their pools.
+    Pools are refilled whenever their configuration changes.
+    '''
+
+    #: events, fired on an AppVM, which may change its pool configuration
+    #: or the configuration DispVMs copy from it
+    appvm_events = (
+        'domain-feature-set:*',
+        'domain-feature-delete:*',
+        'property-set:*',
+        'property-del:*',
+        'domain-tag-add:*',
+        'domain-tag-delete:*',
+        'firewall-changed',
+    )
+
+    def __init__(self, app):
+        self.app = app
+        #: AppVM -> :py:class:`DispVMPool`
+        self.pools = {}
+
+        for vm in app.domains:
+            if isinstance(vm, qubes.vm.appvm.AppVM):
+                self._watch(vm)
+        for vm in app.domains:
+            if isinstance(vm, DispVM) and 'dispvm-pool' in vm.features \
+                    and (vm.is_halted() or vm.is_paused()):
+                self.get_pool(vm.template).ready.append(vm)
+        app.add_handler('domain-add', self.on_domain_add)
+        app.add_handler('domain-delete', self.on_domain_delete)
+        app.dispvm_pools = self
+
+    def _watch(self, appvm):
+        for event in self.appvm_events:
+            appvm.add_handler(event, self.on_appvm_changed)
+
+    def on_domain_add(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        if isinstance(vm, qubes.vm.appvm.AppVM):
+            self._watch(vm)
+
+    def on_domain_delete(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        self.pools.pop(vm, None)
+
+    def on_appvm_changed(self, subject, event, **kwargs):
+        '''Refill the pool when its configuration changes; discard pooled
+        DispVMs when anything they copy from the AppVM changes'''
+        if subject not in self.pools and \
+                'dispvm-pool-size' not in subject.features:
+            return
+        if event.startswith('domain-feature-'):
+            if kwargs['feature'].startswith('dispvm-pool-'):
+                self.get_pool(subject).schedule_refill()
+                return
+        elif event.startswith('property-'):
+            name = kwargs['name']
+            if name == 'template_for_dispvms':
+                self.get_pool(subject).schedule_refill()
+                return
+            # DispVMs do not copy those
+            if name != 'template' and \
+                    not subject.property_get_def(name).clone:
+                return
+        self.get_pool(subject).invalidate()
+
+    def get_pool(self, appvm):
+        '''Return the pool of *appvm*, creating it if needed'''
+        if appvm not in self.pools:
+            self.pools[appvm] = DispVMPool(self, appvm)
+        return self.pools[appvm]
+
+    @property
+    def memory_budget(self):
+        '''Memory (MiB) for pre-started DispVMs, :py:obj:`None` if
+        unlimited'''
+        try:
+            value = self.app.domains['dom0'].features.get(
+                'dispvm-pool-memory', None)
+        except KeyError:
+            return None
+        try:
+            return int(value) if value else None
+        except ValueError:
+            return None
+
+    def can_prestart(self, dispvm):
+        '''Check if *dispvm* can be pre-started within
+        :py:attr:`memory_budget`'''
+        budget = self.memory_budget
+        if budget is None:
+            return True
+        used = sum(vm.memory for pool in self.pools.values()
+            for vm in pool.ready if not vm.is_halted())
+        return used + dispvm.memory <= budget
+
+    def refill_all(self):
+        '''Schedule refill of all the configured pools'''
+        for vm in self.app.domains:
+            if isinstance(vm, qubes.vm.appvm.AppVM) and \
+                    (vm in self.pools or 'dispvm-pool-size' in vm.features):
+                self.get_pool(vm).schedule_refill()
@@ -355,20 +355,21 @@ class NetVMMixin(qubes.events.Emitter):
         if not self.is_running():
             return
 
-        for addr_family in (4, 6):
-            ip = vm.ip6 if addr_family == 6 else vm.ip
-            if ip is None:
-                continue
-            base_dir = '/qubes-firewall/{}/'.format(ip)
-            # remove old entries if any (but don't touch base empty entry - it
-            # would trigger reload right away
-            self.untrusted_qdb.rm(base_dir)
-            # write new rules
-            for key, value in vm.firewall.qdb_entries(
-                    addr_family=addr_family).items():
-                self.untrusted_qdb.write(base_dir + key, value)
-            # signal its done
-            self.untrusted_qdb.write(base_dir[:-1], '')
+        with self.batched_qdb():
+            for addr_family in (4, 6):
+                ip = vm.ip6 if addr_family == 6 else vm.ip
+                if ip is None:
+                    continue
+                base_dir = '/qubes-firewall/{}/'.format(ip)
+                # remove old entries if any (but don't touch base empty entry -
+                # it would trigger reload right away
+                self.untrusted_qdb.rm(base_dir)
+                # write new rules
+                for key, value in vm.firewall.qdb_entries(
+                        addr_family=addr_family).items():
+                    self.untrusted_qdb.write(base_dir + key, value)
+                # signal its done
+                self.untrusted_qdb.write(base_dir[:-1], '')
 
     def set_mapped_ip_info_for_vm(self, vm):
         '''
@@ -378,16 +379,17 @@ class NetVMMixin(qubes.events.Emitter):
         '''
         # add info about remapped IPs (VM IP hidden from the VM itself)
         mapped_ip_base = '/mapped-ip/{}'.format(vm.ip)
-        if vm.visible_ip:
-            self.untrusted_qdb.write(mapped_ip_base + '/visible-ip',
-                str(vm.visible_ip))
-        else:
-            self.untrusted_qdb.rm(mapped_ip_base + '/visible-ip')
-        if vm.visible_gateway:
-            self.untrusted_qdb.write(mapped_ip_base + '/visible-gateway',
-                str(vm.visible_gateway))
-        else:
-            self.untrusted_qdb.rm(mapped_ip_base + '/visible-gateway')
+        with self.batched_qdb():
+            if vm.visible_ip:
+                self.untrusted_qdb.write(mapped_ip_base + '/visible-ip',
+                    str(vm.visible_ip))
+            else:
+                self.untrusted_qdb.rm(mapped_ip_base + '/visible-ip')
+            if vm.visible_gateway:
+                self.untrusted_qdb.write(mapped_ip_base + '/visible-gateway',
+                    str(vm.visible_gateway))
+            else:
+                self.untrusted_qdb.rm(mapped_ip_base + '/visible-gateway')
 
     @qubes.events.handler('property-pre-del:netvm')
     def on_property_pre_del_netvm(self, event, name, oldvalue=None):
@@ -467,8 +469,10 @@ class NetVMMixin(qubes.events.Emitter):
         ''' Reloads the firewall if vm is running and has a NetVM assigned '''
         # pylint: disable=unused-argument
         if self.is_running() and self.netvm:
-            self.netvm.set_mapped_ip_info_for_vm(self)
-            self.netvm.reload_firewall_for_vm(self)  # pylint: disable=no-member
+            # pylint: disable=no-member
+            with self.netvm.batched_qdb():
+                self.netvm.set_mapped_ip_info_for_vm(self)
+                self.netvm.reload_firewall_for_vm(self)
 
     # CORE2: swallowed get_firewall_conf, write_firewall_conf,
     # get_firewall_defaults
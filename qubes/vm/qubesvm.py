@@ -24,12 +24,16 @@ from __future__ import absolute_import
 
 import asyncio
 import base64
+import collections
+import contextlib
+import functools
 import grp
 import os
 import os.path
 import shutil
 import string
 import subprocess
+import time
 import uuid
 import warnings
 
@@ -195,6 +199,121 @@ def _default_kernelopts(self):
                 qubes.config.defaults['kernelopts'])
 
 
+class QubesDBBatch:
+    """Collect QubesDB writes and removals, to send them at once
+
+    Operations are sent in order by :py:meth:`flush`. A write superseded by
+    a later write to the same path, or by a removal of that path, is
+    dropped. Reads (and any other operation) flush the batch first.
+
+    If the database is known to be *empty* (like just after qubesdb-daemon
+    was started), removals are not sent at all until the first flush, as
+    they can only remove entries written in this batch.
+
+    :param qdb: QubesDB connection
+    :param bool empty: the database does not contain any entries
+    """
+
+    def __init__(self, qdb, empty=False):
+        self._qdb = qdb
+        self._empty = empty
+        #: pending operations: (method name, path, value); dropped ones are
+        #: replaced with None
+        self._ops = []
+        #: path -> index in _ops of the pending write
+        self._writes = {}
+
+    def __len__(self):
+        return sum(1 for operation in self._ops if operation is not None)
+
+    def write(self, path, value):
+        """Schedule a write"""
+        if path in self._writes:
+            self._ops[self._writes[path]] = None
+        self._writes[path] = len(self._ops)
+        self._ops.append(('write', path, value))
+
+    def remove(self, path):
+        """Schedule a removal; *path* ending with ``/`` removes the whole
+        directory"""
+        if path.endswith('/'):
+            removed = [p for p in self._writes if p.startswith(path)]
+        else:
+            removed = [path] if path in self._writes else []
+        for removed_path in removed:
+            self._ops[self._writes.pop(removed_path)] = None
+        if not self._empty:
+            self._ops.append(('rm', path, None))
+
+    # the name used by qubesdb.QubesDB, which this replaces
+    rm = remove  # pylint: disable=invalid-name
+
+    def flush(self):
+        """Send the pending operations"""
+        ops = self._ops
+        self._ops = []
+        self._writes = {}
+        self._empty = False
+        for operation in ops:
+            if operation is None:
+                continue
+            method, path, value = operation
+            if method == 'write':
+                self._qdb.write(path, value)
+            else:
+                self._qdb.rm(path)
+
+    def __getattr__(self, name):
+        self.flush()
+        return getattr(self._qdb, name)
+
+
+class OperationTiming:
+    """Durations of phases of an operation on a qube (like start)
+
+    Phases are consecutive, each :py:meth:`phase` call ends the current one.
+    Steps running concurrently within a phase are added with
+    :py:meth:`record`. Durations are in seconds.
+
+    :param str operation: name of the operation
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        #: wall-clock time when the operation started
+        self.started = time.time()
+        #: list of (phase name, duration)
+        self.phases = []
+        #: ``'ok'`` or ``'failed'``, :py:obj:`None` until finished
+        self.result = None
+        #: total duration, :py:obj:`None` until finished
+        self.total = None
+        self._start = time.monotonic()
+        self._last = self._start
+
+    def phase(self, name):
+        """End phase *name*, which started when the previous one ended"""
+        now = time.monotonic()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def record(self, name, duration):
+        """Record duration of a step, without ending the current phase"""
+        self.phases.append((name, duration))
+
+    def finish(self, result):
+        """Mark the operation as finished"""
+        self.result = result
+        self.total = time.monotonic() - self._start
+
+    def __str__(self):
+        return ' '.join(
+            ['{} {} total={:.3f}'.format(self.operation, self.result,
+                self.total if self.total is not None else float('nan'))]
+            + ['{}={:.3f}'.format(name, duration)
+                for name, duration in self.phases])
+
+
 class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
     """Base functionality of Qubes VM shared between all VMs.
 
@@ -258,6 +377,26 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             :param subject: Event emitter (the qube object)
             :param event: Event name (``'domain-start-failed'``)
 
+        .. event:: domain-start-timing (subject, event, timing)
+
+            Fired when :py:meth:`start` finishes (successfully or not), with
+            durations of its phases.
+
+            :param subject: Event emitter (the qube object)
+            :param event: Event name (``'domain-start-timing'``)
+            :param timing: :py:class:`OperationTiming` object
+
+        .. event:: domain-shutdown-timing (subject, event, timing)
+
+            Fired when :py:meth:`shutdown` finishes, and when handling of
+            domain stop (``'domain-stopped'`` and ``'domain-shutdown'``
+            events) finishes. *timing.operation* is ``'shutdown'`` or
+            ``'stopped'`` respectively.
+
+            :param subject: Event emitter (the qube object)
+            :param event: Event name (``'domain-shutdown-timing'``)
+            :param timing: :py:class:`OperationTiming` object
+
         .. event:: domain-paused (subject, event)
 
             Fired when the domain has been paused.
@@ -747,6 +886,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         try:
             self._libvirt_domain = self.app.vmm.libvirt_conn.lookupByUUID(
                 self.uuid.bytes)
+            self._libvirt_config_cache.pop('defined', None)
         except libvirt.libvirtError as e:
             if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
                 self._update_libvirt_domain()
@@ -754,6 +894,16 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                 raise
         return self._libvirt_domain
 
+    @property
+    def libvirt_domain_async(self):
+        """Asynchronous facade of :py:attr:`libvirt_domain`, calling libvirt
+        outside of the event loop (see
+        :py:class:`qubes.app.AsyncVirDomainWrapper`).
+        """
+        import qubes.app  # pylint: disable=redefined-outer-name
+
+        return qubes.app.AsyncVirDomainWrapper.for_domain(self.libvirt_domain)
+
     @property
     def block_devices(self):
         """ Return all :py:class:`qubes.storage.BlockDevice` for current domain
@@ -766,13 +916,64 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
     @property
     def untrusted_qdb(self):
-        """QubesDB handle for this domain."""
+        """QubesDB handle for this domain.
+
+        Inside :py:meth:`batched_qdb`, this is a :py:class:`QubesDBBatch`.
+        """
+        if self._qdb_batch is not None:
+            return self._qdb_batch
         if self._qdb_connection is None:
             if self.is_running():
                 import qubesdb  # pylint: disable=import-error
                 self._qdb_connection = qubesdb.QubesDB(self.name)
         return self._qdb_connection
 
+    @contextlib.contextmanager
+    def batched_qdb(self, empty=False):
+        """Collect QubesDB writes to this domain made in the ``with`` block,
+        and send them when the block completes successfully.
+
+        :param bool empty: QubesDB of this domain does not contain any \
+            entries yet (see :py:class:`QubesDBBatch`)
+
+        >>> with vm.batched_qdb():
+        ...     vm.untrusted_qdb.write('/name', vm.name)
+        """
+        if self._qdb_batch is not None:
+            # already batching
+            yield self._qdb_batch
+            return
+        self._qdb_batch = QubesDBBatch(self.untrusted_qdb, empty=empty)
+        try:
+            yield self._qdb_batch
+            self._qdb_batch.flush()
+        finally:
+            self._qdb_batch = None
+
+    @contextlib.contextmanager
+    def _timed_operation(self, operation, event):
+        """Measure *operation* made in the ``with`` block
+
+        The :py:class:`OperationTiming` object is saved in
+        :py:attr:`operation_timings`, logged and sent with *event*.
+        """
+        timing = OperationTiming(operation)
+        try:
+            yield timing
+        except BaseException:
+            timing.finish('failed')
+            raise
+        else:
+            timing.finish('ok')
+        finally:
+            self.operation_timings.append(timing)
+            self.log.info('Timing: %s', timing)
+            # do not mask the exception of the operation itself
+            try:
+                self.fire_event(event, timing=timing)
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception('Failed to fire %s', event)
+
     @property
     def dir_path(self):
         """Root directory for files related to this domain"""
@@ -841,7 +1042,17 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         # Init private attrs
 
         self._libvirt_domain = None
+        self._libvirt_state = None
+        #: libvirt configs: ``'rendered'`` - (key, config) of the last
+        #: rendered one, ``'defined'`` - the one :py:attr:`_libvirt_domain`
+        #: was defined with by us
+        self._libvirt_config_cache = {}
         self._qdb_connection = None
+        self._qdb_batch = None
+
+        #: timings of the last operations (see :py:class:`OperationTiming`)
+        self.operation_timings = collections.deque(
+            maxlen=qubes.config.defaults['operation_timings_count'])
 
         # We assume a fully halted VM here. The 'domain-init' handler will
         # check if the VM is already running.
@@ -882,6 +1093,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             self._qdb_connection = None
         if self._libvirt_domain is not None:
             self._libvirt_domain = None
+        self._libvirt_state = None
+        self._libvirt_config_cache = {}
         super().close()
 
     def __hash__(self):
@@ -1060,122 +1273,219 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
             yield from self._ensure_shutdown_handled()
 
-            self.log.info('Starting {}'.format(self.name))
-
-            try:
-                yield from self.fire_event_async('domain-pre-start',
-                                                 pre_event=True,
-                                                 start_guid=start_guid,
-                                                 mem_required=mem_required)
-            except Exception as exc:
-                self.log.error('Start failed: %s', str(exc))
-                yield from self.fire_event_async('domain-start-failed',
-                                                 reason=str(exc))
-                raise
-
-            qmemman_client = None
-            try:
-                for devclass in self.devices:
-                    for dev in self.devices[devclass].persistent():
-                        if isinstance(dev, qubes.devices.UnknownDevice):
-                            raise qubes.exc.QubesException(
-                                '{} device {} not available'.format(
-                                    devclass, dev))
-
-                if self.virt_mode == 'pvh' and not self.kernel:
-                    raise qubes.exc.QubesException(
-                        'virt_mode PVH require kernel to be set')
-                yield from self.storage.verify()
-
-                if self.netvm is not None:
-                    # pylint: disable = no-member
-                    if self.netvm.qid != 0:
-                        if not self.netvm.is_running():
-                            yield from self.netvm.start(
-                                start_guid=start_guid,
-                                notify_function=notify_function)
-
-                qmemman_client = yield from asyncio.get_event_loop(). \
-                    run_in_executor(None, self.request_memory, mem_required)
-
-                yield from self.storage.start()
-
-            except Exception as exc:
-                self.log.error('Start failed: %s', str(exc))
-                # let anyone receiving domain-pre-start know that startup failed
-                yield from self.fire_event_async('domain-start-failed',
-                                                 reason=str(exc))
-                if qmemman_client:
-                    qmemman_client.close()
-                raise
-
-            try:
-                self._update_libvirt_domain()
+            with self._timed_operation('start',
+                    'domain-start-timing') as timing:
+                self.log.info('Starting {}'.format(self.name))
 
-                self.libvirt_domain.createWithFlags(
-                    libvirt.VIR_DOMAIN_START_PAUSED)
-
-            except libvirt.libvirtError as exc:
-                # missing IOMMU?
-                if self.virt_mode == 'hvm' and \
-                        list(self.devices['pci'].persistent()) and \
-                        not self.app.host.is_iommu_supported():
-                    exc = qubes.exc.QubesException(
-                        'Failed to start an HVM qube with PCI devices assigned '
-                        '- hardware does not support IOMMU/VT-d/AMD-Vi')
-                self.log.error('Start failed: %s', str(exc))
-                yield from self.fire_event_async('domain-start-failed',
-                                                 reason=str(exc))
-                yield from self.storage.stop()
-                raise exc
-            except Exception as exc:
-                self.log.error('Start failed: %s', str(exc))
-                # let anyone receiving domain-pre-start know that startup failed
-                yield from self.fire_event_async('domain-start-failed',
-                                                 reason=str(exc))
-                yield from self.storage.stop()
-                raise
-
-            finally:
-                if qmemman_client:
-                    qmemman_client.close()
-
-            self._domain_stopped_event_received = False
-            self._domain_stopped_event_handled = False
+                try:
+                    yield from self.fire_event_async('domain-pre-start',
+                                                     pre_event=True,
+                                                     start_guid=start_guid,
+                                                     mem_required=mem_required)
+                    timing.phase('pre-start')
+                except Exception as exc:
+                    self.log.error('Start failed: %s', str(exc))
+                    yield from self.fire_event_async('domain-start-failed',
+                                                     reason=str(exc))
+                    raise
+
+                qmemman_client = None
+                try:
+                    for devclass in self.devices:
+                        for dev in self.devices[devclass].persistent():
+                            if isinstance(dev, qubes.devices.UnknownDevice):
+                                raise qubes.exc.QubesException(
+                                    '{} device {} not available'.format(
+                                        devclass, dev))
+
+                    if self.virt_mode == 'pvh' and not self.kernel:
+                        raise qubes.exc.QubesException(
+                            'virt_mode PVH require kernel to be set')
+                    yield from self.storage.verify()
+                    timing.phase('verify')
+
+                    qmemman_client = yield from self._prepare_start(
+                        start_guid, notify_function, mem_required,
+                        timing=timing)
+                    timing.phase('prepare')
+
+                except Exception as exc:
+                    self.log.error('Start failed: %s', str(exc))
+                    # let anyone receiving domain-pre-start know that startup
+                    # failed
+                    yield from self.fire_event_async('domain-start-failed',
+                                                     reason=str(exc))
+                    raise
 
-            try:
-                yield from self.fire_event_async('domain-spawn',
-                                                 start_guid=start_guid)
+                try:
+                    self._update_libvirt_domain()
+
+                    yield from self.libvirt_domain_async.createWithFlags(
+                        libvirt.VIR_DOMAIN_START_PAUSED)
+                    self.invalidate_libvirt_state()
+                    timing.phase('libvirt-create')
+                    if qmemman_client:
+                        # the domain has its memory now
+                        qmemman_client.commit()
+
+                except libvirt.libvirtError as exc:
+                    # missing IOMMU?
+                    if self.virt_mode == 'hvm' and \
+                            list(self.devices['pci'].persistent()) and \
+                            not self.app.host.is_iommu_supported():
+                        exc = qubes.exc.QubesException(
+                            'Failed to start an HVM qube with PCI devices '
+                            'assigned - hardware does not support '
+                            'IOMMU/VT-d/AMD-Vi')
+                    self.log.error('Start failed: %s', str(exc))
+                    yield from self.fire_event_async('domain-start-failed',
+                                                     reason=str(exc))
+                    yield from self.storage.stop()
+                    raise exc
+                except Exception as exc:
+                    self.log.error('Start failed: %s', str(exc))
+                    # let anyone receiving domain-pre-start know that startup
+                    # failed
+                    yield from self.fire_event_async('domain-start-failed',
+                                                     reason=str(exc))
+                    yield from self.storage.stop()
+                    raise
+
+                finally:
+                    if qmemman_client:
+                        qmemman_client.close()
+
+                self._domain_stopped_event_received = False
+                self._domain_stopped_event_handled = False
 
-                self.log.info('Setting Qubes DB info for the VM')
-                yield from self.start_qubesdb()
-                self.create_qdb_entries()
-                self.start_qdb_watch()
+                try:
+                    yield from self.fire_event_async('domain-spawn',
+                                                     start_guid=start_guid)
+                    timing.phase('spawn')
+
+                    self.log.info('Setting Qubes DB info for the VM')
+                    yield from self.start_qubesdb()
+                    # qubesdb-daemon was just started, nothing to remove there
+                    with self.batched_qdb(empty=True):
+                        self.create_qdb_entries()
+                    self.start_qdb_watch()
+                    timing.phase('qubesdb')
+
+                    self.log.warning('Activating the {} VM'.format(self.name))
+                    yield from self.libvirt_domain_async.resume()
+                    self.invalidate_libvirt_state()
+                    timing.phase('resume')
+
+                    yield from self.start_qrexec_daemon()
+                    timing.phase('qrexec')
+
+                    yield from self.fire_event_async('domain-start',
+                                                     start_guid=start_guid)
+                    timing.phase('start')
+
+                except Exception as exc:  # pylint: disable=bare-except
+                    self.log.error('Start failed: %s', str(exc))
+                    # This avoids losing the exception if an exception is
+                    # raised in self.force_shutdown(), because the vm is not
+                    # running or paused
+                    try:
+                        yield from self._kill_locked()
+                    except qubes.exc.QubesVMNotStartedError:
+                        pass
 
-                self.log.warning('Activating the {} VM'.format(self.name))
-                self.libvirt_domain.resume()
+                    # let anyone receiving domain-pre-start know that startup
+                    # failed
+                    yield from self.fire_event_async('domain-start-failed',
+                                                     reason=str(exc))
+                    raise
 
-                yield from self.start_qrexec_daemon()
+        return self
 
-                yield from self.fire_event_async('domain-start',
-                                                 start_guid=start_guid)
+    @asyncio.coroutine
+    def _prepare_start(self, start_guid, notify_function, mem_required,
+            timing=None):
+        """Prepare resources needed to create the domain
+
+        Storage start runs concurrently with netvm start followed by memory
+        reservation; meanwhile libvirt config is rendered. Memory is
+        requested only after netvm is started: a granted request may block
+        other requests (including the netvm one) until the domain is
+        created. If any of those fails, the others are waited for and rolled
+        back (except netvm, which is left running).
+
+        Durations of the steps (``netvm``, ``memory``, ``storage``) are
+        recorded in *timing* (:py:class:`OperationTiming`), if given.
+
+        :return: qmemman client holding the memory reservation (or
+            :py:obj:`None`)
+        """
+        tasks = []
+        netvm_task = None
+        # pylint: disable=no-member
+        if self.netvm is not None and self.netvm.qid != 0 \
+                and not self.netvm.is_running():
+            netvm_task = asyncio.ensure_future(self.netvm.start(
+                start_guid=start_guid, notify_function=notify_function))
+            tasks.append(netvm_task)
+        memory_task = asyncio.ensure_future(
+            self._request_memory_after(netvm_task, mem_required))
+        storage_task = asyncio.ensure_future(self.storage.start())
+        tasks.extend((memory_task, storage_task))
+        if timing is not None:
+            started = time.monotonic()
+
+            def record_step(name, _task):
+                timing.record(name, time.monotonic() - started)
+
+            step_names = ('netvm', 'memory', 'storage')[-len(tasks):]
+            for name, task in zip(step_names, tasks):
+                task.add_done_callback(functools.partial(record_step, name))
 
-            except Exception as exc:  # pylint: disable=bare-except
-                self.log.error('Start failed: %s', str(exc))
-                # This avoids losing the exception if an exception is
-                # raised in self.force_shutdown(), because the vm is not
-                # running or paused
-                try:
-                    yield from self._kill_locked()
-                except qubes.exc.QubesVMNotStartedError:
-                    pass
+        try:
+            # the result is cached for _update_libvirt_domain(); don't bother
+            # if it can't be
+            if self._get_libvirt_config_key() is not None:
+                self.create_config_file()
+            yield from asyncio.wait(tasks)
+            for task in tasks:
+                # raise the first exception
+                task.result()
+        except asyncio.CancelledError:
+            # can't wait for the steps here
+            asyncio.ensure_future(self._rollback_prepare_start(tasks,
+                memory_task, storage_task))
+            raise
+        except Exception:
+            yield from self._rollback_prepare_start(tasks,
+                memory_task, storage_task)
+            raise
+        return memory_task.result()
 
-                # let anyone receiving domain-pre-start know that startup failed
-                yield from self.fire_event_async('domain-start-failed',
-                                                 reason=str(exc))
-                raise
+    @asyncio.coroutine
+    def _request_memory_after(self, netvm_task, mem_required):
+        """Request memory (see :py:meth:`request_memory`) once *netvm_task*
+        (if any) is done; nothing is requested if it failed"""
+        if netvm_task is not None:
+            # not "yield from netvm_task", cancelling us should not cancel it
+            yield from asyncio.wait([netvm_task])
+            if netvm_task.cancelled() or netvm_task.exception() is not None:
+                return None
+        return (yield from asyncio.get_event_loop().run_in_executor(None,
+            self.request_memory, mem_required))
 
-        return self
+    @asyncio.coroutine
+    def _rollback_prepare_start(self, tasks, memory_task, storage_task):
+        """Undo successful steps of :py:meth:`_prepare_start`, after all
+        *tasks* finish"""
+        yield from asyncio.wait(tasks)
+        if not memory_task.cancelled() and memory_task.exception() is None \
+                and memory_task.result() is not None:
+            memory_task.result().close()
+        if not storage_task.cancelled() and storage_task.exception() is None:
+            try:
+                yield from self.storage.stop()
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception('Failed to stop storage after failed start')
 
     def on_libvirt_domain_stopped(self):
         """ Handle VIR_DOMAIN_EVENT_STOPPED events from libvirt.
@@ -1209,10 +1519,15 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             # an exception gets thrown.
             self._domain_stopped_event_handled = True
 
-            while self.get_power_state() == 'Dying':
-                yield from asyncio.sleep(0.25)
-            yield from self.fire_event_async('domain-stopped')
-            yield from self.fire_event_async('domain-shutdown')
+            with self._timed_operation('stopped',
+                    'domain-shutdown-timing') as timing:
+                while self.get_power_state() == 'Dying':
+                    yield from asyncio.sleep(0.25)
+                timing.phase('dying')
+                yield from self.fire_event_async('domain-stopped')
+                timing.phase('stopped')
+                yield from self.fire_event_async('domain-shutdown')
+                timing.phase('shutdown')
 
     @qubes.events.handler('domain-stopped')
     @asyncio.coroutine
@@ -1239,28 +1554,35 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if self.is_halted():
             raise qubes.exc.QubesVMNotStartedError(self)
 
-        try:
-            yield from self.fire_event_async('domain-pre-shutdown',
-                                             pre_event=True, force=force)
-
-            self.libvirt_domain.shutdown()
-
-            if wait:
-                if timeout is None:
-                    timeout = self.shutdown_timeout
-                while timeout > 0 and not self.is_halted():
-                    yield from asyncio.sleep(0.25)
-                    timeout -= 0.25
-                with (yield from self.startup_lock):
-                    if self.is_halted():
-                        # make sure all shutdown tasks are completed
-                        yield from self._ensure_shutdown_handled()
-                    else:
-                        raise qubes.exc.QubesVMShutdownTimeoutError(self)
-        except Exception as ex:
-            yield from self.fire_event_async('domain-shutdown-failed',
-                                             reason=str(ex))
-            raise
+        with self._timed_operation('shutdown',
+                'domain-shutdown-timing') as timing:
+            try:
+                yield from self.fire_event_async('domain-pre-shutdown',
+                                                 pre_event=True, force=force)
+                timing.phase('pre-shutdown')
+
+                yield from self.libvirt_domain_async.shutdown()
+                self.invalidate_libvirt_state()
+                timing.phase('libvirt-shutdown')
+
+                if wait:
+                    if timeout is None:
+                        timeout = self.shutdown_timeout
+                    while timeout > 0 and not self.is_halted():
+                        yield from asyncio.sleep(0.25)
+                        timeout -= 0.25
+                    timing.phase('wait')
+                    with (yield from self.startup_lock):
+                        if self.is_halted():
+                            # make sure all shutdown tasks are completed
+                            yield from self._ensure_shutdown_handled()
+                        else:
+                            raise qubes.exc.QubesVMShutdownTimeoutError(self)
+                    timing.phase('cleanup')
+            except Exception as ex:
+                yield from self.fire_event_async('domain-shutdown-failed',
+                                                 reason=str(ex))
+                raise
 
         return self
 
@@ -1286,11 +1608,13 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         This function needs to be called with self.startup_lock held."""
         try:
-            self.libvirt_domain.destroy()
+            yield from self.libvirt_domain_async.destroy()
         except libvirt.libvirtError as e:
             if e.get_error_code() == libvirt.VIR_ERR_OPERATION_INVALID:
                 raise qubes.exc.QubesVMNotStartedError(self)
             raise
+        finally:
+            self.invalidate_libvirt_state()
 
         # make sure all shutdown tasks are completed
         yield from self._ensure_shutdown_handled()
@@ -1317,10 +1641,11 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             if self.features.check_with_template('qrexec', False):
                 yield from self.run_service_for_stdio('qubes.SuspendPre',
                                                       user='root')
-            self.libvirt_domain.pMSuspendForDuration(
+            yield from self.libvirt_domain_async.pMSuspendForDuration(
                 libvirt.VIR_NODE_SUSPEND_TARGET_MEM, 0, 0)
         else:
-            self.libvirt_domain.suspend()
+            yield from self.libvirt_domain_async.suspend()
+        self.invalidate_libvirt_state()
 
         return self
 
@@ -1331,7 +1656,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if not self.is_running():
             raise qubes.exc.QubesVMNotRunningError(self)
 
-        self.libvirt_domain.suspend()
+        yield from self.libvirt_domain_async.suspend()
+        self.invalidate_libvirt_state()
 
         return self
 
@@ -1345,7 +1671,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         # pylint: disable=not-an-iterable
         if self.get_power_state() == "Suspended":
-            self.libvirt_domain.pMWakeup()
+            yield from self.libvirt_domain_async.pMWakeup()
+            self.invalidate_libvirt_state()
             if self.features.check_with_template('qrexec', False):
                 yield from self.run_service_for_stdio('qubes.SuspendPost',
                                                       user='root')
@@ -1360,7 +1687,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if not self.is_paused():
             raise qubes.exc.QubesVMNotPausedError(self)
 
-        self.libvirt_domain.resume()
+        yield from self.libvirt_domain_async.resume()
+        self.invalidate_libvirt_state()
 
         return self
 
@@ -1856,50 +2184,116 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                 Libvirt's enum describing precise state of a domain.
         """  # pylint: disable=too-many-return-statements
 
+        if self.app.vmm.offline_mode:
+            return 'Halted'
+
+        cached = self._libvirt_state is not None
+        active, state = self._get_libvirt_state()
+        if cached and active and state == libvirt.VIR_DOMAIN_RUNNING \
+                and not self._domain_stopped_event_received:
+            # shutdown initiated by the guest starts without any event, do
+            # not report it as running
+            self.invalidate_libvirt_state()
+            active, state = self._get_libvirt_state()
+        if not active:
+            return 'Halted'
+        if state == libvirt.VIR_DOMAIN_PAUSED:
+            return "Paused"
+        if state == libvirt.VIR_DOMAIN_CRASHED:
+            return "Crashed"
+        if state == libvirt.VIR_DOMAIN_SHUTDOWN:
+            return "Halting"
+        if state == libvirt.VIR_DOMAIN_SHUTOFF:
+            return "Dying"
+        if state == libvirt.VIR_DOMAIN_PMSUSPENDED:
+            return "Suspended"
+        if not self.is_fully_usable():
+            return "Transient"
+        return "Running"
+
+    def _query_libvirt_state(self):
+        """Ask libvirt about the domain state.
+
+        :returns: tuple ``(active, state)``, where *state* is one of \
+            ``libvirt.VIR_DOMAIN_*`` constants (meaningful only for active \
+            domain)
+        """
         # don't try to define libvirt domain, if it isn't there, VM surely
         # isn't running
         # reason for this "if": allow vm.is_running() in PCI (or other
         # device) extension while constructing libvirt XML
-        if self.app.vmm.offline_mode:
-            return 'Halted'
         if self._libvirt_domain is None:
             try:
                 self._libvirt_domain = self.app.vmm.libvirt_conn.lookupByUUID(
                     self.uuid.bytes)
             except libvirt.libvirtError as e:
                 if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
-                    return 'Halted'
+                    return False, libvirt.VIR_DOMAIN_SHUTOFF
                 raise
 
         libvirt_domain = self.libvirt_domain
         if libvirt_domain is None:
-            return 'Halted'
+            return False, libvirt.VIR_DOMAIN_SHUTOFF
 
         try:
-            if libvirt_domain.isActive():
-                # pylint: disable=line-too-long
-                if libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED:
-                    return "Paused"
-                if libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_CRASHED:
-                    return "Crashed"
-                if libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_SHUTDOWN:
-                    return "Halting"
-                if libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_SHUTOFF:
-                    return "Dying"
-                if libvirt_domain.state()[
-                    0] == libvirt.VIR_DOMAIN_PMSUSPENDED:  # nopep8
-                    return "Suspended"
-                if not self.is_fully_usable():
-                    return "Transient"
-                return "Running"
-
-            return 'Halted'
+            if not libvirt_domain.isActive():
+                return False, libvirt.VIR_DOMAIN_SHUTOFF
+            state = libvirt_domain.state()[0]
         except libvirt.libvirtError as e:
             if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
-                return 'Halted'
+                return False, libvirt.VIR_DOMAIN_SHUTOFF
             raise
 
-        assert False
+        # Xen flips between those two all the time, without any event
+        if state == libvirt.VIR_DOMAIN_BLOCKED:
+            state = libvirt.VIR_DOMAIN_RUNNING
+        return True, state
+
+    def _get_libvirt_state(self):
+        """Get the domain state, as returned by
+        :py:meth:`_query_libvirt_state`, possibly from cache.
+
+        The state is cached only when libvirt lifecycle events are delivered
+        to :py:class:`qubes.Qubes` (see
+        :py:meth:`qubes.Qubes.register_event_handlers`). Any lifecycle event
+        for the domain, and any state change requested by qubesd, drops the
+        cached value (see :py:meth:`invalidate_libvirt_state`). Transitional
+        states (``Halting``, ``Dying``) are not cached, as those may end
+        without any event.
+        """
+        if self._libvirt_state is not None:
+            return self._libvirt_state
+
+        active, state = self._query_libvirt_state()
+        if getattr(self.app, 'cache_libvirt_state', False) and (not active
+                or state not in (libvirt.VIR_DOMAIN_SHUTDOWN,
+                    libvirt.VIR_DOMAIN_SHUTOFF)):
+            self._libvirt_state = (active, state)
+        return active, state
+
+    def invalidate_libvirt_state(self):
+        """Drop cached libvirt domain state.
+
+        This is called on each libvirt lifecycle event for the domain, and
+        whenever qubesd changes the domain state itself.
+        """
+        self._libvirt_state = None
+
+    def check_libvirt_state_cache(self):
+        """Compare cached libvirt domain state with the actual one.
+
+        This is meant for tests.
+
+        :returns: tuple ``(cached, actual)`` if the cached state is \
+            outdated, :py:obj:`None` otherwise
+        """
+        cached = self._libvirt_state
+        if cached is None:
+            return None
+        actual = self._query_libvirt_state()
+        if cached != actual:
+            return cached, actual
+        return None
 
     def is_halted(self):
         """ Check whether this domain's state is 'Halted'
@@ -1920,6 +2314,10 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if self.app.vmm.offline_mode:
             return False
 
+        if getattr(self.app, 'cache_libvirt_state', False):
+            active, _ = self._get_libvirt_state()
+            return active
+
         # don't try to define libvirt domain, if it isn't there, VM surely
         # isn't running
         # reason for this "if": allow vm.is_running() in PCI (or other
@@ -1943,8 +2341,11 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         :rtype: bool
         """
 
-        return self.libvirt_domain \
-               and self.libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED
+        if self.app.vmm.offline_mode:
+            return False
+
+        active, state = self._get_libvirt_state()
+        return active and state == libvirt.VIR_DOMAIN_PAUSED
 
     def is_qrexec_running(self):
         """Check whether qrexec for this domain is available.
@@ -2182,13 +2583,71 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         self.fire_event('domain-qdb-create')
 
+    def _get_libvirt_config_key(self):
+        """Return key identifying all the inputs of libvirt config, or
+        :py:obj:`None` if the config should not be cached.
+
+        The key consists of configuration generations of this qube, its
+        netvm and their templates, and of the app, plus things which may
+        change without an event: block devices of volumes, persistent PCI
+        assignments and kernel options (read from files in the kernel
+        directory). Qubes with persistent block devices are not cached, as
+        their config depends on the backend state.
+        """
+        if not self.events_enabled:
+            return None
+        if any(True for _ in self.devices['block'].assignments(True)):
+            return None
+        related = []
+        for vm in (self, getattr(self, 'netvm', None)):
+            while vm is not None and vm not in related:
+                related.append(vm)
+                vm = getattr(vm, 'template', None)
+        return (
+            self.get_libvirt_template(),
+            getattr(self.app, 'config_generation', None),
+            tuple((vm.name, vm.config_generation) for vm in related),
+            tuple((dev.path, dev.name, dev.script, dev.rw, dev.domain,
+                dev.devtype) for dev in self.block_devices),
+            tuple((assignment.backend_domain.name, assignment.ident,
+                tuple(sorted(assignment.options.items())))
+                for assignment in self.devices['pci'].assignments(True)),
+            (self.kernelopts, self.kernelopts_common) if self.kernel else None,
+        )
+
+    def create_config_file(self):
+        """Create libvirt's XML domain config file
+
+        The result is cached, until any of its inputs change (see
+        :py:meth:`_get_libvirt_config_key`).
+        """
+        key = self._get_libvirt_config_key()
+        cached_key, cached_config = self._libvirt_config_cache.get(
+            'rendered', (None, None))
+        if key is not None and cached_key == key:
+            return cached_config
+        domain_config = super().create_config_file()
+        if key is not None:
+            self._libvirt_config_cache['rendered'] = (key, domain_config)
+        return domain_config
+
     # TODO async; update this in constructor
     def _update_libvirt_domain(self):
-        """Re-initialise :py:attr:`libvirt_domain`."""
+        """Re-initialise :py:attr:`libvirt_domain`.
+
+        Nothing is done if the domain was already defined with the very same
+        config.
+        """
         domain_config = self.create_config_file()
+        if self._libvirt_domain is not None \
+                and self._libvirt_config_cache.get('defined') == domain_config:
+            return
+        self.invalidate_libvirt_state()
+        self._libvirt_config_cache.pop('defined', None)
         try:
             self._libvirt_domain = self.app.vmm.libvirt_conn.defineXML(
                 domain_config)
+            self._libvirt_config_cache['defined'] = domain_config
         except libvirt.libvirtError as e:
             if e.get_error_code() == libvirt.VIR_ERR_OS_TYPE \
                     and e.get_str2() == 'hvm':